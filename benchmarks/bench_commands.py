@@ -0,0 +1,155 @@
+#############################################################################
+##                 Benchmark: MQTT command to relay latency                ##
+#############################################################################
+# Runs the real control loop (scheduler, sensor task, command queue) on the
+# simulated box in real time against the local stand-in broker. A second
+# client sends exhauston / exhaustoff commands at random moments and waits
+# for each acknowledgement. Reports the latency measured by Grass (command
+# received to relay switched) and the round trip seen by the sender, with
+# the sensor task idle, busy with slow reads (DS18B20 conversion), and busy
+# without acting on commands while waiting for the reads.
+#
+# Usage: python benchmarks/bench_commands.py [--commands N] [--read-delay S]
+
+import os
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "grass"))
+
+import paho.mqtt.client as mqtt
+import grass
+import simulation
+import mqttsecrets
+from fakebroker import FakeBroker
+
+#######################################
+# Simulated box on the wall clock, with slow sensor reads
+#######################################
+class RealTimeBackend(simulation.SimBackend):
+    readDelay = 0.0
+
+    def time(self):
+        return time.time()
+
+    def readOneWire(self, path):
+        time.sleep(self.readDelay)
+        return super().readOneWire(path)
+
+#######################################
+# Grass running in the background
+#######################################
+def startGrass(broker, readDelay):
+    workDir = tempfile.mkdtemp(prefix="grass-bench-")
+    backend = RealTimeBackend(grass.relayNames, buckets=len(grass.SOIL_MOIST_ADR))
+    backend.readDelay = readDelay
+
+    mqttsecrets.Broker  = broker.host
+    mqttsecrets.Port    = broker.port
+    grass.hw            = backend
+    grass.energyPath    = os.path.join(workDir, "GrassEnergyUsed.txt")
+    grass.spoolPath     = os.path.join(workDir, "spool")
+    grass.parameterPath = os.path.join(workDir, "GrassParameters.json")
+    grass.historyPath   = os.path.join(workDir, "history")
+    grass.tentSetup()
+    tent = grass.controllers[0]
+    tent.hw = backend
+    tent.energySetup()
+    tent.historySetup()
+    grass.pahoSetup()
+    tent.sensorSetup()
+    tent.actuatorSetup()
+    grass.actuatorTimer.start()
+
+    tent.addTasks()
+    grass.taskScheduler.setInterval("sensors", 3600)
+    grass.taskScheduler.add("replay", grass.replayTask)
+    threading.Thread(target=grass.taskScheduler.runForever, name="grass", daemon=True).start()
+
+#######################################
+# Sends commands and waits for their acknowledgement
+#######################################
+class Commander:
+    def __init__(self, broker):
+        self.acks   = queue.Queue()
+        self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+        self.client.on_message = lambda client, userdata, message: self.acks.put((time.perf_counter(), message))
+        self.client.connect(broker.host, broker.port)
+        self.client.subscribe("grass/outputs/commands/#", qos=1)
+        self.client.loop_start()
+
+    def send(self, name, timeout=5):
+        # Returns (latency in Grass, round trip) in seconds, None if no acknowledgement came
+        sent = time.perf_counter()
+        self.client.publish("grass/inputs/command", name, qos=1)
+        while True:
+            try:
+                received, message = self.acks.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if message.topic.endswith("/" + name):
+                ack = json.loads(message.payload)
+                return ack["latency_ms"] / 1000, received - sent
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+#######################################
+# main()
+#######################################
+def main():
+    parser = argparse.ArgumentParser(description="Latency from MQTT command to switched relay")
+    parser.add_argument("--commands", type=int, default=200, help="Commands sent per scenario")
+    parser.add_argument("--read-delay", type=float, default=0.75, help="Seconds a water temperature read takes")
+    parser.add_argument("--sensor-interval", type=float, default=1.0, help="Sensor cycle under load in seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    broker = FakeBroker()
+    startGrass(broker, args.read_delay)
+    commander = Commander(broker)
+    rng = random.Random(0)
+    waitForReads = grass.commandsWhileReading
+
+    scenarios = [
+        ("idle",                        3600,                   waitForReads),
+        ("sensor load",                 args.sensor_interval,   waitForReads),
+        ("sensor load, no interrupt",   args.sensor_interval,   lambda: None),
+    ]
+    print("%d commands per scenario, latency in ms" % args.commands)
+    print("%-28s%10s%10s%10s%14s%14s" % ("scenario", "p50", "p99", "max", "round p50", "round p99"))
+    for name, interval, onInterrupt in scenarios:
+        grass.commandsWhileReading = onInterrupt
+        grass.taskScheduler.setInterval("sensors", interval)
+        time.sleep(0.5)
+        latencies, roundTrips, lost = [], [], 0
+        for idx in range(args.commands):
+            result = commander.send("exhauston" if idx % 2 == 0 else "exhaustoff")
+            if result is None:
+                lost += 1
+                continue
+            latencies.append(result[0])
+            roundTrips.append(result[1])
+            # Land at random moments of the sensor cycle
+            time.sleep(rng.uniform(0, 0.05))
+        print("%-28s%10.2f%10.2f%10.2f%14.2f%14.2f%s" % (
+            name,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            max(latencies) * 1000,
+            percentile(roundTrips, 0.5) * 1000,
+            percentile(roundTrips, 0.99) * 1000,
+            "  (%d lost)" % lost if lost else ""))
+    commander.client.loop_stop()
+    broker.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#############################################################################
+##                     Benchmark: sensor filtering                         ##
+#############################################################################
+# Two questions: how much better is a filtered reading than the single raw
+# sample used before, and what does filtering cost per sensor cycle with
+# NumPy and in plain Python, depending on the number of channels.
+#
+# Accuracy uses a soil moisture like channel: slow drift, gaussian noise and
+# the occasional garbage read (65535) the Seesaw sensors are known for.
+#
+# Usage: python benchmarks/bench_filtering.py [--cycles N] [--burst N]
+
+import os
+import sys
+import math
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "grass"))
+
+import filtering
+
+POLICY = filtering.Policy("median", window=12, tolerance=5.0)
+
+#######################################
+# A noisy sensor
+#######################################
+def sensor(rng, truth, sigma=3.0, glitch=0.03):
+    if rng.random() < glitch:
+        return 6553.5
+    return truth + rng.gauss(0, sigma)
+
+#######################################
+# Accuracy, RMS error against the true value
+#######################################
+def accuracy(cycles, burst, useNumpy):
+    rng     = random.Random(0)
+    bank    = filtering.FilterBank({"soil": POLICY}, useNumpy=useNumpy)
+    errors  = {"raw sample": [], "burst mean": [], "filtered": []}
+    confidence = []
+    for cycle in range(cycles):
+        truth   = 100 + 20 * math.sin(cycle / 200)
+        samples = [sensor(rng, truth) for _ in range(burst)]
+        bank.add("soil", samples)
+        value, conf = bank.evaluate()["soil"]
+        errors["raw sample"].append(samples[0] - truth)
+        errors["burst mean"].append(sum(samples) / len(samples) - truth)
+        errors["filtered"].append(value - truth)
+        confidence.append(conf)
+    rms = {name: math.sqrt(sum(e * e for e in values) / len(values)) for name, values in errors.items()}
+    return rms, sorted(confidence)[len(confidence) // 100]
+
+#######################################
+# Cost of one evaluation of all channels
+#######################################
+def cost(channels, burst, useNumpy, cycles=200):
+    rng     = random.Random(0)
+    bank    = filtering.FilterBank({"": POLICY}, useNumpy=useNumpy)
+    names   = ["channel/" + str(idx) for idx in range(channels)]
+    batches = [[[sensor(rng, 100) for _ in range(burst)] for _ in names] for _ in range(cycles)]
+    start   = time.perf_counter()
+    for batch in batches:
+        for name, samples in zip(names, batch):
+            bank.add(name, samples)
+        bank.evaluate()
+    return (time.perf_counter() - start) / cycles
+
+#######################################
+# main()
+#######################################
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy and cost of the sensor filters")
+    parser.add_argument("--cycles", type=int, default=2000, help="Sensor cycles for the accuracy run")
+    parser.add_argument("--burst", type=int, default=4, help="Samples per channel and cycle")
+    parser.add_argument("--channels", default="4,16,64,256,1024", help="Comma separated channel counts for the cost run")
+    args = parser.parse_args()
+
+    print("Accuracy, %d cycles, burst of %d, %s" % (args.cycles, args.burst, "NumPy" if filtering.loadNumpy() else "plain Python"))
+    rms, confidence = accuracy(args.cycles, args.burst, None)
+    for name, value in rms.items():
+        print("  %-12s RMS error %10.2f" % (name, value))
+    print("  1st percentile of the confidence %.2f" % confidence)
+
+    variants = [("plain Python", False)]
+    if filtering.loadNumpy():
+        variants.append(("NumPy", True))
+    print()
+    print("Cost per cycle in us, burst of %d" % args.burst)
+    print("%-10s" % "channels" + "".join("%16s" % name for name, _ in variants))
+    for channels in [int(c) for c in args.channels.split(",")]:
+        row = "%-10d" % channels
+        for _, useNumpy in variants:
+            row += "%16.1f" % (cost(channels, args.burst, useNumpy) * 1e6)
+        print(row)
+
+if __name__ == "__main__":
+    main()
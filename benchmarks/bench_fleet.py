@@ -0,0 +1,145 @@
+#############################################################################
+##                     Benchmark: fleet aggregator                         ##
+#############################################################################
+# Ingest throughput and query times of grass/fleet.py with hundreds of
+# simulated boxes, each publishing its readings one topic each:
+#   - ingest alone, messages straight into Fleet.ingest
+#   - query times over the ingested data
+#   - end to end through the local broker stand-in, the boxes publishing
+#     from a separate process as fast as the broker takes it
+#
+# Usage: python benchmarks/bench_fleet.py [--boxes N] [--hours H] [--cycles N]
+
+import os
+import sys
+import time
+import random
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "grass"))
+
+import fleet
+
+# Channels of a box with three buckets, relays as states
+CHANNELS = (["bucketmoists/%d" % idx for idx in range(3)] + ["buckettemps/%d" % idx for idx in range(3)]
+    + ["airtemp", "airhum", "watertemp", "brightness", "energy", "power"])
+STATES   = ["runlight", "runheater", "exhaust", "runfan", "runwater", "sensorstates/soil", "sensorstates/air"]
+
+#######################################
+# Messages of one sensor cycle of one box
+#######################################
+def cycle(box, step, rng):
+    messages = []
+    for channel in CHANNELS:
+        if channel == "energy":
+            value = 100 + step * 0.002 * (1 + box % 5)
+        elif channel == "airtemp":
+            value = 19 + box % 7 * 0.5 + rng.gauss(0, 0.3)
+        else:
+            value = rng.uniform(10, 60)
+        messages.append(("farm/box%03d/outputs/%s" % (box, channel), b"%.2f" % value))
+    for channel in STATES:
+        messages.append(("farm/box%03d/outputs/%s" % (box, channel), b"True" if rng.random() < 0.5 else b"False"))
+    messages.append(("farm/box%03d/outputs/params/airTempSet" % box, b"20.0"))
+    return messages
+
+def median(func, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[repeat // 2]
+
+#######################################
+# Child: boxes publishing through the broker
+#######################################
+def publish(host, port, boxes, cycles):
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, client_id="bench-boxes")
+    client.connect(host, port)
+    client.loop_start()
+    rng = random.Random(1)
+    for step in range(cycles):
+        for box in range(boxes):
+            for topic, payload in cycle(box, step, rng):
+                info = client.publish(topic, payload, qos=0)
+    info.wait_for_publish()
+    client.disconnect()
+    client.loop_stop()
+
+#######################################
+# main()
+#######################################
+def main():
+    parser = argparse.ArgumentParser(description="Ingest throughput and query times of the fleet aggregator")
+    parser.add_argument("--boxes", type=int, default=300, help="Simulated boxes")
+    parser.add_argument("--hours", type=float, default=6, help="Hours of one minute cycles ingested directly")
+    parser.add_argument("--cycles", type=int, default=5, help="Cycles of all boxes sent through the broker")
+    parser.add_argument("--publish", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.publish:
+        publish(args.publish[0], int(args.publish[1]), args.boxes, args.cycles)
+        return
+
+    # Ingest alone
+    rng     = random.Random(0)
+    steps   = int(args.hours * 60)
+    now     = time.time()
+    start   = now - steps * 60
+    batches = [(start + step * 60, [message for box in range(args.boxes) for message in cycle(box, step, rng)]) for step in range(steps)]
+    count   = sum(len(messages) for _, messages in batches)
+    aggregator = fleet.Fleet(clock=lambda: now)
+    ingest = aggregator.ingest
+    wall = time.perf_counter()
+    for timestamp, messages in batches:
+        for topic, payload in messages:
+            ingest(topic, payload, timestamp)
+    wall = time.perf_counter() - wall
+    stats = aggregator.stats()
+    print("%d boxes, %.0f h of one minute cycles: %d messages, %d samples kept" % (args.boxes, args.hours, count, stats["kept"]))
+    print("Ingest alone       %8.0f messages/s  %5.2f us/message" % (count / wall, wall / count * 1e6))
+    print("Memory             %8.1f MB in arrays, %.1f bytes/sample" % (stats["bytes"] / 1e6, stats["bytes"] / stats["kept"]))
+
+    # Queries
+    queries = [
+        ("10 warmest boxes, last hour mean",    lambda: aggregator.rank("airtemp", now - 3600, now + 1, "mean", top=10)),
+        ("highest max of all boxes, 6 h",       lambda: aggregator.rank("airtemp", now - 6 * 3600, now + 1, "max")),
+        ("energy per box per day, 7 days",      lambda: aggregator.daily("energy", 7, now)),
+        ("one box, 6 h in 5 min steps",         lambda: aggregator.range("farm/box000", "airtemp", now - 6 * 3600, now + 1, 300)),
+    ]
+    for name, query in queries:
+        print("Query %-34s %8.2f ms" % (name, median(query) * 1000))
+
+    # Through the broker
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fakebroker import FakeBroker
+    broker      = FakeBroker()
+    aggregator  = fleet.Fleet()
+    client      = fleet.subscribe(aggregator, broker.host, broker.port, ["farm/#"], "bench-fleet")
+    while not broker.connections or not broker.connections[0].subscriptions:
+        time.sleep(0.01)
+    expected    = args.boxes * args.cycles * len(cycle(0, 0, rng))
+    cpu         = time.process_time()
+    wall        = time.perf_counter()
+    boxes       = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--publish", broker.host, str(broker.port),
+        "--boxes", str(args.boxes), "--cycles", str(args.cycles)])
+    last, idle  = 0, time.perf_counter()
+    while aggregator.messages < expected and time.perf_counter() - idle < 5:
+        time.sleep(0.01)
+        if aggregator.messages != last:
+            last, idle = aggregator.messages, time.perf_counter()
+    wall        = time.perf_counter() - wall
+    cpu         = time.process_time() - cpu
+    boxes.wait()
+    client.loop_stop()
+    client.disconnect()
+    broker.stop()
+    print("Through the broker %8.0f messages/s, %d of %d received, %.1f us CPU/message in broker and aggregator" % (
+        aggregator.messages / wall, aggregator.messages, expected, cpu / max(aggregator.messages, 1) * 1e6))
+
+if __name__ == "__main__":
+    main()
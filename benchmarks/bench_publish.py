@@ -0,0 +1,106 @@
+#############################################################################
+##                     Benchmark: publishing per cycle                     ##
+#############################################################################
+# Measures how long publishing one sensor cycle takes against a local
+# stand-in broker with growing link latency, comparing the old blocking
+# wait_for_publish() after every message with the pipelined Publisher.
+#
+# Usage: python benchmarks/bench_publish.py [--cycles N]
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "grass"))
+
+import paho.mqtt.client as mqtt
+import mqttpublisher
+from fakebroker import FakeBroker
+
+# One sensor cycle as published by machineCode with three buckets
+CYCLE = [
+    "bucketmoists/0", "buckettemps/0",
+    "bucketmoists/1", "buckettemps/1",
+    "bucketmoists/2", "buckettemps/2",
+    "watertemp", "brightness", "runheater", "airhum", "airtemp",
+    "energy", "telemetry/soctemp", "runfan", "runlight",
+]
+TOPIC_QOS = {
+    "bucketmoists/" : 0,
+    "buckettemps/"  : 0,
+    "watertemp"     : 0,
+    "brightness"    : 0,
+    "airhum"        : 1,
+    "airtemp"       : 1,
+    "energy"        : 1,
+    "telemetry/"    : 0,
+    "snapshot"      : 1,
+}
+
+#######################################
+# Client connected to the broker
+#######################################
+def connect(broker):
+    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+    # Created before connecting, paho only accepts the inflight limit then
+    publisher = mqttpublisher.Publisher(client, "grass/outputs/", topicQos=TOPIC_QOS, flushTimeout=30)
+    client.connect(broker.host, broker.port)
+    client.loop_start()
+    deadline = time.monotonic() + 5
+    while not client.is_connected() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return client, publisher
+
+#######################################
+# The different strategies
+#######################################
+def blocking(client, publisher):
+    for subtopic in CYCLE:
+        info = client.publish("grass/outputs/" + subtopic, "21.5", qos=2)
+        info.wait_for_publish()
+
+def pipelined(client, publisher):
+    for subtopic in CYCLE:
+        publisher.queue(subtopic, "21.5", qos=2)
+    publisher.flush()
+
+def pipelinedQos(client, publisher):
+    for subtopic in CYCLE:
+        publisher.queue(subtopic, "21.5")
+    publisher.flush()
+
+STRATEGIES = [
+    ("blocking QoS 2",      blocking),
+    ("pipelined QoS 2",     pipelined),
+    ("pipelined per-topic", pipelinedQos),
+]
+
+#######################################
+# main()
+#######################################
+def main():
+    parser = argparse.ArgumentParser(description="Publishing cost per sensor cycle vs. broker latency")
+    parser.add_argument("--cycles", type=int, default=10, help="Cycles measured per data point")
+    parser.add_argument("--latencies", default="0,5,20,50,100", help="Comma separated broker latencies in ms")
+    args = parser.parse_args()
+
+    print("%d messages per cycle, mean cycle time in ms" % len(CYCLE))
+    print("%-12s" % "latency" + "".join("%22s" % name for name, _ in STRATEGIES))
+    for latencyMs in [float(l) for l in args.latencies.split(",")]:
+        broker      = FakeBroker(latency=latencyMs / 1000)
+        client, publisher = connect(broker)
+        row         = "%-12s" % ("%.0f ms" % latencyMs)
+        for _, strategy in STRATEGIES:
+            strategy(client, publisher)     # Warm up
+            start = time.perf_counter()
+            for _ in range(args.cycles):
+                strategy(client, publisher)
+            row += "%22.1f" % ((time.perf_counter() - start) / args.cycles * 1000)
+        print(row)
+        client.loop_stop()
+        client.disconnect()
+        broker.stop()
+
+if __name__ == "__main__":
+    main()
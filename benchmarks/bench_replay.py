@@ -0,0 +1,58 @@
+#############################################################################
+##                     Benchmark: replay / backtesting                     ##
+#############################################################################
+# Records a trace with the simulated box, then replays it: events per second
+# of a single replay, and a parameter grid run in one process and spread
+# over all cores. The replay with the recorded parameters has to switch the
+# heater exactly as often as the simulation did.
+#
+# Usage: python benchmarks/bench_replay.py [--days N] [--processes N]
+
+import os
+import sys
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "grass"))
+
+import replay
+import simulation
+
+#######################################
+# main()
+#######################################
+def main():
+    parser = argparse.ArgumentParser(description="Speed of the replay engine and of parameter sweeps")
+    parser.add_argument("--days", type=float, default=7, help="Simulated days recorded")
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes, all cores by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    recorded = simulation.simulate(args.days)
+    trace = replay.loadHistory(recorded["history"].path)
+    params = replay.defaults()
+    print("Trace of %.1f days, %d events" % (args.days, len(trace.events)))
+
+    start = time.perf_counter()
+    result = replay.Replay(trace, params).run()
+    single = time.perf_counter() - start
+    print("Single replay %.3f s, %.0f events/s, %.0fx real time" % (
+        single, len(trace.events) / single, result["duration"] / single))
+    print("Heater switched %d times replayed, %d times simulated" % (
+        result["switches"]["heater"], recorded["switches"]["heater"]))
+
+    grid = {
+        "airTempSet"    : replay.parseValues("18:22:0.5"),
+        "airTempHyst"   : [0.2, 0.5, 1.0],
+        "airCircTime"   : [15, 30],
+    }
+    processes = args.processes or os.cpu_count() or 1
+    for name, count in [("one process", 1), ("%d processes" % processes, processes)]:
+        start = time.perf_counter()
+        results = replay.sweep(trace, grid, params, processes=count)
+        wall = time.perf_counter() - start
+        print("Grid of %d in %-14s %6.2f s, %.1f replays/s" % (len(results), name, wall, len(results) / wall))
+
+if __name__ == "__main__":
+    main()
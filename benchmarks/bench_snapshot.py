@@ -0,0 +1,96 @@
+#############################################################################
+##                  Benchmark: per-topic vs. snapshot                      ##
+#############################################################################
+# Compares the wire formats of one sensor cycle: a topic per reading as
+# before, one JSON snapshot, and one packed binary snapshot. Reports bytes
+# the broker received (MQTT headers and QoS handshakes included), broker
+# CPU time and client time per cycle.
+#
+# Usage: python benchmarks/bench_snapshot.py [--cycles N]
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "grass"))
+
+import snapshot
+from fakebroker import FakeBroker
+from bench_publish import CYCLE, connect
+
+#######################################
+# A plausible cycle of readings
+#######################################
+def makeFrame(random, timestamp):
+    frame = snapshot.Frame(timestamp, 3)
+    for idx in range(3):
+        frame.set("bucketmoists/" + str(idx), round(random.uniform(40, 120), 1))
+        frame.set("buckettemps/" + str(idx), random.uniform(17, 24))
+    frame.set("watertemp", random.uniform(16, 20))
+    frame.set("brightness", random.uniform(0, 30000))
+    frame.set("airtemp", random.uniform(18, 26))
+    frame.set("airhum", random.uniform(40, 90))
+    frame.set("energy", 123.456 + timestamp / 1e6)
+    frame.set("telemetry/soctemp", random.uniform(40, 60), stale=True)
+    frame.relays = {"light": True, "heater": False, "exhaust": False, "circ": True, "water": False}
+    return frame
+
+#######################################
+# The different formats
+#######################################
+def topics(publisher, frame):
+    # As machineCode does with publishTopics, values as strings
+    for subtopic in CYCLE:
+        value = frame.values.get(subtopic)
+        publisher.queue(subtopic, str(value if value is not None else True))
+    publisher.flush()
+
+def jsonSnapshot(publisher, frame):
+    publisher.queue("snapshot", frame.toJson())
+    publisher.flush()
+
+def binarySnapshot(publisher, frame):
+    publisher.queue("snapshot/bin", frame.toBinary())
+    publisher.flush()
+
+FORMATS = [
+    ("per-topic",       topics),
+    ("json snapshot",   jsonSnapshot),
+    ("binary snapshot", binarySnapshot),
+]
+
+#######################################
+# main()
+#######################################
+def main():
+    parser = argparse.ArgumentParser(description="Bytes on the wire and broker CPU per sensor cycle and wire format")
+    parser.add_argument("--cycles", type=int, default=500, help="Cycles per format")
+    args = parser.parse_args()
+
+    broker = FakeBroker()
+    client, publisher = connect(broker)
+    rng = random.Random(0)
+
+    print("%-18s%10s%12s%16s%16s" % ("format", "messages", "bytes in", "broker CPU us", "client us"))
+    for name, publish in FORMATS:
+        frames = [makeFrame(rng, 1.7e9 + i * 60) for i in range(args.cycles)]
+        publish(publisher, frames[0])   # Warm up
+        broker.resetCounters()
+        start = time.perf_counter()
+        for frame in frames:
+            publish(publisher, frame)
+        elapsed = time.perf_counter() - start
+        print("%-18s%10.1f%12.0f%16.1f%16.1f" % (
+            name,
+            broker.published / args.cycles,
+            broker.bytesIn / args.cycles,
+            broker.cpuTime / args.cycles * 1e6,
+            elapsed / args.cycles * 1e6))
+    client.loop_stop()
+    client.disconnect()
+    broker.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#############################################################################
+##                     Benchmark: startup time                             ##
+#############################################################################
+# Starts Grass in a fresh interpreter on the simulated box, with sensor
+# probes taking as long as the real drivers (a Seesaw resets for 500 ms),
+# and measures from starting the process to the first control decision and
+# to all sensors being found. Scenarios: probes in parallel, probes one after
+# the other (like before the staged startup) and the broker not answering.
+#
+# Usage: python benchmarks/bench_startup.py [--runs N]
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+GRASS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "grass")
+
+# Probe times of the real drivers in seconds
+PROBE_DELAYS = {
+    "soil"      : 0.5,      # Seesaw software reset
+    "air"       : 0.04,     # AHT20 calibration
+    "light"     : 0.01,
+    "onewire"   : 0.005,
+}
+
+#######################################
+# Child: Grass itself, reports when it got where
+#######################################
+def child(host, port, threads):
+    started = time.perf_counter()
+    sys.path.insert(0, GRASS)
+    import grass
+    import simulation
+    import mqttsecrets
+    imported = time.perf_counter() - started
+
+    class SlowProbeBackend(simulation.SimBackend):
+        def __init__(self):
+            super().__init__(grass.relayNames, buckets=len(grass.SOIL_MOIST_ADR))
+
+        def time(self):
+            return time.time()
+
+        def soilSensor(self, box, address):
+            time.sleep(PROBE_DELAYS["soil"])
+            return super().soilSensor(box, address)
+
+        def airSensor(self, box):
+            time.sleep(PROBE_DELAYS["air"])
+            return super().airSensor(box)
+
+        def lightSensor(self, box):
+            time.sleep(PROBE_DELAYS["light"])
+            return super().lightSensor(box)
+
+        def findOneWire(self, serial=None):
+            time.sleep(PROBE_DELAYS["onewire"])
+            return super().findOneWire(serial)
+
+    workDir = tempfile.mkdtemp(prefix="grass-bench-")
+    mqttsecrets.Broker      = host
+    mqttsecrets.Port        = port
+    grass.hwBackend         = SlowProbeBackend
+    grass.metricsPort       = None
+    grass.sensorProbeThreads= threads
+    grass.logPath           = os.path.join(workDir, "GrassLog.txt")
+    grass.energyPath        = os.path.join(workDir, "GrassEnergyUsed.txt")
+    grass.spoolPath         = os.path.join(workDir, "spool")
+    grass.historyPath       = os.path.join(workDir, "history")
+    grass.parameterPath     = os.path.join(workDir, "GrassParameters.json")
+    grass.haCachePath       = os.path.join(workDir, "GrassDiscovery.json")
+    grass.logLevel          = "ERROR"
+
+    def watch():
+        while grass.startup is None or "control" not in grass.startup.durations:
+            time.sleep(0.001)
+        decided = time.time()
+        while not all(tent.probed for tent in grass.controllers):
+            time.sleep(0.001)
+        print(json.dumps({
+            "imported"  : imported,
+            "decided"   : decided,
+            "found"     : time.time(),
+            "phases"    : grass.startup.durations,
+        }), flush=True)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+    grass.main()
+
+#######################################
+# Parent: one run, seconds from spawning the process
+#######################################
+def run(host, port, threads):
+    spawned = time.time()
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", host, str(port), str(threads)],
+        capture_output=True, text=True, timeout=60).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    return result["imported"], result["decided"] - spawned, result["found"] - spawned, result["phases"]
+
+#######################################
+# main()
+#######################################
+def main():
+    parser = argparse.ArgumentParser(description="Time from process start to the first control decision")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per scenario, the median is shown")
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], int(args.child[1]), int(args.child[2]))
+        return
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fakebroker import FakeBroker
+    broker = FakeBroker()
+    # A port nobody listens on
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+    deadPort = closed.getsockname()[1]
+    closed.close()
+
+    scenarios = [
+        ("parallel probes",         broker.port,    8),
+        ("serial probes",           broker.port,    1),
+        ("parallel, broker down",   deadPort,       8),
+    ]
+    print("Median of %d runs, ms from spawning the process" % args.runs)
+    print("%-24s%10s%16s%16s  %s" % ("scenario", "import", "first decision", "sensors found", "phases of the median run"))
+    for name, port, threads in scenarios:
+        results = sorted((run(broker.host, port, threads) for _ in range(args.runs)), key=lambda result: result[1])
+        imported, decided, found, phases = results[len(results) // 2]
+        print("%-24s%10.0f%16.0f%16.0f  %s" % (name, imported * 1000, decided * 1000, found * 1000,
+            ", ".join("%s %.0f" % (phase, seconds * 1000) for phase, seconds in phases.items())))
+    broker.stop()
+
+if __name__ == "__main__":
+    main()
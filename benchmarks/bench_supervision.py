@@ -0,0 +1,118 @@
+#############################################################################
+##                     Benchmark: loop supervision                         ##
+#############################################################################
+# Wedges one task of a running scheduler for a while, the way a hanging I2C
+# read would, with a stand-in for systemd listening on NOTIFY_SOCKET. Shows
+# how long it takes to notice the stall, to reach the safe state and to see
+# the loop recover, the longest gap between watchdog pings, and what a
+# supervision check costs.
+#
+# Usage: python benchmarks/bench_supervision.py [--wedge S] [--stall-after S] [--safe-after S]
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "grass"))
+
+import scheduler
+import supervision
+
+#######################################
+# Stand-in for systemd, timestamps of the notifications
+#######################################
+class NotifyListener:
+    def __init__(self):
+        self.path       = os.path.join(tempfile.mkdtemp(prefix="grass-notify-"), "notify")
+        self.socket     = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        self.received   = []    # (monotonic, message)
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def listen(self):
+        while True:
+            message = self.socket.recv(4096).decode("utf-8")
+            self.received.append((time.monotonic(), message))
+
+    def pings(self):
+        return [timestamp for timestamp, message in self.received if "WATCHDOG=1" in message.split("\n")]
+
+#######################################
+# main()
+#######################################
+def main():
+    parser = argparse.ArgumentParser(description="Stall detection, safe state and watchdog pings of the loop supervision")
+    parser.add_argument("--wedge", type=float, default=3.0, help="Seconds the wedged task hangs")
+    parser.add_argument("--stall-after", type=float, default=0.5, help="Seconds late until the loop counts as stalled")
+    parser.add_argument("--safe-after", type=float, default=1.0, help="Seconds late until the safe state")
+    parser.add_argument("--watchdog", type=float, default=2.0, help="WatchdogSec of the stand-in systemd")
+    args = parser.parse_args()
+
+    listener = NotifyListener()
+    os.environ["WATCHDOG_USEC"] = str(int(args.watchdog * 1e6))
+    os.environ["WATCHDOG_PID"]  = str(os.getpid())
+
+    events  = []    # (monotonic, event)
+    wedged  = {}
+    loop    = scheduler.Scheduler()
+
+    def sensors(now):
+        pass
+
+    def wedge(now):
+        wedged["start"] = time.monotonic()
+        time.sleep(args.wedge)
+        wedged["end"] = time.monotonic()
+
+    loop.add("sensors", sensors, interval=0.1)
+    loop.add("control", lambda now: 0.05)
+    supervisor = supervision.Supervisor(
+        loop,
+        stallAfter  = args.stall_after,
+        safeAfter   = args.safe_after,
+        safeState   = lambda: events.append((time.monotonic(), "outputs safe")),
+        recover     = lambda: events.append((time.monotonic(), "outputs released")),
+        onEvent     = lambda name, details: events.append((time.monotonic(), name)),
+        notifier    = supervision.Notifier(listener.path))
+    supervisor.start()
+    threading.Thread(target=loop.runForever, daemon=True).start()
+
+    # Healthy for a second, then the wedge, then a second to recover
+    time.sleep(1.0)
+    loop.add("wedge", wedge)
+    time.sleep(args.wedge + 1.0)
+    supervisor.stop()
+
+    print("Wedged for %.1f s, stallAfter %.1f s, safeAfter %.1f s, watchdog %.1f s, checks every %.2f s" % (
+        args.wedge, args.stall_after, args.safe_after, args.watchdog, supervisor.interval))
+    for timestamp, name in events:
+        if timestamp < wedged["end"]:
+            print("  %-18s %6.2f s after the wedge" % (name, timestamp - wedged["start"]))
+        else:
+            print("  %-18s %6.2f s after the loop ran again" % (name, timestamp - wedged["end"]))
+    pings   = listener.pings()
+    gaps    = [later - earlier for earlier, later in zip(pings, pings[1:])]
+    print("Watchdog pings %d, usual gap %.2f s, longest gap %.2f s (systemd restarts after %.1f s)" % (
+        len(pings), sorted(gaps)[len(gaps) // 2], max(gaps), args.watchdog))
+    stats = supervisor.stats
+    print("Stats: %d stalls, %d safe states, longest stall %.2f s, worst lateness %.2f s in %s" % (
+        stats.stalls, stats.safeStates, stats.longestStall, stats.maxLateness, stats.slowestTask))
+
+    # Cost of one check with a realistic number of tasks
+    idle = scheduler.Scheduler()
+    for idx in range(24):
+        idle.add("task%d" % idx, lambda now: None, interval=60)
+    idle.runPending()
+    checker = supervision.Supervisor(idle, stallAfter=args.stall_after, notifier=supervision.Notifier(listener.path))
+    count   = 20000
+    start   = time.perf_counter()
+    for _ in range(count):
+        checker.check()
+    print("One check with 24 tasks and a ping %.1f us" % ((time.perf_counter() - start) / count * 1e6))
+
+if __name__ == "__main__":
+    main()
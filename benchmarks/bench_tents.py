@@ -0,0 +1,77 @@
+#############################################################################
+##                     Benchmark: tents per process                        ##
+#############################################################################
+# Runs the simulation with 1, 2, 4, ... tents driven by one process and
+# reports CPU time per tent and the Python heap every further tent adds,
+# both should stay flat as tents are added. Every tent count runs in a
+# fresh interpreter, the grass module keeps its state between runs.
+#
+# Usage: python benchmarks/bench_tents.py [--days N] [--tents 1,2,4,8]
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "grass"))
+
+#######################################
+# A single run, printed as JSON for the parent
+#######################################
+def run(days, tents):
+    import simulation
+
+    logging.basicConfig(level=logging.ERROR)
+    tracemalloc.start()
+    cpu     = time.process_time()
+    result  = simulation.simulate(days, tents=tents)
+    cpu     = time.process_time() - cpu
+    heap, peak = tracemalloc.get_traced_memory()
+    print(json.dumps({
+        "cpu"       : cpu,
+        "heap"      : heap,
+        "peak"      : peak,
+        "cycles"    : result["cycles"],
+        "outOfBand" : [box["outOfBand"] for box in result["tents"]],
+    }))
+
+#######################################
+# main()
+#######################################
+def main():
+    parser = argparse.ArgumentParser(description="CPU and memory per tent with several tents in one process")
+    parser.add_argument("--days", type=float, default=1, help="Simulated days per run")
+    parser.add_argument("--tents", default="1,2,4,8", help="Comma separated tent counts")
+    parser.add_argument("--one", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one is not None:
+        run(args.days, args.one)
+        return
+
+    print("%.1f simulated days per run, tracemalloc on (slows everything down alike)" % args.days)
+    print("%-8s%12s%16s%14s%18s%14s" % ("tents", "cpu s", "cpu ms/tent/day", "heap kB", "kB per more tent", "worst band"))
+    first = None
+    for tents in [int(count) for count in args.tents.split(",")]:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--days", str(args.days), "--one", str(tents)],
+            capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        # Heap of the modules themselves is in every run, compare against the smallest
+        if first is None:
+            first = (tents, result["heap"])
+        extra = (result["heap"] - first[1]) / (tents - first[0]) / 1024 if tents > first[0] else float("nan")
+        print("%-8d%12.2f%16.1f%14.0f%18.0f%13.1f%%" % (
+            tents,
+            result["cpu"],
+            result["cpu"] / tents / args.days * 1000,
+            result["heap"] / 1024,
+            extra,
+            max(result["outOfBand"]) * 100))
+
+if __name__ == "__main__":
+    main()
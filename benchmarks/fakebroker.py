@@ -0,0 +1,242 @@
+#############################################################################
+##                          Local stand-in broker                          ##
+#############################################################################
+# Minimal MQTT 3.1.1 broker used by the benchmarks. It understands just
+# enough of the protocol for paho (CONNECT, PUBLISH QoS 0/1/2, SUBSCRIBE,
+# PINGREQ, DISCONNECT) and can delay every packet it sends back by a fixed
+# amount to emulate a slow link between the Pi and the real broker.
+
+import socket
+import struct
+import threading
+import time
+import heapq
+
+#######################################
+# Packet types
+#######################################
+CONNECT     = 1
+CONNACK     = 2
+PUBLISH     = 3
+PUBACK      = 4
+PUBREC      = 5
+PUBREL      = 6
+PUBCOMP     = 7
+SUBSCRIBE   = 8
+SUBACK      = 9
+PINGREQ     = 12
+PINGRESP    = 13
+DISCONNECT  = 14
+
+#######################################
+# Helpers
+#######################################
+def encodeLength(length):
+    out = bytearray()
+    while True:
+        byte = length % 128
+        length = length // 128
+        if length > 0:
+            byte |= 0x80
+        out.append(byte)
+        if length == 0:
+            return bytes(out)
+
+def packet(packetType, flags, body):
+    return bytes([(packetType << 4) | flags]) + encodeLength(len(body)) + body
+
+def topicMatches(pattern, topic):
+    patternParts    = pattern.split("/")
+    topicParts      = topic.split("/")
+    for idx, part in enumerate(patternParts):
+        if part == "#":
+            return True
+        if idx >= len(topicParts):
+            return False
+        if part != "+" and part != topicParts[idx]:
+            return False
+    return len(patternParts) == len(topicParts)
+
+def recvExact(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Client went away")
+        data += chunk
+    return bytes(data)
+
+#######################################
+# Single client connection
+#######################################
+class Connection:
+    def __init__(self, broker, sock):
+        self.broker         = broker
+        self.sock           = sock
+        self.subscriptions  = []
+        self.outbox         = []    # Heap of (sendAt, seq, bytes)
+        self.seq            = 0
+        self.condition      = threading.Condition()
+        self.alive          = True
+        threading.Thread(target=self.reader, daemon=True).start()
+        threading.Thread(target=self.writer, daemon=True).start()
+
+    def send(self, data, delayed=True):
+        with self.condition:
+            sendAt = time.monotonic() + (self.broker.latency if delayed else 0)
+            self.seq += 1
+            heapq.heappush(self.outbox, (sendAt, self.seq, data))
+            self.condition.notify()
+
+    def writer(self):
+        while self.alive:
+            with self.condition:
+                while self.alive and not self.outbox:
+                    self.condition.wait(0.5)
+                if not self.alive:
+                    return
+                sendAt = self.outbox[0][0]
+                delay = sendAt - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                _, _, data = heapq.heappop(self.outbox)
+            try:
+                self.sock.sendall(data)
+                self.broker.bytesOut += len(data)
+            except OSError:
+                self.close()
+
+    def reader(self):
+        try:
+            while self.alive:
+                header = recvExact(self.sock, 1)[0]
+                length = 0
+                multiplier = 1
+                while True:
+                    byte = recvExact(self.sock, 1)[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = recvExact(self.sock, length)
+                self.broker.bytesIn += 1 + len(encodeLength(length)) + length
+                # CPU spent on every packet, acks and handshakes included
+                start = time.thread_time()
+                self.handle(header >> 4, header & 0x0F, body)
+                self.broker.cpuTime += time.thread_time() - start
+        except (OSError, ConnectionError):
+            pass
+        self.close()
+
+    def handle(self, packetType, flags, body):
+        if packetType == CONNECT:
+            self.send(packet(CONNACK, 0, b"\x00\x00"))
+        elif packetType == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topicLength = struct.unpack("!H", body[:2])[0]
+            topic = body[2:2 + topicLength].decode("utf-8")
+            offset = 2 + topicLength
+            if qos > 0:
+                mid = body[offset:offset + 2]
+                offset += 2
+            self.broker.deliver(topic, body[offset:], flags & 0x01)
+            if qos == 1:
+                self.send(packet(PUBACK, 0, mid))
+            elif qos == 2:
+                self.send(packet(PUBREC, 0, mid))
+        elif packetType == PUBREL:
+            self.send(packet(PUBCOMP, 0, body[:2]))
+        elif packetType == SUBSCRIBE:
+            mid = body[:2]
+            offset = 2
+            granted = bytearray()
+            while offset < len(body):
+                topicLength = struct.unpack("!H", body[offset:offset + 2])[0]
+                pattern = body[offset + 2:offset + 2 + topicLength].decode("utf-8")
+                offset += 3 + topicLength
+                self.subscriptions.append(pattern)
+                granted.append(0)
+            self.send(packet(SUBACK, 0, mid + bytes(granted)))
+            for topic, payload in list(self.broker.retained.items()):
+                if any(topicMatches(p, topic) for p in self.subscriptions):
+                    self.forward(topic, payload, retain=True)
+        elif packetType == PINGREQ:
+            self.send(packet(PINGRESP, 0, b""))
+        elif packetType == DISCONNECT:
+            self.close()
+
+    def forward(self, topic, payload, retain=False):
+        # Subscribers always get QoS 0, good enough for benchmarking
+        encoded = topic.encode("utf-8")
+        body = struct.pack("!H", len(encoded)) + encoded + payload
+        self.send(packet(PUBLISH, 1 if retain else 0, body))
+
+    def close(self):
+        if not self.alive:
+            return
+        self.alive = False
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.broker.remove(self)
+
+#######################################
+# Broker
+#######################################
+class FakeBroker:
+    def __init__(self, latency=0.0, host="127.0.0.1", port=0):
+        self.latency        = latency   # Seconds every outgoing packet is held back
+        self.connections    = []
+        self.retained       = {}
+        self.lock           = threading.Lock()
+        self.bytesIn        = 0
+        self.bytesOut       = 0
+        self.published      = 0
+        self.cpuTime        = 0.0
+        self.server         = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(512)
+        self.host, self.port = self.server.getsockname()
+        self.running        = True
+        threading.Thread(target=self.acceptLoop, daemon=True).start()
+
+    def acceptLoop(self):
+        while self.running:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.connections.append(Connection(self, sock))
+
+    def deliver(self, topic, payload, retain):
+        self.published += 1
+        if retain:
+            self.retained[topic] = payload
+        with self.lock:
+            targets = [c for c in self.connections if any(topicMatches(p, topic) for p in c.subscriptions)]
+        for connection in targets:
+            connection.forward(topic, payload)
+
+    def remove(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    def resetCounters(self):
+        self.bytesIn    = 0
+        self.bytesOut   = 0
+        self.published  = 0
+        self.cpuTime    = 0.0
+
+    def stop(self):
+        self.running = False
+        self.server.close()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.close()
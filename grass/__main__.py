@@ -1,6 +1,27 @@
-"""Makes module executable by `python -m splive`."""
+"""Makes module executable by `python -m grass`, installed as `grass`.
+
+`grass` runs the controller, `grass fleet ...` the fleet view of many boxes.
+"""
+
+import argparse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="grass", description="Plant growth controller for PiPLC")
+    commands = parser.add_subparsers(dest="command")
+    # Options of the subcommands are parsed by their own main()
+    commands.add_parser("fleet", add_help=False, help="Collect the outputs of many boxes and answer queries over them")
+    args, rest = parser.parse_known_args(argv)
+
+    if args.command == "fleet":
+        from grass.fleet import main as fleetMain
+        fleetMain(rest, prog="grass fleet")
+        return
+    if rest:
+        parser.error("unrecognized arguments: " + " ".join(rest))
+    from grass.grass import main as controllerMain
+    controllerMain()
 
-from grass.grass import main
 
 if __name__ == "__main__":
     main()
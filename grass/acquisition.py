@@ -0,0 +1,217 @@
+#############################################################################
+##                          Sensor acquisition                             ##
+#############################################################################
+# Reads independent buses (I2C, 1-Wire, sysfs) concurrently. Every bus gets
+# its own worker thread so reads on one bus stay in order, while a slow
+# DS18B20 conversion or a hung I2C device can't delay the others. Each
+# sensor has its own deadline, counted from when its bus worker starts the
+# read, and all reads queued on a bus together get no more than the sum of
+# their deadlines. When a deadline is missed the last good value is returned
+# and marked stale, up to maxAge seconds after it was read. Missed deadlines
+# are counted per sensor, so discovery can drop one that never answers.
+# Waiting for the reads can be interrupted, e.g. to act on an MQTT command
+# without waiting for a slow sensor.
+
+import time
+import queue
+import logging
+import threading
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Result of a single sensor read
+#######################################
+class Reading:
+    __slots__ = ("value", "timestamp", "stale")
+
+    def __init__(self, value=None, timestamp=0.0, stale=True):
+        self.value      = value         # Last good value, None if never read
+        self.timestamp  = timestamp     # time.time() of the last good read
+        self.stale      = stale         # True if value isn't from this sample
+
+#######################################
+# One worker thread per bus
+#######################################
+class BusWorker:
+    def __init__(self, name):
+        self.name   = name
+        self.jobs   = queue.Queue()
+        # Daemon so a device that never answers can't keep us from exiting
+        threading.Thread(target=self.run, name="bus-" + name, daemon=True).start()
+
+    def submit(self, read):
+        future = concurrent.futures.Future()
+        self.jobs.put((read, future))
+        return future
+
+    def run(self):
+        while True:
+            read, future = self.jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(read())
+            except BaseException as e:
+                future.set_exception(e)
+
+#######################################
+# Sensor registered with the engine
+#######################################
+class Channel:
+    __slots__ = ("name", "bus", "read", "timeout", "last", "future", "started", "misses")
+
+    def __init__(self, name, bus, read, timeout):
+        self.name       = name
+        self.bus        = bus
+        self.read       = read
+        self.timeout    = timeout
+        self.last       = Reading()
+        self.future     = None      # Read still running from an earlier sample
+        self.started    = None      # Monotonic time the bus worker started the read
+        self.misses     = 0         # Deadlines missed since takeMisses()
+
+class Acquisition:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, maxAge=None):
+        self.maxAge     = maxAge    # Seconds a last good value stands in for a missed read, None for ever
+        self.buses      = {}
+        self.channels   = {}
+        self.lock       = threading.Lock()
+        self.event      = threading.Event()     # Set by finished reads and interrupt()
+        self.interrupted= False
+
+    #######################################
+    # Add a sensor
+    #######################################
+    def register(self, name, bus, read, timeout):
+        self.worker(bus)
+        self.channels[name] = Channel(name, bus, read, timeout)
+
+    def worker(self, bus):
+        # Anything else touching a bus (probes) goes through its worker too
+        if bus not in self.buses:
+            self.buses[bus] = BusWorker(bus)
+        return self.buses[bus]
+
+    def unregister(self, name):
+        self.channels.pop(name, None)
+
+    #######################################
+    # Deadlines a sensor missed since the last call, a read that never
+    # returns counts again on every sample it's still running
+    #######################################
+    def takeMisses(self, name):
+        channel = self.channels.get(name)
+        if channel is None:
+            return 0
+        with self.lock:
+            misses, channel.misses = channel.misses, 0
+        return misses
+
+    #######################################
+    # Runs on the bus worker, the read's deadline starts now
+    #######################################
+    def run(self, channel):
+        channel.started = time.monotonic()
+        return channel.read()
+
+    def deadline(self, channel, start, budgets):
+        limit = start + budgets[channel.bus]
+        started = channel.started
+        return limit if started is None else min(started + channel.timeout, limit)
+
+    #######################################
+    # Store a finished read, also called for reads finishing late
+    #######################################
+    def complete(self, channel, future):
+        self.event.set()
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self.lock:
+            channel.last = Reading(future.result(), time.time(), False)
+
+    #######################################
+    # Make a running sample() call onInterrupt, safe to call from any thread
+    #######################################
+    def interrupt(self):
+        self.interrupted = True
+        self.event.set()
+
+    #######################################
+    # Read all sensors, or only those in names, bounded by the busiest bus's budget.
+    # onInterrupt is called from the waiting thread whenever interrupt() was called.
+    #######################################
+    def sample(self, onInterrupt=None, names=None):
+        start       = time.monotonic()
+        busyBuses   = set()
+        submitted   = []
+        if names is None:
+            channels = list(self.channels.values())
+        else:
+            channels = [self.channels[name] for name in names if name in self.channels]
+
+        # A bus that still works on a read from an earlier sample is hung,
+        # anything queued behind it would only time out as well
+        for channel in self.channels.values():
+            if channel.future is not None and not channel.future.done():
+                if channel.bus not in busyBuses:
+                    logger.error("Bus " + channel.bus + " still busy, using last values!")
+                busyBuses.add(channel.bus)
+                # Only the read that hangs, not those queued behind it
+                if channel.started is not None:
+                    with self.lock:
+                        channel.misses += 1
+
+        # Reads on a bus run one after the other, the bus gets their deadlines added up
+        budgets = {}
+        for channel in channels:
+            if channel.bus in busyBuses:
+                continue
+            channel.started = None
+            channel.future  = self.buses[channel.bus].submit(lambda c=channel: self.run(c))
+            channel.future.add_done_callback(lambda f, c=channel: self.complete(c, f))
+            budgets[channel.bus] = budgets.get(channel.bus, 0) + channel.timeout
+            submitted.append(channel)
+
+        snapshot = {}
+        waiting  = submitted
+        while waiting:
+            deadline = min(self.deadline(channel, start, budgets) for channel in waiting)
+            self.event.wait(max(deadline - time.monotonic(), 0))
+            # Cleared before looking, a read finishing right after sets it again
+            self.event.clear()
+            if self.interrupted:
+                self.interrupted = False
+                if onInterrupt is not None:
+                    onInterrupt()
+
+            now         = time.monotonic()
+            remaining   = []
+            for channel in waiting:
+                if channel.future.done():
+                    try:
+                        snapshot[channel.name] = Reading(channel.future.result(), time.time(), False)
+                    except Exception as e:
+                        logger.error("Reading " + channel.name + " didn't work! (" + repr(e) + ")")
+                elif now >= self.deadline(channel, start, budgets):
+                    logger.error("Reading " + channel.name + " timed out!")
+                    if channel.started is not None:
+                        with self.lock:
+                            channel.misses += 1
+                else:
+                    remaining.append(channel)
+            waiting = remaining
+
+        # Everything not read in time falls back to the last good value, if it isn't too old
+        oldest = None if self.maxAge is None else time.time() - self.maxAge
+        with self.lock:
+            for channel in channels:
+                if channel.name not in snapshot:
+                    last = channel.last
+                    value = last.value if oldest is None or last.timestamp >= oldest else None
+                    snapshot[channel.name] = Reading(value, last.timestamp, True)
+        return snapshot
@@ -0,0 +1,212 @@
+#############################################################################
+##                          Actuator timing                                ##
+#############################################################################
+# Timed actuation without blocking the control loop. Pulses, minimum off
+# times and periodic on/off windows are kept as scheduled transitions and
+# executed by a timer thread at their deadline, so a watering pulse ends on
+# time no matter what the control loop is doing in the meantime.
+
+import time
+import heapq
+import logging
+import threading
+import collections
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Output controlled by the timer
+#######################################
+class TimedOutput:
+    __slots__ = ("name", "apply", "minOff", "state", "blockedUntil", "period", "duration")
+
+    def __init__(self, name, apply, minOff=0, period=None, duration=None):
+        self.name           = name
+        self.apply          = apply     # Called with True/False to switch the hardware
+        self.minOff         = minOff    # Seconds the output has to stay off after a pulse
+        self.state          = False
+        self.blockedUntil   = 0         # No new pulse before this timestamp
+        self.period         = period    # Windows only: seconds off between windows
+        self.duration       = duration  # Windows only: seconds on per window
+
+class ActuatorTimer:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, clock=time.time):
+        self.clock      = clock
+        self.outputs    = {}
+        self.events     = []    # Heap of (timestamp, seq, name, state)
+        self.seq        = 0
+        self.changes    = collections.deque()   # (name, state) for the control loop to report
+        self.condition  = threading.Condition()
+        self.thread     = None
+        self.held       = False # Nothing switches on while held, see hold()
+        self.heldOff    = []    # Outputs hold() marked off, switched off properly on release()
+        self.configured = {}    # Timing set by configure() before the output was added
+
+    #######################################
+    # Outputs
+    #######################################
+    def addOutput(self, name, apply, minOff=0):
+        self.outputs[name] = TimedOutput(name, apply, minOff)
+        self.configure(name, **self.configured.pop(name, {}))
+
+    def addWindow(self, name, apply, period, duration, start=None):
+        # On for duration, then off for period, repeating. First window at start.
+        self.outputs[name] = TimedOutput(name, apply, period=period, duration=duration)
+        self.configure(name, **self.configured.pop(name, {}))
+        self.schedule(self.clock() if start is None else start, name, True)
+
+    def configure(self, name, minOff=None, period=None, duration=None):
+        # New timing, used from the next transition on, or once the output is added
+        with self.condition:
+            output = self.outputs.get(name)
+            if output is None:
+                pending = self.configured.setdefault(name, {})
+                for key, value in (("minOff", minOff), ("period", period), ("duration", duration)):
+                    if value is not None:
+                        pending[key] = value
+                return
+            if minOff is not None:
+                output.minOff = minOff
+            if period is not None:
+                output.period = period
+            if duration is not None:
+                output.duration = duration
+
+    def isOn(self, name):
+        return self.outputs[name].state
+
+    #######################################
+    # Switch on for duration seconds, honouring the minimum off time
+    #######################################
+    def pulse(self, name, duration):
+        output = self.outputs[name]
+        now = self.clock()
+        with self.condition:
+            if self.held or output.state or now < output.blockedUntil:
+                return False
+            self.switch(output, True)
+            self.schedule(now + duration, name, False)
+        return True
+
+    #######################################
+    # Internals
+    #######################################
+    def schedule(self, timestamp, name, state):
+        with self.condition:
+            self.seq += 1
+            heapq.heappush(self.events, (timestamp, self.seq, name, state))
+            self.condition.notify()
+
+    def switch(self, output, state):
+        output.apply(state)
+        output.state = state
+        self.changes.append((output.name, state))
+        if not state:
+            output.blockedUntil = self.clock() + output.minOff
+
+    #######################################
+    # Execute all transitions that are due
+    #######################################
+    def runDue(self, now=None):
+        if now is None:
+            now = self.clock()
+        with self.condition:
+            while self.events and self.events[0][0] <= now:
+                timestamp, _, name, state = heapq.heappop(self.events)
+                output = self.outputs.get(name)
+                if output is None:
+                    continue
+                if state != output.state and not (state and self.held):
+                    self.switch(output, state)
+                # Windows schedule their own next transition
+                if output.period is not None:
+                    if state:
+                        self.schedule(timestamp + output.duration, name, False)
+                    else:
+                        self.schedule(timestamp + output.period, name, True)
+
+    #######################################
+    # Next transition, None if nothing is scheduled. With prefix only of the
+    # outputs whose names start with it.
+    #######################################
+    def nextDeadline(self, prefix=None):
+        with self.condition:
+            if prefix is None:
+                return self.events[0][0] if self.events else None
+            deadlines = [event[0] for event in self.events if event[2].startswith(prefix)]
+            return min(deadlines) if deadlines else None
+
+    #######################################
+    # Transitions since the last call, for logging and MQTT. With prefix only
+    # those of the outputs whose names start with it, the rest is kept.
+    #######################################
+    def popChanges(self, prefix=None):
+        changes = []
+        with self.condition:
+            kept = collections.deque()
+            while self.changes:
+                change = self.changes.popleft()
+                if prefix is None or change[0].startswith(prefix):
+                    changes.append(change)
+                else:
+                    kept.append(change)
+            self.changes.extend(kept)
+        return changes
+
+    #######################################
+    # Timer thread
+    #######################################
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="actuators", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.runDue()
+            with self.condition:
+                deadline = self.events[0][0] if self.events else None
+                timeout = None if deadline is None else max(deadline - self.clock(), 0)
+                if timeout is None or timeout > 0:
+                    self.condition.wait(timeout)
+
+    #######################################
+    # Keep all outputs off until release(), windows go on in the background.
+    # Only marks them off, switching the hardware is up to the caller, who
+    # may not get past a lock the apply functions wait for.
+    #######################################
+    def hold(self):
+        with self.condition:
+            self.held = True
+            for output in self.outputs.values():
+                if output.state:
+                    output.state = False
+                    self.heldOff.append(output)
+
+    def release(self):
+        with self.condition:
+            for output in self.heldOff:
+                try:
+                    self.switch(output, False)
+                except Exception:
+                    logger.error("Switching off " + output.name + " after a hold didn't work!")
+            self.heldOff    = []
+            self.held       = False
+            self.condition.notify()
+
+    #######################################
+    # Switch everything off, used on exit
+    #######################################
+    def failSafe(self):
+        with self.condition:
+            # Nothing may switch back on afterwards
+            self.events = []
+        for output in self.outputs.values():
+            try:
+                output.apply(False)
+                output.state = False
+            except Exception:
+                logger.error("Fail-safe switch off of " + output.name + " didn't work!")
+        logger.info("All timed outputs switched off")
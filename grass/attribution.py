@@ -0,0 +1,154 @@
+#############################################################################
+##                      Per actuator energy attribution                    ##
+#############################################################################
+# The S0 meter only sees the whole box. Between two pulses exactly one pulse
+# worth of energy was used, so every pulse interval gives one observation
+# of the mean power together with how long each relay was on during it:
+#
+#   power = base + sum(draw[relay] * share of the interval relay was on)
+#
+# The draws are learned by recursive least squares with a forgetting
+# factor, so nothing but the relay transitions since the last pulse is
+# kept. Each pulse's energy is split between the relays by the learned
+# draws and summed into hourly buckets for a rolling per relay total.
+
+import collections
+import threading
+
+class Attribution:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, names, kWhPerPulse, forgetting=0.995, hours=24, start=None, maxEvents=256):
+        self.names          = list(names)           # Relays, order of the regression terms after base
+        self.kWhPerPulse    = kWhPerPulse
+        self.forgetting     = forgetting            # RLS forgetting factor, closer to 1 remembers longer
+        self.lock           = threading.Lock()
+        self.states         = {name: False for name in self.names}
+        self.events         = collections.deque()   # (timestamp, name, state) not yet integrated
+        self.queued         = {}                    # Last state switched to per relay, queued or applied
+        self.maxEvents      = maxEvents             # Beyond that the oldest events are integrated right away
+        self.cursor         = start                 # Integrated up to here
+        self.lastPulse      = None
+        self.onTime         = {name: 0.0 for name in self.names}  # Seconds on since lastPulse
+        self.samples        = 0
+
+        # RLS state, parameter 0 is the base load
+        size                = len(self.names) + 1
+        self.theta          = [0.0] * size          # W
+        self.P              = [[1e4 if i == j else 0.0 for j in range(size)] for i in range(size)]
+        self.traceLimit     = 2e4 * size
+
+        # Rolling totals in kWh, one dict per hour
+        self.hourly         = collections.deque(maxlen=hours)
+        self.hour           = None
+        self.totals         = {name: 0.0 for name in ["base"] + self.names}
+
+    #######################################
+    # Relay transition, from any thread
+    #######################################
+    def switch(self, name, state, timestamp):
+        state = bool(state)
+        with self.lock:
+            if self.queued.get(name, self.states.get(name)) == state:
+                return
+            self.queued[name] = state
+            self.events.append((timestamp, name, state))
+            # Without pulses nothing consumes the events, integrating early gives the same on times
+            if len(self.events) > self.maxEvents:
+                self.advance(self.events[0][0])
+
+    #######################################
+    # New S0 pulse timestamps, in order
+    #######################################
+    def pulses(self, stamps):
+        with self.lock:
+            for stamp in stamps:
+                self.advance(stamp)
+                if self.lastPulse is not None and stamp > self.lastPulse:
+                    self.observe(stamp - self.lastPulse, stamp)
+                self.onTime = {name: 0.0 for name in self.names}
+                self.lastPulse = stamp
+
+    def advance(self, until):
+        # Integrate relay on times up to until, applying transitions on the way
+        if self.cursor is None:
+            self.cursor = until
+        while self.events and self.events[0][0] <= until:
+            timestamp, name, state = self.events.popleft()
+            self.integrate(max(timestamp, self.cursor))
+            self.states[name] = state
+        self.integrate(until)
+
+    def integrate(self, until):
+        dt = until - self.cursor
+        if dt <= 0:
+            return
+        for name in self.names:
+            if self.states[name]:
+                self.onTime[name] += dt
+        self.cursor = until
+
+    #######################################
+    # One pulse interval: learn, then split its energy
+    #######################################
+    def observe(self, dt, timestamp):
+        x = [1.0] + [self.onTime[name] / dt for name in self.names]
+        y = self.kWhPerPulse * 3.6e6 / dt
+        self.update(x, y)
+        self.samples += 1
+
+        # Split by the learned draws, never negative, always adding up to the pulse
+        shares = {"base": max(self.theta[0], 0.0) * dt}
+        for idx, name in enumerate(self.names):
+            shares[name] = max(self.theta[idx + 1], 0.0) * self.onTime[name]
+        total = sum(shares.values())
+        if total <= 0:
+            shares, total = {"base": 1.0}, 1.0
+
+        hour = int(timestamp // 3600)
+        if self.hour is None or hour > self.hour:
+            # Hours without a single pulse still move the window
+            for _ in range(min(hour - self.hour, self.hourly.maxlen) if self.hour is not None else 1):
+                self.hourly.append({})
+            self.hour = hour
+        bucket = self.hourly[-1]
+        for name, share in shares.items():
+            kWh = self.kWhPerPulse * share / total
+            bucket[name] = bucket.get(name, 0.0) + kWh
+            self.totals[name] += kWh
+
+    def update(self, x, y):
+        # Standard RLS step with forgetting. A relay that never switches
+        # leaves its direction unexcited, stop forgetting before P winds up.
+        size    = len(x)
+        lam     = self.forgetting if sum(self.P[i][i] for i in range(size)) < self.traceLimit else 1.0
+        Px      = [sum(self.P[i][j] * x[j] for j in range(size)) for i in range(size)]
+        denom   = lam + sum(x[i] * Px[i] for i in range(size))
+        gain    = [v / denom for v in Px]
+        error   = y - sum(self.theta[i] * x[i] for i in range(size))
+        for i in range(size):
+            self.theta[i] += gain[i] * error
+        for i in range(size):
+            for j in range(size):
+                self.P[i][j] = (self.P[i][j] - gain[i] * Px[j]) / lam
+
+    #######################################
+    # Results
+    #######################################
+    def draws(self):
+        # Learned power per relay and base load in W
+        with self.lock:
+            result = {"base": self.theta[0]}
+            for idx, name in enumerate(self.names):
+                result[name] = self.theta[idx + 1]
+            return result
+
+    def rolling(self):
+        # kWh per relay and base load over the last hours
+        with self.lock:
+            result = {name: 0.0 for name in self.totals}
+            for bucket in self.hourly:
+                for name, kWh in bucket.items():
+                    result[name] += kWh
+            return result
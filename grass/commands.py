@@ -0,0 +1,83 @@
+#############################################################################
+##                             Command queue                               ##
+#############################################################################
+# Hands MQTT commands from the paho network thread to the control loop. The
+# network thread only stamps and queues a command and wakes the control
+# task, the relays are only ever switched on the control loop. Commands
+# acting on the same output coalesce: a newer one replaces a queued older
+# one (exhauston followed by exhaustoff before the loop ran ends up as just
+# exhaustoff), the replaced command is handed out once, marked superseded,
+# so it can still be acknowledged.
+
+import time
+import threading
+
+#######################################
+# Single received command
+#######################################
+class Command:
+    __slots__ = ("name", "group", "state", "received", "superseded")
+
+    def __init__(self, name, group, state, received):
+        self.name       = name
+        self.group      = group     # Output the command acts on
+        self.state      = state     # Requested state of the output
+        self.received   = received  # Monotonic timestamp the network thread got it
+        self.superseded = False     # Replaced by a newer command before it was acted on
+
+class CommandQueue:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, commands, clock=time.monotonic, onCommand=None):
+        self.commands   = commands  # Command name -> (group, state)
+        self.clock      = clock
+        self.onCommand  = onCommand # Called after every queued command, e.g. to wake a task
+        self.lock       = threading.Lock()
+        self.pending    = {}        # Group -> newest command, in order of arrival
+        self.replaced   = []        # Superseded commands not handed out yet
+        self.received   = 0
+        self.coalesced  = 0
+
+    #######################################
+    # From the network thread, returns False for unknown commands
+    #######################################
+    def put(self, name):
+        entry = self.commands.get(name)
+        if entry is None:
+            return False
+        group, state = entry
+        command = Command(name, group, state, self.clock())
+        with self.lock:
+            previous = self.pending.pop(group, None)
+            if previous is not None:
+                previous.superseded = True
+                self.replaced.append(previous)
+                self.coalesced += 1
+            self.pending[group] = command
+            self.received += 1
+        if self.onCommand is not None:
+            self.onCommand()
+        return True
+
+    #######################################
+    # From the control loop: everything queued, superseded ones first
+    #######################################
+    def take(self):
+        with self.lock:
+            if not self.pending and not self.replaced:
+                return []
+            commands = self.replaced + list(self.pending.values())
+            self.replaced   = []
+            self.pending    = {}
+        return commands
+
+    def waiting(self):
+        with self.lock:
+            return bool(self.pending or self.replaced)
+
+    #######################################
+    # Seconds since the command was received
+    #######################################
+    def latency(self, command):
+        return self.clock() - command.received
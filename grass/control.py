@@ -0,0 +1,29 @@
+#############################################################################
+##                          Control decisions                              ##
+#############################################################################
+# The relay decisions of a tent as plain functions of the readings and the
+# parameters, without any I/O. grass.Tent switches the relays with them and
+# replay.py runs recorded traces through the very same functions.
+
+#######################################
+# Heater, two point controller around airTempSet
+#######################################
+def heater(airTemp, running, airTempSet, airTempHyst):
+    if airTemp < (airTempSet - airTempHyst):
+        return True
+    if airTemp < (airTempSet + airTempHyst):
+        return False
+    # Above the band: whatever it was
+    return running
+
+#######################################
+# Light, on from lightOnTime to lightOffTime (full hours)
+#######################################
+def light(hour, lightOnTime, lightOffTime):
+    return hour >= lightOnTime and hour < lightOffTime
+
+#######################################
+# Circulation fan, runs in its windows and along with the exhaust
+#######################################
+def circ(runFan, runExhaust):
+    return runFan or runExhaust
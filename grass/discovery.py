@@ -0,0 +1,185 @@
+#############################################################################
+##                          Sensor discovery                               ##
+#############################################################################
+# Keeps track of which sensors are present and healthy. A sensor that is
+# missing, or fails failLimit reads in a row (raising, or missing its
+# deadline even if the read never returns), is taken out of the
+# acquisition engine so it costs nothing in the sensor cycle, and probed
+# again with exponential backoff until it answers. Probes run on the
+# worker thread of the sensor's bus, so they never block the control loop
+# and never run concurrently with reads on the same bus.
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MISSING = "missing"
+PROBING = "probing"
+HEALTHY = "healthy"
+
+#######################################
+# A sensor that may come and go
+#######################################
+class Device:
+    __slots__ = ("name", "bus", "probe", "bind", "timeout", "state", "failures", "backoff", "nextProbe", "future")
+
+    def __init__(self, name, bus, probe, bind, timeout):
+        self.name       = name
+        self.bus        = bus
+        self.probe      = probe     # Returns the driver, raises or returns None if there is no device
+        self.bind       = bind      # Driver -> read function for the acquisition engine
+        self.timeout    = timeout   # Read deadline, slower reads count as failed
+        self.state      = MISSING
+        self.failures   = 0         # Failed reads in a row
+        self.backoff    = 0.0       # Seconds until the next probe after this one fails
+        self.nextProbe  = 0.0
+        self.future     = None      # Probe running on the bus worker
+
+class Discovery:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, engine, clock=time.monotonic, minBackoff=10, maxBackoff=600, failLimit=3, onProbe=None, prefix=""):
+        self.engine     = engine        # acquisition.Acquisition the devices are registered with
+        self.prefix     = prefix        # Prepended to the names in the engine, which may be shared
+        self.clock      = clock
+        self.minBackoff = minBackoff    # Seconds until the first re-probe
+        self.maxBackoff = maxBackoff    # Longest wait between probes
+        self.failLimit  = failLimit     # Failed reads in a row before a device counts as gone
+        self.onProbe    = onProbe       # Called from the bus worker when a probe finished
+        self.devices    = {}
+        self.lock       = threading.Lock()
+
+    #######################################
+    # Add a device, probed on the next scan
+    #######################################
+    def add(self, name, bus, probe, bind, timeout):
+        device = Device(name, bus, probe, bind, timeout)
+        device.backoff = self.minBackoff
+        self.devices[name] = device
+
+    def present(self, name):
+        device = self.devices.get(name)
+        return device is not None and device.state == HEALTHY
+
+    #######################################
+    # Read wrapper, runs on the bus worker. Reads past their deadline
+    # were counted by the engine already, see scan().
+    #######################################
+    def reader(self, device, read):
+        def wrapper():
+            start = time.monotonic()
+            try:
+                value = read()
+            except Exception:
+                if time.monotonic() - start <= device.timeout:
+                    self.readDone(device, False)
+                raise
+            if time.monotonic() - start <= device.timeout:
+                self.readDone(device, True)
+            return value
+        return wrapper
+
+    def readDone(self, device, ok):
+        with self.lock:
+            if ok:
+                device.failures = 0
+                device.backoff  = self.minBackoff
+            else:
+                device.failures += 1
+
+    #######################################
+    # Probe everything missing, used at startup. With executor all probes
+    # run at once instead of one after the other on their bus worker, only
+    # for drivers that lock the bus per transfer and before reads started.
+    #######################################
+    def start(self, executor=None):
+        for device in self.devices.values():
+            if device.state == MISSING:
+                self.submit(device, executor)
+
+    def wait(self, timeout=10):
+        # Wait for the probes started, returns the changes like scan()
+        deadline = time.monotonic() + timeout
+        for device in self.devices.values():
+            if device.future is not None:
+                try:
+                    device.future.exception(timeout=max(deadline - time.monotonic(), 0))
+                except Exception:
+                    pass
+        return self.scan()
+
+    #######################################
+    # Apply finished probes, drop failing devices, start due probes.
+    # Runs on the control loop, returns [(name, present)] of what changed.
+    #######################################
+    def scan(self):
+        now     = self.clock()
+        changes = []
+        for device in self.devices.values():
+            # Probe finished
+            if device.state == PROBING and device.future.done():
+                driver = None
+                try:
+                    driver = device.future.result()
+                except Exception as e:
+                    logger.debug("Probing " + device.name + " didn't work (" + repr(e) + ")")
+                device.future = None
+                if driver is not None:
+                    with self.lock:
+                        device.failures = 0
+                    self.engine.register(self.prefix + device.name, device.bus, self.reader(device, device.bind(driver)), device.timeout)
+                    # Backoff is only reset by a good read, a device that answers
+                    # probes but no reads still gets probed less and less often
+                    device.state    = HEALTHY
+                    changes.append((device.name, True))
+                    logger.info("Sensor " + device.name + " found")
+                else:
+                    device.state        = MISSING
+                    device.nextProbe    = now + device.backoff
+                    device.backoff      = min(device.backoff * 2, self.maxBackoff)
+
+            # Failing too often, skip it until it answers a probe again.
+            # Deadlines missed in the engine count as failed reads.
+            elif device.state == HEALTHY and self.missed(device) >= self.failLimit:
+                self.engine.unregister(self.prefix + device.name)
+                device.state        = MISSING
+                device.nextProbe    = now + device.backoff
+                changes.append((device.name, False))
+                logger.error("Sensor " + device.name + " failed " + str(device.failures) + " reads in a row, probing again in "
+                    + "{:.0f}".format(device.backoff) + " s")
+                device.backoff      = min(device.backoff * 2, self.maxBackoff)
+
+            if device.state == MISSING and now >= device.nextProbe:
+                self.submit(device)
+        return changes
+
+    def missed(self, device):
+        misses = self.engine.takeMisses(self.prefix + device.name)
+        with self.lock:
+            device.failures += misses
+            return device.failures
+
+    def submit(self, device, executor=None):
+        device.state    = PROBING
+        device.future   = (executor or self.engine.worker(device.bus)).submit(device.probe)
+        if self.onProbe is not None:
+            device.future.add_done_callback(lambda f: self.onProbe())
+
+    #######################################
+    # Seconds until scan() has something to do, None if only a probe is running
+    #######################################
+    def nextScan(self):
+        now     = self.clock()
+        delay   = None
+        for device in self.devices.values():
+            if device.state == MISSING:
+                wait = max(device.nextProbe - now, 0)
+            elif device.state == HEALTHY and device.failures >= self.failLimit:
+                wait = 0
+            else:
+                continue
+            delay = wait if delay is None else min(delay, wait)
+        return delay
@@ -0,0 +1,210 @@
+#############################################################################
+##                           S0 energy meter                               ##
+#############################################################################
+# Counts the pulses of the S0 output of the energy meter. The GPIO interrupt
+# only stores the pulse timestamp in a preallocated ring and bumps a counter,
+# no locks, no I/O, it doesn't even wake anybody. The control loop polls
+# the ring with collect(), derives the instantaneous power from the pulse
+# intervals and keeps the total.
+#
+# Persistence is split in two so the SD card isn't rewritten every cycle and
+# a power cut can't corrupt anything:
+#   - the total file ("<kWh> <pulse sequence>") is replaced atomically
+#     (write, fsync, rename) at most every persistInterval seconds
+#   - every collected batch appends "<pulse sequence> <timestamp>" to a
+#     journal, on startup pulses journaled after the total file are added.
+#     The journal is only fsynced every syncInterval seconds or syncPulses
+#     pulses, a power cut loses at most those, never the total file
+# A torn journal line is ignored, a crash between the rename and the journal
+# truncation can't count pulses twice thanks to the sequence numbers.
+
+import os
+import array
+import logging
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Single producer, single consumer ring of pulse timestamps
+#######################################
+class PulseRing:
+    def __init__(self, capacity=1024):
+        self.capacity   = capacity
+        self.stamps     = array.array('d', bytes(8 * capacity))
+        self.written    = 0     # Only ever changed by the producer
+        self.read       = 0     # Only ever changed by the consumer
+
+    def push(self, timestamp):
+        # Slot first, counter second, the consumer never sees a half written pulse
+        self.stamps[self.written % self.capacity] = timestamp
+        self.written += 1
+
+    def take(self):
+        # Returns (new pulse count, timestamps still in the ring)
+        written = self.written
+        count   = written - self.read
+        first   = max(self.read, written - self.capacity)
+        stamps  = [self.stamps[i % self.capacity] for i in range(first, written)]
+        self.read = written
+        return count, stamps
+
+class EnergyMeter:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, path, kWhPerPulse, clock, persistInterval=600, syncInterval=60, syncPulses=100, powerWindow=60,
+                 ringSize=1024, onCollect=None):
+        self.path           = path              # Total file, the journal lives next to it
+        self.journalPath    = path + ".journal"
+        self.kWhPerPulse    = kWhPerPulse
+        self.clock          = clock
+        self.persistInterval= persistInterval   # Seconds at least between rewrites of the total file
+        self.syncInterval   = syncInterval      # Seconds at most between fsyncs of the journal
+        self.syncPulses     = syncPulses        # Pulses at most journaled without fsync
+        self.powerWindow    = powerWindow       # Seconds of pulses averaged for the power
+        self.onCollect      = onCollect         # Called with the timestamps of every collected batch
+        self.ring           = PulseRing(ringSize)
+        self.recent         = []                # Pulse timestamps within powerWindow
+        self.total          = 0.0               # kWh
+        self.sequence       = 0                 # Pulses counted ever, ties journal to total file
+        self.persisted      = 0                 # Sequence in the total file
+        self.lastPersist    = clock()
+        self.journal        = None
+        self.synced         = 0                 # Sequence of the last fsynced journal line
+        self.lastSync       = self.lastPersist
+        self.load()
+
+    #######################################
+    # GPIO interrupt
+    #######################################
+    def pulse(self, channel=None):
+        self.ring.push(self.clock())
+
+    #######################################
+    # Restore total and journaled pulses
+    #######################################
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                fields = f.read().split()
+            self.total = float(fields[0])
+            # Files written before the journal only hold the total
+            self.sequence = int(fields[1]) if len(fields) > 1 else 0
+            logger.info("Read out " + "{:.3f}".format(self.total) + " kWh energy used from memory!")
+        except (OSError, ValueError, IndexError):
+            logger.warning("No energy memory present. Starting at 0kwh!")
+        self.persisted = self.sequence
+        self.synced    = self.sequence
+
+        journaled = self.sequence
+        try:
+            with open(self.journalPath, 'r') as f:
+                for line in f:
+                    try:
+                        sequence, timestamp = line.split()
+                        journaled = max(journaled, int(sequence))
+                    except ValueError:
+                        # Torn write at the end
+                        break
+        except OSError:
+            pass
+        if journaled > self.sequence:
+            missed = journaled - self.sequence
+            self.total += missed * self.kWhPerPulse
+            self.sequence = journaled
+            self.synced   = journaled
+            logger.info("Recovered " + str(missed) + " S0 pulses from the journal")
+
+    #######################################
+    # Collect pulses from the ring, returns how many were new
+    #######################################
+    def collect(self):
+        count, stamps = self.ring.take()
+        if count == 0:
+            return 0
+        if count > len(stamps):
+            logger.warning("S0 ring overflowed, " + str(count - len(stamps)) + " pulse timestamps lost")
+        self.total      += count * self.kWhPerPulse
+        self.sequence   += count
+        self.recent.extend(stamps)
+        if self.onCollect is not None:
+            self.onCollect(stamps)
+        self.journalWrite(stamps[-1] if stamps else self.clock())
+        logger.debug(str(count) + " S0 pulses counted, energy used: " + "{:.3f}".format(self.total) + " kWh")
+        return count
+
+    def journalWrite(self, timestamp):
+        try:
+            if self.journal is None:
+                self.journal = open(self.journalPath, 'a')
+            self.journal.write(str(self.sequence) + " " + "{:.3f}".format(timestamp) + "\n")
+            self.journal.flush()
+            # Every pulse through to the card would wear it, batch them
+            now = self.clock()
+            if self.sequence - self.synced >= self.syncPulses or now - self.lastSync >= self.syncInterval:
+                os.fsync(self.journal.fileno())
+                self.synced     = self.sequence
+                self.lastSync   = now
+        except OSError:
+            logger.error("Writing the energy journal didn't work!")
+
+    #######################################
+    # Instantaneous power in W, None until there are two pulses
+    #######################################
+    def power(self, now=None):
+        if now is None:
+            now = self.clock()
+        # Keep the last two pulses in any case for slow meters
+        cut = 0
+        while cut < len(self.recent) - 2 and self.recent[cut] < now - self.powerWindow:
+            cut += 1
+        del self.recent[:cut]
+        if len(self.recent) < 2:
+            return None
+        span = self.recent[-1] - self.recent[0]
+        if span <= 0:
+            return None
+        joules  = self.kWhPerPulse * 3.6e6
+        power   = (len(self.recent) - 1) * joules / span
+        # Without a new pulse the draw can't be more than one pulse since the last
+        sinceLast = now - self.recent[-1]
+        if sinceLast > 0:
+            power = min(power, joules / sinceLast)
+        return power
+
+    #######################################
+    # Throttled atomic rewrite of the total file
+    #######################################
+    def persistDue(self, now):
+        return self.sequence != self.persisted and now - self.lastPersist >= self.persistInterval
+
+    def persist(self, now=None):
+        if now is None:
+            now = self.clock()
+        self.lastPersist = now
+        if self.sequence == self.persisted:
+            return
+        tmpPath = self.path + ".tmp"
+        try:
+            with open(tmpPath, 'w') as f:
+                f.write(repr(self.total) + " " + str(self.sequence))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpPath, self.path)
+        except OSError:
+            logger.error("Persisting energy used didn't work!")
+            return
+        self.persisted = self.sequence
+        self.synced    = self.sequence
+        # Everything journaled is in the total file now
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        try:
+            os.remove(self.journalPath)
+        except OSError:
+            pass
+
+    def close(self):
+        self.collect()
+        self.persist()
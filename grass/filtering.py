@@ -0,0 +1,235 @@
+#############################################################################
+##                          Sensor filtering                               ##
+#############################################################################
+# Sensors are read in bursts of a few samples per cycle, every channel keeps
+# its last samples in a window. Channels sharing a policy are evaluated
+# together as one (channels x window) block: median, median absolute
+# deviation, outlier rejection and the mean of what's left, so the cost per
+# cycle hardly grows with the number of channels or samples.
+#
+# Every channel gets a filtered value and a confidence between 0 and 1:
+#
+#   confidence = share of samples that aren't outliers
+#              * 1 / (1 + (standard error / tolerance) ** 2)
+#
+# tolerance is the error still acceptable for the channel, so a channel
+# with a lot of outliers or noise relative to it gets a low confidence.
+#
+# With NumPy (optional, only imported when used) the block is evaluated vectorized, otherwise the
+# same is computed in plain Python row by row. For the few channels of a
+# single box plain Python is quicker, NumPy wins from ~16 channels per block.
+
+import math
+import statistics
+
+numpy = None        # Imported by loadNumpy() once a FilterBank asks for it, it takes a while
+
+MAD_SIGMA = 1.4826  # Median absolute deviation to standard deviation for normal noise
+
+#######################################
+# NumPy if it's installed, returns False if it isn't
+#######################################
+def loadNumpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            return False
+        numpy = module
+    return True
+
+#######################################
+# Wraps a read function to return a burst of count samples. Failed reads
+# are left out as long as at least one of them worked.
+#######################################
+def burst(read, count):
+    def wrapper():
+        samples = []
+        error   = None
+        for _ in range(count):
+            try:
+                samples.append(read())
+            except Exception as e:
+                error = e
+        if not samples:
+            raise error
+        return samples
+    return wrapper
+
+#######################################
+# How a channel is filtered
+#######################################
+class Policy:
+    __slots__ = ("method", "window", "outlier", "alpha", "tolerance")
+
+    def __init__(self, method="median", window=8, outlier=3.5, alpha=0.3, tolerance=1.0):
+        self.method     = method    # "median", "mean" (of the samples left after outlier rejection) or "ema" (of that mean)
+        self.window     = window    # Samples kept per channel
+        self.outlier    = outlier   # Samples further than this many sigmas from the median are rejected...
+        self.alpha      = alpha     # EMA only: weight of the newest mean
+        self.tolerance  = tolerance # ...unless they're within tolerance, also the error still acceptable
+
+    def key(self):
+        return (self.method, self.window, self.outlier, self.alpha, self.tolerance)
+
+#######################################
+# Channels sharing a policy, evaluated as one block
+#######################################
+class Group:
+    def __init__(self, policy, useNumpy):
+        self.policy     = policy
+        self.useNumpy   = useNumpy
+        self.rows       = {}        # Channel -> row
+        self.written    = []        # Samples written per row, ever
+        self.buffer     = numpy.full((0, policy.window), numpy.nan) if useNumpy else []
+        self.pending    = ([], [], [])  # NumPy only: (rows, columns, samples) written into buffer in one go
+
+    def add(self, channel, samples):
+        row = self.rows.get(channel)
+        if row is None:
+            row = len(self.rows)
+            self.rows[channel] = row
+            self.written.append(0)
+            if self.useNumpy:
+                self.buffer = numpy.vstack([self.buffer, numpy.full((1, self.policy.window), numpy.nan)])
+            else:
+                self.buffer.append([math.nan] * self.policy.window)
+        window  = self.policy.window
+        samples = list(samples)[-window:]
+        start   = self.written[row]
+        for idx, sample in enumerate(samples):
+            if self.useNumpy:
+                self.pending[0].append(row)
+                self.pending[1].append((start + idx) % window)
+                self.pending[2].append(sample)
+            else:
+                self.buffer[row][(start + idx) % window] = sample
+        self.written[row] = start + len(samples)
+
+    #######################################
+    # Returns per row (median, inlier mean, inliers, filled, standard error)
+    #######################################
+    def evaluate(self):
+        if not self.rows:
+            return []
+        if self.useNumpy:
+            return self.evaluateNumpy()
+        return [self.evaluateRow(row) for row in self.buffer]
+
+    def evaluateNumpy(self):
+        policy  = self.policy
+        rows, columns, samples = self.pending
+        if rows:
+            self.buffer[rows, columns] = samples
+            self.pending = ([], [], [])
+        data    = self.buffer
+        filled  = numpy.count_nonzero(~numpy.isnan(data), axis=1)
+        median  = self.medianNumpy(data, filled)
+        dev     = numpy.abs(data - median[:, None])
+        sigma   = MAD_SIGMA * self.medianNumpy(dev, filled)
+        limit   = numpy.maximum(policy.outlier * sigma, policy.tolerance)
+        inlier  = dev <= limit[:, None]     # NaN is never an inlier
+        count   = numpy.count_nonzero(inlier, axis=1)
+        values  = numpy.where(inlier, data, 0.0)
+        mean    = values.sum(axis=1) / count
+        square  = numpy.where(inlier, (data - mean[:, None]) ** 2, 0.0).sum(axis=1)
+        stderr  = numpy.where(count > 1, numpy.sqrt(square / numpy.maximum(count - 1, 1) / count), policy.tolerance)
+        return list(zip(median.tolist(), mean.tolist(), count.tolist(), filled.tolist(), stderr.tolist()))
+
+    @staticmethod
+    def medianNumpy(data, filled):
+        # Row medians ignoring NaN. Sorting puts NaN last, so the median of a row
+        # is in the middle of its filled part. Rows are never empty, a channel
+        # only gets a row with its first samples. Much cheaper than nanmedian()
+        # on small blocks.
+        ordered = numpy.sort(data, axis=1)
+        rows    = numpy.arange(len(data))
+        return (ordered[rows, (filled - 1) // 2] + ordered[rows, filled // 2]) / 2
+
+    def evaluateRow(self, row):
+        policy  = self.policy
+        data    = [sample for sample in row if not math.isnan(sample)]
+        median  = statistics.median(data)
+        sigma   = MAD_SIGMA * statistics.median([abs(sample - median) for sample in data])
+        limit   = max(policy.outlier * sigma, policy.tolerance)
+        inliers = [sample for sample in data if abs(sample - median) <= limit]
+        count   = len(inliers)
+        mean    = sum(inliers) / count
+        if count > 1:
+            stderr = math.sqrt(sum((sample - mean) ** 2 for sample in inliers) / (count - 1) / count)
+        else:
+            stderr = policy.tolerance
+        return (median, mean, count, len(data), stderr)
+
+class FilterBank:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, policies, useNumpy=None):
+        self.policies   = policies  # Channel prefix -> Policy, longest matching prefix wins, others aren't filtered
+        self.useNumpy   = useNumpy is not False and loadNumpy()   # None: if installed
+        self.groups     = {}        # Policy key -> Group
+        self.channels   = {}        # Channel -> Group, None if not filtered
+        self.ema        = {}        # Channel -> last EMA value
+        self.last       = {}        # Channel -> last (value, confidence)
+        self.updated    = set()     # Channels with new samples since evaluate()
+
+    def policyFor(self, channel):
+        best = None
+        for prefix in self.policies:
+            if channel.startswith(prefix) and (best is None or len(prefix) > len(best)):
+                best = prefix
+        return None if best is None else self.policies[best]
+
+    #######################################
+    # New samples of a channel, returns False if it isn't filtered
+    #######################################
+    def add(self, channel, samples):
+        if channel not in self.channels:
+            policy = self.policyFor(channel)
+            if policy is None:
+                self.channels[channel] = None
+            else:
+                group = self.groups.get(policy.key())
+                if group is None:
+                    group = Group(policy, self.useNumpy)
+                    self.groups[policy.key()] = group
+                self.channels[channel] = group
+        group = self.channels[channel]
+        if group is None:
+            return False
+        samples = [float(sample) for sample in samples if sample is not None]
+        if not samples:
+            return True
+        group.add(channel, samples)
+        self.updated.add(channel)
+        return True
+
+    #######################################
+    # Filter everything with new samples, returns {channel: (value, confidence)}
+    #######################################
+    def evaluate(self):
+        results = {}
+        for group in self.groups.values():
+            policy = group.policy
+            for channel, (median, mean, count, filled, stderr) in zip(group.rows, group.evaluate()):
+                if channel not in self.updated:
+                    continue
+                if policy.method == "median":
+                    value = median
+                elif policy.method == "ema":
+                    previous = self.ema.get(channel)
+                    value = mean if previous is None else previous + policy.alpha * (mean - previous)
+                    self.ema[channel] = value
+                else:
+                    value = mean
+                confidence = count / filled / (1 + (stderr / policy.tolerance) ** 2)
+                results[channel] = (value, confidence)
+        self.last.update(results)
+        self.updated = set()
+        return results
+
+    def value(self, channel):
+        # Last (value, confidence), None before the first samples
+        return self.last.get(channel)
@@ -0,0 +1,434 @@
+#############################################################################
+##                          Fleet aggregator                               ##
+#############################################################################
+# Collects the output topics of many Grass boxes into memory for central
+# dashboards and queries. Every topic below <box>/outputs/ is a channel of
+# that box, e.g. farm/tent7/outputs/airtemp is channel airtemp of box
+# farm/tent7. Each channel keeps its samples in two flat arrays, receive
+# times (f64) and values (f32), 12 bytes a sample, trimmed to the retention.
+# Relay and sensor states count as 1 / 0, parameters are left out.
+#
+# Snapshots (snapshotFormat "json" or "binary") are unpacked into the same
+# channels with the box's own timestamp. Once a box sends snapshots, the
+# single topics of the channels they carry are ignored so nothing counts
+# twice.
+#
+# Queries, also served as JSON over HTTP:
+#   /boxes                                              channels per box
+#   /range?box=B&channel=C&window=3600&step=60          (start, mean, min, max, count) per step
+#   /rank?channel=airtemp&window=3600&statistic=max     boxes ordered by a statistic
+#   /daily?channel=energy&days=7                        increase per box and local day
+#   /stats                                              ingest counters and memory
+#
+# Usage: python grass/fleet.py [--broker HOST] [--subscribe "farm/#"] [--port 9120]
+
+import math
+import time
+import array
+import bisect
+import struct
+import logging
+import argparse
+import datetime
+import threading
+
+import history
+import snapshot
+
+logger = logging.getLogger(__name__)
+
+OUTPUTS         = "/outputs/"   # A box publishes its channels below <box>/outputs/
+IGNORED         = ("params/",)  # Channels not kept
+STATES          = {b"True": 1.0, b"False": 0.0, b"true": 1.0, b"false": 0.0}
+STATISTICS      = ("mean", "min", "max", "last", "increase")
+TRIM_INTERVAL   = 60            # Seconds between trimming to the retention
+# Relays of a snapshot and the channels they're published on one by one
+SNAPSHOT_RELAYS = {"light": "runlight", "heater": "runheater", "exhaust": "exhaust", "circ": "runfan", "water": "runwater"}
+
+# Routes of a topic
+IGNORE          = 0
+READING         = 1
+JSON            = 2
+BINARY          = 3
+
+#######################################
+# Payload to a float, None if it isn't a number or state
+#######################################
+def parse(payload):
+    state = STATES.get(payload)
+    if state is not None:
+        return state
+    try:
+        value = float(payload)
+    except ValueError:
+        return None
+    return value if math.isfinite(value) else None
+
+#######################################
+# Increase of a counter over values[lo:hi], resets count from zero
+#######################################
+def increase(values, lo, hi):
+    if hi - lo < 2:
+        return None
+    total       = 0.0
+    previous    = values[lo]
+    for value in values[lo + 1:hi]:
+        total   += value - previous if value >= previous else value
+        previous = value
+    return total
+
+#######################################
+# Channels a snapshot carries
+#######################################
+def inSnapshot(channel):
+    return (channel.startswith(("bucketmoists/", "buckettemps/")) or channel in snapshot.CHANNELS
+        or channel in SNAPSHOT_RELAYS.values())
+
+#######################################
+# Local midnights of the last days, oldest first, today's included
+#######################################
+def midnights(days, now):
+    today = datetime.datetime.fromtimestamp(now).date()
+    return [datetime.datetime.combine(today - datetime.timedelta(days=idx), datetime.time()).timestamp()
+        for idx in range(days - 1, -1, -1)]
+
+#######################################
+# Samples of one channel of one box
+#######################################
+class Series:
+    __slots__ = ("times", "values", "first")
+
+    def __init__(self):
+        self.times  = array.array("d")
+        self.values = array.array("f")
+        self.first  = 0     # Oldest sample kept, trimmed ones are dropped in batches
+
+    def __len__(self):
+        return len(self.times) - self.first
+
+    def append(self, timestamp, value):
+        times = self.times
+        if len(times) > self.first and timestamp < times[-1]:
+            # Out of order, keep the arrays sorted for bisecting
+            return False
+        times.append(timestamp)
+        self.values.append(value)
+        return True
+
+    def trim(self, before):
+        self.first = bisect.bisect_left(self.times, before, self.first)
+        # Moved only once half of it is gone, keeps appending amortized O(1)
+        if self.first > len(self.times) // 2:
+            del self.times[:self.first]
+            del self.values[:self.first]
+            self.first = 0
+
+    def window(self, start, end):
+        lo = bisect.bisect_left(self.times, start, self.first)
+        return lo, bisect.bisect_left(self.times, end, lo)
+
+    def samples(self, start, end):
+        lo, hi = self.window(start, end)
+        return list(zip(self.times[lo:hi], self.values[lo:hi]))
+
+    #######################################
+    # (start, mean, min, max, count) per step, like the history rollups
+    #######################################
+    def downsample(self, start, end, step):
+        lo, hi  = self.window(start, end)
+        buckets = []
+        bucket  = None
+        for timestamp, value in zip(self.times[lo:hi], self.values[lo:hi]):
+            bucketStart = start + (timestamp - start) // step * step
+            if bucket is None or bucket.start != bucketStart:
+                bucket = history.Bucket(bucketStart)
+                buckets.append(bucket)
+            bucket.add(value)
+        return [(b.start, b.sum / b.count, b.min, b.max, b.count) for b in buckets]
+
+    def statistic(self, name, start, end):
+        lo, hi = self.window(start, end)
+        if name == "increase":
+            # Counted from the last sample before the window
+            return increase(self.values, max(lo - 1, self.first), hi)
+        if lo == hi:
+            return None
+        values = self.values[lo:hi]
+        if name == "mean":
+            return sum(values) / len(values)
+        if name == "min":
+            return min(values)
+        if name == "max":
+            return max(values)
+        return values[-1]
+
+class Fleet:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, retention=2 * 24 * 3600, clock=time.time):
+        self.retention      = retention
+        self.clock          = clock
+        self.boxes          = {}        # Box -> {channel: Series}
+        self.routes         = {}        # Topic -> (route, Series or box, box)
+        self.snapshotBoxes  = set()     # Boxes sending snapshots
+        self.lock           = threading.Lock()
+        self.messages       = 0
+        self.samples        = 0
+        self.lastTrim       = 0.0
+
+    def series(self, box, channel):
+        channels = self.boxes.get(box)
+        if channels is None:
+            channels = self.boxes[box] = {}
+            logger.info("New box " + box)
+        series = channels.get(channel)
+        if series is None:
+            series = channels[channel] = Series()
+        return series
+
+    #######################################
+    # Where a topic goes, looked up once per topic
+    #######################################
+    def route(self, topic):
+        idx = topic.find(OUTPUTS)
+        if idx < 0:
+            return (IGNORE, None, None)
+        box     = topic[:idx]
+        channel = topic[idx + len(OUTPUTS):]
+        if channel == "snapshot":
+            return (JSON, box, box)
+        if channel == "snapshot/bin":
+            return (BINARY, box, box)
+        if not channel or channel.startswith(IGNORED) or (box in self.snapshotBoxes and inSnapshot(channel)):
+            return (IGNORE, None, box)
+        return (READING, self.series(box, channel), box)
+
+    #######################################
+    # A message as received, payload as bytes
+    #######################################
+    def ingest(self, topic, payload, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock()
+        with self.lock:
+            self.messages += 1
+            route = self.routes.get(topic)
+            if route is None:
+                route = self.routes[topic] = self.route(topic)
+            kind, target, box = route
+            if kind == READING:
+                value = parse(payload)
+                if value is not None and target.append(timestamp, value):
+                    self.samples += 1
+            elif kind != IGNORE:
+                self.ingestSnapshot(target, payload, kind)
+            if timestamp - self.lastTrim > TRIM_INTERVAL:
+                self.trim(timestamp)
+
+    def ingestSnapshot(self, box, payload, kind):
+        try:
+            frame = snapshot.fromJson(payload) if kind == JSON else snapshot.fromBinary(payload)
+        except (ValueError, KeyError, TypeError, struct.error):
+            logger.debug("Unreadable snapshot from " + box)
+            return
+        if box not in self.snapshotBoxes:
+            self.snapshotBoxes.add(box)
+            for topic, (route, target, routeBox) in list(self.routes.items()):
+                if route == READING and routeBox == box and inSnapshot(topic[len(box) + len(OUTPUTS):]):
+                    self.routes[topic] = (IGNORE, None, box)
+        for channel, value in frame.values.items():
+            if self.series(box, channel).append(frame.timestamp, value):
+                self.samples += 1
+        for relay, state in frame.relays.items():
+            if self.series(box, SNAPSHOT_RELAYS.get(relay, relay)).append(frame.timestamp, 1.0 if state else 0.0):
+                self.samples += 1
+
+    def trim(self, now):
+        self.lastTrim = now
+        before = now - self.retention
+        for channels in self.boxes.values():
+            for series in channels.values():
+                series.trim(before)
+
+    #######################################
+    # Queries
+    #######################################
+    def channels(self):
+        with self.lock:
+            return {box: sorted(channels) for box, channels in sorted(self.boxes.items())}
+
+    def range(self, box, channel, start, end, step=None):
+        # Raw (timestamp, value) samples, or (start, mean, min, max, count) per step
+        with self.lock:
+            series = self.boxes.get(box, {}).get(channel)
+            if series is None:
+                return []
+            if step:
+                return series.downsample(start, end, step)
+            return series.samples(start, end)
+
+    def rank(self, channel, start, end, statistic="mean", top=None, lowest=False):
+        # [(box, value)], highest first unless lowest
+        if statistic not in STATISTICS:
+            raise ValueError("Unknown statistic " + statistic)
+        with self.lock:
+            ranked = []
+            for box, channels in self.boxes.items():
+                series = channels.get(channel)
+                if series is None:
+                    continue
+                value = series.statistic(statistic, start, end)
+                if value is not None:
+                    ranked.append((box, value))
+        ranked.sort(key=lambda entry: entry[1], reverse=not lowest)
+        return ranked[:top] if top else ranked
+
+    def periods(self, channel, boundaries, end, statistic="increase"):
+        # {box: [(period start, value)]} for the periods starting at boundaries
+        if statistic not in STATISTICS:
+            raise ValueError("Unknown statistic " + statistic)
+        ends = boundaries[1:] + [end]
+        with self.lock:
+            result = {}
+            for box, channels in sorted(self.boxes.items()):
+                series = channels.get(channel)
+                if series is not None:
+                    result[box] = [(start, series.statistic(statistic, start, stop)) for start, stop in zip(boundaries, ends)]
+            return result
+
+    def daily(self, channel, days, now=None, statistic="increase"):
+        now = self.clock() if now is None else now
+        return self.periods(channel, midnights(days, now), now, statistic)
+
+    def stats(self):
+        with self.lock:
+            series  = [s for channels in self.boxes.values() for s in channels.values()]
+            kept    = sum(len(s) for s in series)
+            return {
+                "messages"  : self.messages,
+                "samples"   : self.samples,
+                "kept"      : kept,
+                "boxes"     : len(self.boxes),
+                "series"    : len(series),
+                "bytes"     : sum(s.times.itemsize * len(s.times) + s.values.itemsize * len(s.values) for s in series),
+            }
+
+#######################################
+# JSON queries over HTTP
+#######################################
+def serve(fleet, port, host="0.0.0.0"):
+    import json
+    import http.server
+    import urllib.parse
+
+    def answer(path, query):
+        now     = fleet.clock()
+        window  = float(query.get("window", 3600))
+        if path == "/boxes":
+            return fleet.channels()
+        if path == "/stats":
+            return fleet.stats()
+        if path == "/range":
+            step = float(query["step"]) if "step" in query else None
+            return fleet.range(query["box"], query["channel"], now - window, now + 1, step)
+        if path == "/rank":
+            top = int(query["top"]) if "top" in query else None
+            return fleet.rank(query["channel"], now - window, now + 1, query.get("statistic", "mean"), top,
+                query.get("lowest") in ("1", "true", "True"))
+        if path == "/daily":
+            return fleet.daily(query.get("channel", "energy"), int(query.get("days", 7)), now, query.get("statistic", "increase"))
+        return None
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url     = urllib.parse.urlsplit(self.path)
+            query   = dict(urllib.parse.parse_qsl(url.query))
+            try:
+                result = answer(url.path, query)
+            except (KeyError, ValueError) as e:
+                self.send_error(400, "Bad query: " + str(e))
+                return
+            if result is None:
+                self.send_error(404)
+                return
+            body = json.dumps(result).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fleet-http", daemon=True).start()
+    logger.info("Serving fleet queries on port " + str(port))
+    return server
+
+#######################################
+# MQTT subscription feeding a fleet
+#######################################
+def subscribe(fleet, broker, port, topics, clientId, username=None, password=None):
+    import paho.mqtt.client as mqtt
+
+    def on_connect(client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logger.error("Connecting to " + broker + " failed: " + str(reason_code))
+            return
+        logger.info("Connected to " + broker + ", subscribing to " + ", ".join(topics))
+        client.subscribe([(topic, 0) for topic in topics])
+
+    def on_message(client, userdata, message):
+        fleet.ingest(message.topic, message.payload)
+
+    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, client_id=clientId)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    if username:
+        client.username_pw_set(username, password)
+    client.connect_async(broker, port)
+    client.loop_start()
+    return client
+
+#######################################
+# main()
+#######################################
+def main(argv=None, prog=None):
+    import mqttsecrets
+
+    parser = argparse.ArgumentParser(prog=prog, description="Collect the outputs of many Grass boxes and answer queries over them")
+    parser.add_argument("--broker", default=mqttsecrets.Broker, help="MQTT broker")
+    parser.add_argument("--mqtt-port", type=int, default=mqttsecrets.Port, help="MQTT port")
+    parser.add_argument("--subscribe", action="append", default=None, metavar="TOPIC", help="Topic filter, # by default")
+    parser.add_argument("--retention", type=float, default=48, help="Hours kept in memory")
+    parser.add_argument("--port", type=int, default=9120, help="HTTP port for queries")
+    parser.add_argument("--report", type=float, default=60, help="Seconds between logged summaries")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", level=logging.INFO)
+    fleet   = Fleet(retention=args.retention * 3600)
+    server  = serve(fleet, args.port)
+    client  = subscribe(fleet, args.broker, args.mqtt_port, args.subscribe or ["#"], mqttsecrets.ClientId + "-fleet",
+        mqttsecrets.Username, mqttsecrets.Password)
+
+    try:
+        messages = 0
+        while True:
+            time.sleep(args.report)
+            stats   = fleet.stats()
+            now     = fleet.clock()
+            hottest = fleet.rank("airtemp", now - 3600, now + 1, "mean", top=3)
+            logger.info("%d boxes, %.0f messages/s, %d samples in %.1f MB, warmest last hour: %s" % (
+                stats["boxes"], (stats["messages"] - messages) / args.report, stats["kept"], stats["bytes"] / 1e6,
+                ", ".join("%s %.1f °C" % entry for entry in hottest) or "-"))
+            messages = stats["messages"]
+    except KeyboardInterrupt:
+        pass
+    client.loop_stop()
+    client.disconnect()
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
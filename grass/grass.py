@@ -1,49 +1,141 @@
 #############################################################################
 ##                               GRASS                                     ##
 #############################################################################
-# PiPLC / Raspberry Pi based controller for a growtent
+# PiPLC / Raspberry Pi based controller for one or more growtents
 
 # Secrets
 import mqttsecrets
+import mqttpublisher
+import acquisition
+import discovery
+import parameters
+import actuators
+import scheduler
+import spool
+import history
+import hal
+import instrumentation
+import logpipeline
+import reporting
+import snapshot
+import energy
+import attribution
+import commands
+import filtering
+import control
+import homeassistant
+import supervision
 # General libraries
 import os
 import sys
-import glob
+import json
 import time
 import datetime
 import logging
-# GPIO
-import RPi.GPIO as GPIO
+import atexit
+import signal
+import threading
+import concurrent.futures
 # MQTT
 import paho.mqtt.client as mqtt
-# Sensors 
-import board
-from adafruit_seesaw.seesaw import Seesaw
-import adafruit_ahtx0
-import adafruit_bh1750
 
 #############################################################################
 ##                           Global variables                              ##
 #############################################################################
-# General
+# General, the paths are those of the first tent, further tents get "-<name>" appended
 energyPath      = os.getenv('HOME') + "/GrassEnergyUsed.txt"
 logPath         = os.getenv('HOME') + "/GrassLog.txt"
-THERMAL_PATH    = "/sys/class/thermal/thermal_zone0/temp"
+spoolPath       = os.getenv('HOME') + "/GrassSpool"
+historyPath     = os.getenv('HOME') + "/GrassHistory"
+profilePath     = os.getenv('HOME') + "/GrassProfiles"
+parameterPath   = os.getenv('HOME') + "/GrassParameters.json"
+hwBackend       = hal.PiPlcBackend  # Hardware backend, simulation.SimBackend runs without a Pi
+hw              = None              # Instance of hwBackend, created in main()
+startup         = None              # instrumentation.Phases, timings of the startup phases
 logger          = logging.getLogger(__name__)
+logLevel        = "INFO"            # Changed at runtime through mqttTopicLogLevel
+logMaxBytes     = 5 * 1024 * 1024   # Log file is rotated at this size...
+logMaxAge       = 7 * 24 * 3600     # ...or after this many seconds, old files are gzipped
+logBackups      = 8                 # Rotated files kept
+logBurst        = 5                 # Identical messages logged per logWindow, the rest is counted
+logWindow       = 300
+logLimitLevel   = "WARNING"         # Only messages from this level up are limited, readings and switches are all logged
+logPipeline     = None              # logpipeline.LogPipeline, created in main()
 
-# MQTT
-mqttTopicOutput = "grass/outputs/"
-mqttTopicInput  = "grass/inputs/#"
-mqttQos         = 2
+# MQTT, topics below the topic of every tent (see tents), e.g. grass/outputs/
+mqttTopicOutput = "outputs/"
+mqttTopicInput  = "inputs/"     # Subscribed with #
+mqttTopicLogLevel = "loglevel"  # Below mqttTopicInput of the first tent: DEBUG, INFO, WARNING, ERROR or CRITICAL
+mqttTopicParams = "params/"     # Below mqttTopicInput, followed by the parameter name, current values are in outputs/params/
+mqttQos         = 2     # Default QoS, used for everything not listed in mqttTopicQos
+mqttTopicQos    = {     # QoS per topic below mqttTopicOutput, longest matching prefix wins
+    "bucketmoists/" : 0,
+    "buckettemps/"  : 0,
+    "watertemp"     : 0,
+    "brightness"    : 0,
+    "airhum"        : 1,
+    "airtemp"       : 1,
+    "energy"        : 1,
+    "power"         : 0,
+    "telemetry/"    : 0,
+    "snapshot"      : 1,
+    "commands/"     : 1,
+    "confidence/"   : 0,
+}
+mqttMaxInflight = 100   # Messages paho may keep in flight at once
+mqttFlushTimeout= 5     # Seconds to wait for a cycle's messages to be confirmed
+mqttReconnect   = 3     # Seconds between reconnection attempts
+spoolMaxBytes   = 50 * 1024 * 1024  # Messages kept on disk while offline, oldest dropped beyond
+spoolSegment    = 1024 * 1024       # Size of a single spool file
+spoolRetry      = 30    # Seconds between replay attempts after a failed replay
+publishTopics   = True  # One topic per reading, as existing dashboards expect
+snapshotFormat  = None  # One message per sensor cycle as well: "json" (snapshot) or "binary" (snapshot/bin, up to 12 buckets)
+mqttOK          = False
+mqttTopicStatus = "status"  # Below the first tent's topic: "online", or "offline" as last will when the connection drops
+
+# Home Assistant MQTT discovery, configs are only sent again once they changed
+haDiscovery     = True
+haPrefix        = "homeassistant/"  # Discovery prefix configured in Home Assistant
+haStatusTopic   = haPrefix + "status"   # Home Assistant says "online" there when it starts, all configs are sent again
+haCachePath     = os.getenv('HOME') + "/GrassDiscovery.json"   # Hashes of the configs sent
+haRetry         = 60    # Seconds until configs the broker didn't take are sent again
+advertiser      = None  # homeassistant.Advertiser, created in pahoSetup()
+
+# Report by exception, per topic below mqttTopicOutput, longest matching prefix wins.
+# A reading is only published once it left the deadband (absolute, or percent of the
+# last published value but at least the absolute one) but at most every minInterval
+# and at least every maxInterval s.
+reportPolicies  = {
+    "bucketmoists/" : reporting.Policy(deadband=5.0,  maxInterval=600),
+    "buckettemps/"  : reporting.Policy(deadband=0.5,  maxInterval=600),
+    "watertemp"     : reporting.Policy(deadband=0.2,  maxInterval=600),
+    "brightness"    : reporting.Policy(percent=5,     deadband=1.0,  minInterval=10, maxInterval=600),
+    "airhum"        : reporting.Policy(deadband=2.0,  maxInterval=300),
+    "airtemp"       : reporting.Policy(deadband=0.2,  maxInterval=300),
+    "energy"        : reporting.Policy(deadband=0.01, maxInterval=600),
+    "power"         : reporting.Policy(percent=10,    deadband=1.0,  minInterval=5, maxInterval=300),
+    "telemetry/"    : reporting.Policy(deadband=1.0,  maxInterval=900),
+    "confidence/"   : reporting.Policy(deadband=0.1,  maxInterval=900),
+}
+reportDefault   = reporting.Policy(maxInterval=300)  # Everything else, e.g. runheater, on change only
+
+# Local history, (tier, resolution in s, retention in s). Resolution 0 is every reading.
+historyTiers    = [
+    ("raw", 0,      7 * 24 * 3600),
+    ("1m",  60,     30 * 24 * 3600),
+    ("1h",  3600,   2 * 365 * 24 * 3600),
+]
 
 # Machine parameters, set through recipe or MQTT outputs
+# Defaults of every tent, overridden by its parameter file and <topic>inputs/params/<name> (see Tent.parameterSetup)
+parameterDebounce = 30  # Seconds without updates before the parameter file is written
 controlMode     = "local"
 airTempSet      = 20    # Air Temperature setpoint in C
 airTempHyst     = 0.5   # Hysterysis for AirTemperature contoller
 airHumMax       = 90    # Maximum air humidity in % before ventilation starts
 soilMoistSet    = 1000  # Soil moisture setpoint in whatever unit Adafruit found appropriate (200 .. 2000)
 wateringPulseOn = 10    # How long the water can be turned on
-wateringPulseOff= 30    # How long the water needs to be off
+wateringPulseOff= 30    # How long the water needs to be off after a pulse
 airCircDuration = 60    # Duration of air circulation when triggered
 airCircTime     = 30    # Time in minutes between air circulations
 lightSet        = 2000  # Target brightness in Lux
@@ -51,31 +143,90 @@ lightOn         = 1     # Binary output of Light switch
 sensorInterval  = 60    # Interval to measure inputs in seconds
 slowInterval    = 3600  # Interval for slow stuff
 s0kWhPerPulse   = 0.001 # kWH to be added to total counter per pulse
+energyPersist   = 600   # Seconds at least between rewrites of energyPath, pulses in between are journaled
+energyPoll      = 2     # Seconds between looks for new S0 pulses, the interrupt takes no locks to wake anybody
+energySync      = 60    # Seconds at most until journaled pulses are synced to the card
+energySyncPulses= 100   # Pulses at most until they are synced to the card
+lightOnTime     = 3     # Hour at which light is switched on
+lightOffTime    = 21    # Hour at which light is switched off
 
-# Machine thinking
-lastAirCirc         = 0
-runFan              = False
-runHeater           = False
-runLight            = False
-runExhaust          = False
-lastWaterOff        = 0
-lastSensors         = 0
-lastSlow            = 0
-soilSensors         = []    # List of soil sensor entities
-topic               = ""
-payload             = ""
-lightOnTime         = 3     # Hour at which light is switched on 
-lightOffTime        = 21    # Hour at which light is switched off
-lastRunLight        = False
-energyUsed          = 0.0   # Total energy used in kwh
-waterRequested      = False
-exhaustRequested    = False
-
-# Sensor states
-mqttOK          = False
-allStemmasOK    = True
-lightSensorOK   = True
-airSensorOK     = True
+# Sensor acquisition, deadline in seconds for every sensor read, per sample for sensors read in bursts
+sensorTimeouts  = {
+    "soil"      : 0.5,
+    "water"     : 1.5,  # DS18B20 conversion alone takes ~750 ms
+    "light"     : 0.5,
+    "air"       : 0.5,
+    "soc"       : 0.2,
+}
+sensorMaxAge    = 300   # Seconds a last good value stands in for missed reads, then the sensor counts as missing
+# One worker per bus for all tents, so tents never talk on the same bus at once
+sensorEngine    = acquisition.Acquisition(maxAge=sensorMaxAge)
+# Samples read per sensor cycle, in a row on the sensor's bus
+sensorBursts    = {
+    "soil"      : 4,
+    "air"       : 3,
+}
+# Filtering of the bursts, per channel below mqttTopicOutput, longest matching prefix
+# wins, channels not listed aren't filtered. Confidence is published under confidence/.
+filterPolicies  = {
+    "bucketmoists/" : filtering.Policy("median", window=12, tolerance=5.0),
+    "buckettemps/"  : filtering.Policy("ema",    window=8,  tolerance=0.5, alpha=0.3),
+    "airtemp"       : filtering.Policy("mean",   window=6,  tolerance=0.2),
+    "airhum"        : filtering.Policy("mean",   window=6,  tolerance=1.0),
+}
+filterNumpy     = False # Evaluate with NumPy, only pays off from ~16 channels per policy (benchmarks/bench_filtering.py)
+# Sensors missing or failing are skipped and probed again, waiting twice as long every time
+sensorBackoff   = 10    # Seconds until the first re-probe
+sensorBackoffMax= 600   # Longest wait between probes
+sensorFailLimit = 3     # Failed reads in a row before a sensor counts as gone
+sensorProbeThreads = 8  # Sensors probed at the same time at startup, the drivers lock the bus per transfer
+sensorProbeTimeout = 10 # Seconds the first sensor cycle waits for the startup probes
+
+# Instrumentation
+metricsPort     = 9110  # Local Prometheus text endpoint (/metrics), None to disable
+telemetryInterval = 300 # Seconds between uploads of stage timings
+cycleBudget     = 2.0   # Seconds a control cycle may take before it counts as overrun
+profileOnOverrun= False # Sample the stack during every cycle and keep those over budget
+instruments     = instrumentation.Instruments(
+    cycleBudget     = cycleBudget,
+    profileOnOverrun= profileOnOverrun,
+    profilePath     = profilePath)
+
+# Supervision of the control loop from a thread of its own. Pings the systemd watchdog
+# while the loop is healthy, run as Type=notify with WatchdogSec longer than stallAfter.
+stallAfter      = 30    # Seconds a task may run or be overdue before the loop counts as stalled
+safeAfter       = 60    # Seconds stalled before the relays are driven into safeOutputs
+safeOutputs     = {     # Relay states of every tent while stalled, None leaves the relay as it is
+    "light"     : None,
+    "heater"    : False,
+    "exhaust"   : False,
+    "circ"      : False,
+    "water"     : False,
+}
+exitOutputs     = dict(safeOutputs, light=False)   # Relay states on exit, nothing runs the light schedule anymore
+mqttTopicSupervision = "supervision/"   # Below mqttTopicOutput of the first tent: event (JSON) and state (retained)
+supervisor      = None  # supervision.Supervisor, created in main()
+supervisionState= "ok"  # ok, stalled or safestate
+
+# Timed actuators (watering pulses, circulation windows) of all tents, one timer thread
+actuatorTimer   = actuators.ActuatorTimer(clock=lambda: hw.time())
+outputLock      = threading.Lock()  # Held while relays shared with the timer thread are written
+actuatorTopics  = {
+    "water"     : "runwater",
+    "circ"      : "runfan",
+}
+
+# MQTT commands, (output, requested state). Queued by the network thread, newer
+# commands for the same output replace older ones. Acted on by the control task,
+# or right from the sensor task if it's waiting for a slow sensor.
+commandMap      = {
+    "waternow"  : ("water",     True),
+    "exhauston" : ("exhaust",   True),
+    "exhaustoff": ("exhaust",   False),
+}
+
+# Tasks of the control loop of all tents, run at their deadline
+taskScheduler   = scheduler.Scheduler()
 
 ###################
 # GPIO mapping
@@ -97,7 +248,16 @@ relayWater      = 12    # Q5
 relayCirc       = 16    # Q6
 
 # PWM
-pwmCircFan      = 18    # PWM 1 
+pwmCircFan      = 18    # PWM 1
+
+# Relays by name, as used for the energy attribution
+relayNames      = {
+    "light"     : relayLight,
+    "heater"    : relayHeater,
+    "exhaust"   : relayExhaust,
+    "circ"      : relayCirc,
+    "water"     : relayWater,
+}
 
 #############################################################################
 ##                           Global Constants                              ##
@@ -105,263 +265,484 @@ pwmCircFan      = 18    # PWM 1
 # Stemma soil adresses. 0x38 can't be used as 0x38 is already used by AHT20 and unchangeable
 SOIL_MOIST_ADR  = [0x36, 0x37, 0x39]
 
+#############################################################################
+##                                Tents                                    ##
+#############################################################################
+# Tents run by this Pi. They share the scheduler, the sensor buses and the MQTT
+# connection, everything not listed here is the same for every tent and taken
+# from the globals above. The first tent keeps the topics, files and names of a
+# single tent setup and also reports the Pi itself (SOC temperature, disk, tasks).
+tents           = [
+    {
+        "name"      : "grass",
+        "topic"     : "grass/",         # Prefix of mqttTopicOutput and mqttTopicInput
+        "relays"    : relayNames,
+        "s0"        : S0counter,
+        "soil"      : SOIL_MOIST_ADR,
+        "i2cChannel": None,             # TCA9548A channel of the tent's I2C sensors, None without multiplexer
+        "oneWire"   : None,             # DS18B20 serial (28-...) of the water sensor, None for the first one found
+    },
+]
+controllers     = []    # Tent for every entry of tents, created in tentSetup()
+
 #############################################################################
 ##                               Helpers                                   ##
 #############################################################################
 #######################################
-# S0 counter
+# Log messages of further tents start with their name
 #######################################
-def s0callback(channel):
-    global energyUsed
-    energyUsed += s0kWhPerPulse
-    logger.info("S0 pulse counted, energy used: " + "{:.3f}".format(energyUsed) + " kWh")
+class TentLog(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        return self.extra["label"] + msg, kwargs
 
 #######################################
-# Paho connection established
+# File of a tent, the first tent uses the path as it is
 #######################################
-def on_connect(client, userdata, flags, rc, properties=None):
-    global mqttOK
-    logger.info("Connection established")
-    mqttc.subscribe(mqttTopicInput, qos=1)
-    mqttOK = True
+def tentPath(path, name, primary):
+    if primary:
+        return path
+    root, ext = os.path.splitext(path)
+    return root + "-" + name + ext
 
-#######################################
-# Callback on received message
-#######################################
-def callback(client, userdata, message):
-    global waterRequested, exhaustRequested
+#############################################################################
+##                           Tent controller                               ##
+#############################################################################
+class Tent:
+    __slots__ = (
+        # Configuration
+        "name", "primary", "prefix", "key", "topic", "relays", "s0Pin", "soilAddresses", "i2cChannel", "oneWire",
+        "energyPath", "parameterPath", "historyPath", "logger",
+        # Parameters, see parameterSetup()
+        "controlMode", "airTempSet", "airTempHyst", "airHumMax", "soilMoistSet", "wateringPulseOn", "wateringPulseOff",
+        "airCircDuration", "airCircTime", "lightSet", "lightOnTime", "lightOffTime", "sensorInterval", "slowInterval",
+        # Machine thinking
+        "runFan", "runHeater", "runLight", "runExhaust", "lastSensors", "lastSlow", "lastRunLight",
+        "waterCommand", "exhaustRequested", "airTemp", "airHum",
+        # Sensor states
+        "allStemmasOK", "lightSensorOK", "airSensorOK", "sensorNames", "probed", "filtered",
+        # Parts
+        "hw", "publisher", "reporter", "filterBank", "discovery", "commandQueue",
+        "energyMeter", "energyShares", "parameterStore", "historyStore",
+    )
 
-    message = str(message.payload.decode("utf-8"))
-    logger.info("Message received: " + message)
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, config, primary=False):
+        self.name           = config["name"]
+        self.primary        = primary
+        self.prefix         = "" if primary else self.name + "/"   # Task, sensor and stage names, empty for the first tent
+        self.key            = self.name + "/"                       # Names of the tent's outputs in the shared actuatorTimer
+        self.topic          = config["topic"]
+        self.relays         = config["relays"]
+        self.s0Pin          = config["s0"]
+        self.soilAddresses  = config["soil"]
+        self.i2cChannel     = config.get("i2cChannel")
+        self.oneWire        = config.get("oneWire")
+        self.energyPath     = config.get("energyPath", tentPath(energyPath, self.name, primary))
+        self.parameterPath  = config.get("parameterPath", tentPath(parameterPath, self.name, primary))
+        self.historyPath    = config.get("historyPath", tentPath(historyPath, self.name, primary))
+        self.logger         = TentLog(logger, {"label": "" if primary else "[" + self.name + "] "})
+        if snapshotFormat == "binary" and len(self.soilAddresses) > snapshot.MAX_BUCKETS:
+            self.logger.warning("Binary snapshots hold " + str(snapshot.MAX_BUCKETS) + " buckets, sending JSON snapshots")
 
-    # ---------------------------------
-    # MQTT Inputs
-    # ---------------------------------
-    # Watering request
-    if message == "waternow":
-        waterRequested = True
-    elif message == "exhauston":
-        exhaustRequested = True
-    elif message == "exhaustoff":
-        exhaustRequested = False
+        # Parameters, defaults from the globals
+        self.controlMode    = controlMode
+        self.airTempSet     = airTempSet
+        self.airTempHyst    = airTempHyst
+        self.airHumMax      = airHumMax
+        self.soilMoistSet   = soilMoistSet
+        self.wateringPulseOn= wateringPulseOn
+        self.wateringPulseOff= wateringPulseOff
+        self.airCircDuration= airCircDuration
+        self.airCircTime    = airCircTime
+        self.lightSet       = lightSet
+        self.lightOnTime    = lightOnTime
+        self.lightOffTime   = lightOffTime
+        self.sensorInterval = sensorInterval
+        self.slowInterval   = slowInterval
 
-#######################################
-# Subscription successful
-#######################################
-def on_subscribe(client, userdata, mid, granted_ops, properties=None):
-    logger.info("On subscribe called")
+        # Machine thinking
+        self.runFan         = False
+        self.runHeater      = False
+        self.runLight       = False
+        self.runExhaust     = False
+        self.lastSensors    = 0
+        self.lastSlow       = 0
+        self.lastRunLight   = False
+        self.waterCommand   = None  # Watering command waiting for the pump's minimum off time
+        self.exhaustRequested = False
+        self.airTemp        = None
+        self.airHum         = None
 
-#######################################
-# Paho setup
-#######################################
-def pahoSetup():
-    global mqttc
-    mqttc = mqtt.Client(callback_api_version = mqtt.CallbackAPIVersion.VERSION2, client_id=mqttsecrets.ClientId)
-    mqttc.on_message = callback
-    mqttc.on_connect = on_connect
-    mqttc.on_subscribe = on_subscribe
-    mqttc.username_pw_set(mqttsecrets.Username, mqttsecrets.Password)
-    mqttc.connect(mqttsecrets.Broker, mqttsecrets.Port)
-    # Start the mqtt loop, no intension to ever end
-    mqttc.loop_start()
+        # Sensor states
+        self.allStemmasOK   = True
+        self.lightSensorOK  = True
+        self.airSensorOK    = True
+        self.sensorNames    = []    # Names of the tent's sensors in sensorEngine
+        self.probed         = False # Startup probes are done
 
-#######################################
-# Water temp sensor
-#######################################
-def ds18b20_read_temp():
-    global waterTempSensor
-    try:
-        with open(waterTempSensor, 'r') as f:
-            temp_String = f.read()
-        temp_c = float(temp_String) / 1000.0
-        return temp_c
-    except:
-        logger.error("1-Wire reading failed!")
+        # Parts, hw and publisher are set once they exist
+        self.hw             = None
+        self.publisher      = None  # mqttpublisher.Prefixed below the tent's output topic
+        self.reporter       = reporting.Reporter(reportPolicies, reportDefault)
+        self.filterBank     = filtering.FilterBank(filterPolicies, useNumpy=filterNumpy)
+        self.filtered       = {}    # Sensor -> timestamp of the last reading fed to filterBank
+        self.discovery      = discovery.Discovery(
+            sensorEngine,
+            clock       = lambda: self.hw.time(),
+            minBackoff  = sensorBackoff,
+            maxBackoff  = sensorBackoffMax,
+            failLimit   = sensorFailLimit,
+            onProbe     = lambda: taskScheduler.wake(self.prefix + "discovery"),
+            prefix      = self.prefix)
+        self.commandQueue   = commands.CommandQueue(commandMap,
+            onCommand   = lambda: (taskScheduler.wake(self.prefix + "control"), sensorEngine.interrupt()))
+        self.energyMeter    = None  # energy.EnergyMeter counting S0 pulses, created in energySetup()
+        self.energyShares   = None  # attribution.Attribution splitting the energy between the relays
+        self.parameterStore = None  # parameters.ParameterStore, created in parameterSetup()
+        self.historyStore   = None  # history.History, created in historySetup()
 
-#######################################
-# Sensor setup
-#######################################
-def sensorSetup():
-    global lightSensor, airSensor, soilSensors, waterTempSensor
-    global allStemmasOK, lightSensorOK, airSensorOK
-
-    # Pin setup
-    GPIO.setmode(GPIO.BCM)
-    for pin in digitalOutputs:
-        GPIO.setup(pin, GPIO.OUT)
-    for pin in digitalInputs:
-        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-    #for pin in pwmOutputs:
-    #    GPIO.setup(pin, GPIO.OUT)
-    #    #TODO
-    
+    #######################################
     # S0 counter
-    GPIO.add_event_detect(
-        S0counter,
-        edge = GPIO.FALLING, 
-        callback = s0callback,
-        bouncetime = 100)
-
-    # I2C Adafruit
-    i2c_bus = board.I2C()
-
-    # Stemma soil moisture sensor
-    for address in SOIL_MOIST_ADR:
-        try:
-            ss = Seesaw(i2c_bus, addr=address)
-            soilSensors.append(ss)
-            logger.info("Stemma soil sensor " + hex(address) + " found!")
-        except:
-            logger.error("Stemma soil sensor " + hex(address) + " not found!")
-            allStemmasOK = False
-
-    # Light sensor
-    try:
-        lightSensor = adafruit_bh1750.BH1750(i2c_bus)
-    except:
-        logger.error("Light sensor couldn't be added!")
-        lightSensorOK = False
+    #######################################
+    def energySetup(self):
+        # Learns what every relay draws from the pulses, relays report their transitions in setRelay()
+        self.energyShares = attribution.Attribution(self.relays, s0kWhPerPulse, start=self.hw.time())
+        # Pulses are picked up by the energy task every energyPoll seconds
+        self.energyMeter = energy.EnergyMeter(
+            self.energyPath,
+            s0kWhPerPulse,
+            clock           = self.hw.time,
+            persistInterval = energyPersist,
+            syncInterval    = energySync,
+            syncPulses      = energySyncPulses,
+            onCollect       = self.energyShares.pulses)
 
-    # Temp / Air hum sensor
-    try:
-        airSensor = adafruit_ahtx0.AHTx0(i2c_bus)
-    except:
-        logger.error("Air sensor couldn't be found!")
-        airSensorOK = False
+    #######################################
+    # Local history of all readings
+    #######################################
+    def historySetup(self):
+        self.historyStore = history.History(self.historyPath, tiers=historyTiers, rawInterval=self.sensorInterval)
 
-    # Water temperature sensor
-    base_dir = '/sys/bus/w1/devices/'
-    try:
-        device_folder = glob.glob(base_dir + '28*')[0]
-        waterTempSensor = device_folder + '/temperature'
-        logger.info("Found 1-Wire sensor: " + device_folder)
-    except:
-        logger.error("No 1-Wire device found!")
+    #######################################
+    # Relay output, remembering transitions for the energy attribution
+    #######################################
+    def setRelay(self, name, state):
+        self.hw.output(self.relays[name], state)
+        self.energyShares.switch(name, state, self.hw.time())
 
-    # Upload detected sensor states to MQTT
-    try:
+    #######################################
+    # Message on one of the tent's input topics
+    #######################################
+    def handle(self, subtopic, message):
+        # Parameters, the log level has its own topic as well
+        if subtopic == mqttTopicLogLevel:
+            subtopic, message = mqttTopicParams + "logLevel", message.upper()
+        if subtopic.startswith(mqttTopicParams):
+            name = subtopic[len(mqttTopicParams):]
+            if name not in self.parameterStore.parameters:
+                self.logger.error("Unknown parameter " + name + "!")
+                return
+            try:
+                self.parameterStore.set(name, message)
+            except ValueError as e:
+                self.logger.error("Parameter " + name + " not changed: " + str(e))
+                # Publish the value still in use so dashboards snap back
+                self.parameterStore.announce(name)
+            taskScheduler.wake(self.prefix + "parameters")
+            taskScheduler.wake(self.prefix + "control")
+            return
+
+        # ---------------------------------
+        # MQTT Inputs
+        # ---------------------------------
+        # Watering / exhaust requests, the control task is woken to act on them now
+        if not self.commandQueue.put(message):
+            self.logger.warning("Unknown command " + message + "!")
+
+    #######################################
+    # Runtime parameters
+    #######################################
+    def parameterSetup(self):
+        self.parameterStore = parameters.ParameterStore(self.parameterPath, self, debounce=parameterDebounce)
+        define = self.parameterStore.define
+        define("controlMode",       str,    choices=["local"])
+        define("airTempSet",        float,  minimum=5,      maximum=40)
+        define("airTempHyst",       float,  minimum=0.1,    maximum=5)
+        define("airHumMax",         float,  minimum=0,      maximum=100)
+        define("soilMoistSet",      int,    minimum=200,    maximum=2000)
+        define("wateringPulseOn",   float,  minimum=1,      maximum=600)
+        define("wateringPulseOff",  float,  minimum=1,      maximum=3600,
+            onChange = lambda value: actuatorTimer.configure(self.key + "water", minOff=value))
+        define("airCircDuration",   float,  minimum=0,      maximum=3600,
+            onChange = lambda value: actuatorTimer.configure(self.key + "circ", duration=value))
+        define("airCircTime",       float,  minimum=1,      maximum=24 * 60,
+            onChange = lambda value: actuatorTimer.configure(self.key + "circ", period=value * 60))
+        define("lightSet",          int,    minimum=0,      maximum=100000)
+        define("lightOnTime",       int,    minimum=0,      maximum=24)
+        define("lightOffTime",      int,    minimum=0,      maximum=24)
+        define("sensorInterval",    float,  minimum=1,      maximum=3600,
+            onChange = lambda value: taskScheduler.setInterval(self.prefix + "sensors", value))
+        define("slowInterval",      float,  minimum=60,     maximum=24 * 3600,
+            onChange = lambda value: taskScheduler.setInterval(self.prefix + "slow", value))
+        # The log level is the whole process', it lives with the first tent
+        if self.primary:
+            define("logLevel",      str,    choices=logpipeline.LEVELS, target=sys.modules[__name__],
+                onChange = lambda value: logPipeline.setLevel(value))
+        self.parameterStore.load()
+
+    #######################################
+    # Publish a reading if the report policy of its topic says so
+    #######################################
+    def report(self, subtopic, value, now, payload=None, retain=False):
+        if self.reporter.due(subtopic, value, now):
+            self.publisher.queue(subtopic, str(value) if payload is None else payload, retain=retain)
+
+    #######################################
+    # A reading of this cycle: into the snapshot, history and MQTT
+    #######################################
+    def measured(self, frame, channel, value, now, stale=False):
+        frame.set(channel, value, stale)
+        if stale or value is None:
+            return
+        self.historyStore.append(channel, now, value)
+        if publishTopics:
+            self.report(channel, value, now)
+
+    #######################################
+    # Sensor setup
+    #######################################
+    def sensorSetup(self, executor=None):
+        # Probes keep running in the background, see sensorsFound()
+        with instruments.stage(self.prefix + "setup/sensors"):
+            self.sensorProbe(executor)
+
+    #######################################
+    # Wait for the startup probes, done by the first sensor cycle
+    #######################################
+    def sensorsFound(self):
+        self.discovery.wait(sensorProbeTimeout)
+        self.probed = True
+
+        # Upload detected sensor states to MQTT
+        for name, device in self.discovery.devices.items():
+            if not self.discovery.present(name):
+                self.logger.error("Sensor " + name + " not found!")
+        self.publishSensorStates()
+        self.publisher.flush()
+
+    #######################################
+    # Sensor states, each device and grouped like before: soil, light, air
+    #######################################
+    def publishSensorStates(self):
+        now = self.hw.time()
+        for name in self.discovery.devices:
+            self.report("sensorstates/" + name, self.discovery.present(name), now, retain=True)
+        self.allStemmasOK   = all(self.discovery.present("soil/" + str(idx)) for idx in range(len(self.soilAddresses)))
+        self.lightSensorOK  = self.discovery.present("light")
+        self.airSensorOK    = self.discovery.present("air")
         # Stemmas
-        topic = mqttTopicOutput + "sensorstates/soil"
-        infot = mqttc.publish(topic, str(allStemmasOK), qos=mqttQos)
-        infot.wait_for_publish()
+        self.report("sensorstates/soil", self.allStemmasOK, now, retain=True)
         # Light
-        topic = mqttTopicOutput + "sensorstates/light"
-        infot = mqttc.publish(topic, str(lightSensorOK), qos=mqttQos)
-        infot.wait_for_publish()
+        self.report("sensorstates/light", self.lightSensorOK, now, retain=True)
         # Air
-        topic = mqttTopicOutput + "sensorstates/air"
-        infot = mqttc.publish(topic, str(airSensorOK), qos=mqttQos)
-        infot.wait_for_publish()
-    except:
-        logger.error("Sending sensor states to MQTT didn't work!")
+        self.report("sensorstates/air", self.airSensorOK, now, retain=True)
 
-#######################################
-# Actual machine code
-#######################################
-def machineCode():
-    # Import global vars
-    global lightSensor, airSensor, soilSensors
-    global lastAirCirc, runFan, runHeater, runLight, lastWaterOff, lastSensors, lastSlow, soilSensors, topic, payload
-    global controlMode, airTempSet, airTempHyst, airHumMax, soilMoistSet, wateringPulseOn, wateringPulseOff, airCircDuration
-    global airTemp, airHum, runExhaust
-    global airCircTime, lightSet, lightOn
-    global allStemmasOK, lightSensorOK, airSensorOK
-    global s0kWhPerPulse, energyUsed
-    global lastRunLight, energyPath, waterRequested
-
-    # Remember timestamp
-    now = time.time()
-
-    # #################################
+    #######################################
+    # Sensors that came or went since the last scan
+    #######################################
+    def scanSensors(self):
+        for name, present in self.discovery.scan():
+            self.logger.info("Sensor " + name + (" found" if present else " lost"))
+        # Unchanged states only go out as the reporter's heartbeat
+        self.publishSensorStates()
+
+    #######################################
+    # Find all devices
+    #######################################
+    def sensorProbe(self, executor=None):
+        hw      = self.hw
+        prefix  = self.prefix
+
+        # S0 counter
+        hw.onFallingEdge(self.s0Pin, self.energyMeter.pulse, bouncetime=100)
+
+        # I2C Adafruit, every tent on its multiplexer channel if there is one
+        i2c_bus = hw.i2c(self.i2cChannel)
+
+        # Stemma soil moisture sensor, named by their slot in soilAddresses so they keep it when others come and go
+        for idx, address in enumerate(self.soilAddresses):
+            name = "soil/" + str(idx)
+            self.discovery.add(
+                name, "i2c",
+                instruments.timed(prefix + "setup/" + name, lambda address=address: hw.soilSensor(i2c_bus, address)),
+                lambda ss, name=name: instruments.timed(prefix + "read/" + name,
+                    filtering.burst(lambda: (ss.moisture_read() / 10, ss.get_temp()), sensorBursts["soil"])),
+                sensorTimeouts["soil"] * sensorBursts["soil"])
+
+        # Light sensor
+        self.discovery.add(
+            "light", "i2c",
+            instruments.timed(prefix + "setup/light", lambda: hw.lightSensor(i2c_bus)),
+            lambda lightSensor: instruments.timed(prefix + "read/light", lambda: lightSensor.lux),
+            sensorTimeouts["light"])
+
+        # Temp / Air hum sensor
+        self.discovery.add(
+            "air", "i2c",
+            instruments.timed(prefix + "setup/air", lambda: hw.airSensor(i2c_bus)),
+            lambda airSensor: instruments.timed(prefix + "read/air",
+                filtering.burst(lambda: (airSensor.temperature, airSensor.relative_humidity), sensorBursts["air"])),
+            sensorTimeouts["air"] * sensorBursts["air"])
+
+        # Water temperature sensor, the tent's DS18B20 or the first one showing up
+        self.discovery.add(
+            "water", "onewire",
+            instruments.timed(prefix + "setup/onewire", lambda: hw.findOneWire(self.oneWire)),
+            lambda path: instruments.timed(prefix + "read/water", lambda: hw.readOneWire(path)),
+            sensorTimeouts["water"])
+
+        # Probe everything at once, on executor if given, otherwise one after the other per bus
+        self.discovery.start(executor)
+        self.sensorNames = [prefix + name for name in self.discovery.devices]
+
+        # SOC temperature
+        if self.primary:
+            sensorEngine.register("soc", "sysfs", instruments.timed("read/soc", hw.readThermal), sensorTimeouts["soc"])
+            self.sensorNames.append("soc")
+
+    #######################################
+    # Circulation fan, switched by the actuator timer
+    #######################################
+    def applyCirc(self, state):
+        with outputLock:
+            self.runFan = state
+            self.setRelay("circ", control.circ(self.runFan, self.runExhaust))
+
+    #######################################
+    # Timed actuator setup
+    #######################################
+    def actuatorSetup(self):
+        actuatorTimer.addOutput(self.key + "water", lambda state: self.setRelay("water", state), minOff=self.wateringPulseOff)
+        actuatorTimer.addWindow(self.key + "circ", self.applyCirc, period=self.airCircTime * 60, duration=self.airCircDuration)
+
+    #######################################
+    # Bursts of this cycle into the filters, all channels evaluated at once
+    #######################################
+    def filterReadings(self, readings, now):
+        bursts = [("soil/" + str(idx), ("bucketmoists/" + str(idx), "buckettemps/" + str(idx))) for idx in range(len(self.soilAddresses))]
+        bursts.append(("air", ("airtemp", "airhum")))
+        for name, channels in bursts:
+            reading = readings.get(name)
+            if reading is None or reading.value is None:
+                continue
+            # Every read once, stale ones too if they finished too late for their own cycle
+            if reading.timestamp <= self.filtered.get(name, 0.0):
+                continue
+            self.filtered[name] = reading.timestamp
+            for idx, channel in enumerate(channels):
+                self.filterBank.add(channel, [sample[idx] for sample in reading.value])
+        with instruments.stage(self.prefix + "filter"):
+            filtered = self.filterBank.evaluate()
+        for channel, (value, confidence) in filtered.items():
+            self.report("confidence/" + channel, round(confidence, 2), now)
+
+    #######################################
     # Measure sensors
-    # #################################
-    if now > lastSensors + sensorInterval:
-        lastSensors = now
+    #######################################
+    def measureSensors(self, now):
+        logger          = self.logger
+        filterBank      = self.filterBank
+        self.lastSensors = now
+        if not self.probed:
+            self.sensorsFound()
+
+        # Read the tent's sensors concurrently, stale values are the last good ones
+        with instruments.stage(self.prefix + "read/all"):
+            readings = sensorEngine.sample(onInterrupt=commandsWhileReading, names=self.sensorNames)
+        readings = {name[len(self.prefix):] if name.startswith(self.prefix) else name: reading for name, reading in readings.items()}
+        # Take sensors failing too often out of the next samples
+        self.scanSensors()
+        self.filterReadings(readings, now)
+        frame = snapshot.Frame(now, len(self.soilAddresses))
 
         # -----------------------------
         # Measure soil humidities and temperatures
         # -----------------------------
         soilMoistAvg = 0
+        soilMoistCount = 0
         # Iterate through all connected sensors
-        for idx, soilSensor in enumerate(soilSensors):
-            # Grab soil inputs
-            try:
-                soilMoist       = soilSensor.moisture_read() / 10
-                soilTemp        = soilSensor.get_temp()
-                # TODO what else can the soilSensor do?
+        for idx in range(len(self.soilAddresses)):
+            reading = readings.get("soil/" + str(idx))
+            if reading is None or reading.value is None:
+                continue
+            soilMoist, _ = filterBank.value("bucketmoists/" + str(idx))
+            soilTemp, _  = filterBank.value("buckettemps/" + str(idx))
+            # TODO what else can the soilSensor do?
 
-                soilMoistAvg    = soilMoistAvg + soilMoist
+            soilMoistAvg    = soilMoistAvg + soilMoist
+            soilMoistCount += 1
+            if not reading.stale:
                 logger.info("Bucket " + str(idx) + ": Temperature: " + "{:.2f}".format(soilTemp) + " °C, Moisture: " + "{:.1f}".format(soilMoist) + "%")
 
-                # Send moisture
-                topic = mqttTopicOutput + "bucketmoists/" + str(idx)
-                infot = mqttc.publish(topic, str(soilMoist), qos=mqttQos)
-                infot.wait_for_publish()
-                # Send temperature
-                topic = mqttTopicOutput + "buckettemps/" + str(idx)
-                infot = mqttc.publish(topic, str(soilTemp), qos=mqttQos)
-                infot.wait_for_publish()
-            except:
-                logger.error("Soil sensor " + str(idx) + " reading didn't work!")
+            # Send moisture
+            self.measured(frame, "bucketmoists/" + str(idx), soilMoist, now, reading.stale)
+            # Send temperature
+            self.measured(frame, "buckettemps/" + str(idx), soilTemp, now, reading.stale)
 
-        if len(soilSensors) > 0:
-            soilMoistAvg = soilMoistAvg / len(soilSensors)
+        if soilMoistCount > 0:
+            soilMoistAvg = soilMoistAvg / soilMoistCount
 
         # -----------------------------
         # Measure water temp
         # -----------------------------
-        try:
-            waterTemp = ds18b20_read_temp()
-            logger.info("Water temperature: " + str(waterTemp))
+        reading = readings.get("water")
+        if reading is not None and reading.value is not None:
+            waterTemp = reading.value
+            if not reading.stale:
+                logger.info("Water temperature: " + str(waterTemp))
 
-            topic = mqttTopicOutput + "watertemp"
-            infot = mqttc.publish(topic, str(waterTemp), qos=mqttQos)
-            infot.wait_for_publish()
-        except:
-           logger.error("Reading water temperature didn't work!")
+            self.measured(frame, "watertemp", waterTemp, now, reading.stale)
 
         # -----------------------------
         # Measure light brightness
         # -----------------------------
-        try:
-            logger.info("Light intensity: %.2f Lux" % lightSensor.lux)
-            topic = mqttTopicOutput + "brightness"
-            infot = mqttc.publish(topic, str(lightSensor.lux), qos=mqttQos) # TODO
-            infot.wait_for_publish()
-        except:
-            logger.error("Reading or sending Light Sensor didn't work!")
+        reading = readings.get("light")
+        if reading is not None and reading.value is not None:
+            if not reading.stale:
+                logger.info("Light intensity: %.2f Lux" % reading.value)
+            self.measured(frame, "brightness", reading.value, now, reading.stale)
 
         # -----------------------------
         # Measure Air temp and humidity
         # -----------------------------
-        try:
-            airTemp = airSensor.temperature
-            airHum  = airSensor.relative_humidity
-            logger.info("Air temperature: %0.1f C" % airTemp)
-            logger.info("Air humidity: %0.1f %%" % airHum)
+        reading = readings.get("air")
+        if reading is not None and reading.value is not None:
+            # Stale values still drive the heater, they are the best we have
+            self.airTemp, _ = filterBank.value("airtemp")
+            self.airHum, _  = filterBank.value("airhum")
 
             # Heater
-            if airTemp < (airTempSet - airTempHyst):
-                runHeater = True
-                logger.info("Heater On")
-            elif airTemp < (airTempSet + airTempHyst):
-                runHeater = False
-                logger.info("Heater Off")
+            self.runHeater = control.heater(self.airTemp, self.runHeater, self.airTempSet, self.airTempHyst)
+            logger.info("Heater On" if self.runHeater else "Heater Off")
 
             # Send heater state
-            topic = mqttTopicOutput + "runheater"
-            infot = mqttc.publish(topic, str(runHeater), qos=mqttQos)
-            infot.wait_for_publish()
+            if publishTopics:
+                self.report("runheater", self.runHeater, now, retain=True)
+            if not reading.stale:
+                logger.info("Air temperature: %0.1f C" % self.airTemp)
+                logger.info("Air humidity: %0.1f %%" % self.airHum)
             # Send humidity
-            topic = mqttTopicOutput + "airhum"
-            infot = mqttc.publish(topic, str(airHum), qos=mqttQos)
-            infot.wait_for_publish()
+            self.measured(frame, "airhum", self.airHum, now, reading.stale)
             # Send temperature
-            topic = mqttTopicOutput + "airtemp"
-            infot = mqttc.publish(topic, str(airTemp), qos=mqttQos)
-            infot.wait_for_publish()
-        except:
-            logger.error("Reading or uploading the air sensor didn't work!")
+            self.measured(frame, "airtemp", self.airTemp, now, reading.stale)
+        elif self.runHeater:
+            # Air sensor gone, don't heat blind
+            self.runHeater = False
+            logger.error("No air temperature, heater Off")
+            if publishTopics:
+                self.report("runheater", self.runHeater, now, retain=True)
 
         # -----------------------------
         # Measure water level in reservoir
@@ -371,200 +752,623 @@ def machineCode():
         # -----------------------------
         # Energy used
         # -----------------------------
-        # Remember in case we die
-        with open(energyPath, 'w') as f:
-            f.write(str(energyUsed))
+        self.energyMeter.collect()
+        # Remember in case we die, pulses in between are in the journal
+        if self.energyMeter.persistDue(now):
+            with instruments.stage(self.prefix + "energy/persist"):
+                self.energyMeter.persist(now)
         # Upload to MQTT
-        try:
-            topic = mqttTopicOutput + "energy"
-            infot = mqttc.publish(topic, str(energyUsed), qos=mqttQos)
-            infot.wait_for_publish()
-        except:
-            logger.error("Uploading energy to MQTT didn't work!")
+        self.measured(frame, "energy", self.energyMeter.total, now)
+        self.measured(frame, "power", self.energyMeter.power(now), now)
 
         # -----------------------------
         # SOC Temperature
         # -----------------------------
-        with open(THERMAL_PATH, 'r') as f:
-            socMilliDegrees = float(f.read())
-            socTemp         = socMilliDegrees / 1000 
-            logger.info("Current SOC temperature: " + "{:.2f}".format(socTemp) + " °C")
-        # Upload to MQTT
-        try:
-            topic = mqttTopicOutput + "telemetry/soctemp"
-            infot = mqttc.publish(topic, str(socTemp), qos=mqttQos)
-            infot.wait_for_publish()
-        except:
-            logger.error("Uploading SOC temperature to MQTT didn't work!")
-
-    # #################################
+        reading = readings.get("soc")
+        if reading is not None and reading.value is not None:
+            socTemp = reading.value
+            if not reading.stale:
+                logger.info("Current SOC temperature: " + "{:.2f}".format(socTemp) + " °C")
+            # Upload to MQTT
+            self.measured(frame, "telemetry/soctemp", socTemp, now, reading.stale)
+
+        # -----------------------------
+        # Whole cycle as one message
+        # -----------------------------
+        if snapshotFormat is not None:
+            frame.relays = {
+                "light"     : self.runLight,
+                "heater"    : self.runHeater,
+                "exhaust"   : self.runExhaust,
+                "circ"      : control.circ(self.runFan, self.runExhaust),
+                "water"     : actuatorTimer.isOn(self.key + "water"),
+            }
+            if snapshotFormat == "binary" and len(self.soilAddresses) <= snapshot.MAX_BUCKETS:
+                self.publisher.queue("snapshot/bin", frame.toBinary())
+            else:
+                self.publisher.queue("snapshot", frame.toJson())
+
+    #######################################
     # Slow interval stuff
-    # #################################
-    if now > lastSlow + slowInterval:
-        lastSlow = now
+    #######################################
+    def slowStuff(self, now):
+        logger      = self.logger
+        publisher   = self.publisher
+        self.lastSlow = now
 
         # -----------------------------
         # Free disk space in home
         # -----------------------------
-        statvfs     = os.statvfs(os.getenv('HOME'))     # / KB   / MB   / GB
-        diskSize    = statvfs.f_frsize * statvfs.f_blocks / 1024 / 1024 / 1024 # Size of filesystem in GB
-        diskFree    = statvfs.f_frsize * statvfs.f_bavail / 1024 / 1024 / 1024 # Free space in GB
-        diskPercent = 100 / diskSize * (diskSize - diskFree)
-        logger.info("Filesystem size: " + "{:.3f}".format(diskSize) + "GB")
-        logger.info("Filesystem free space: " + "{:.3f}".format(diskFree) + " GB")
-        logger.info("Filesystem percent used: " + "{:.0f}".format(diskPercent) + " %")
-        # Upload to MQTT
-        try:
-            topic = mqttTopicOutput + "telemetry/fssize"
-            infot = mqttc.publish(topic, "{:.3f}".format(diskSize), qos=mqttQos)
-            infot.wait_for_publish()
-            topic = mqttTopicOutput + "telemetry/fsfree"
-            infot = mqttc.publish(topic, "{:.3f}".format(diskFree), qos=mqttQos)
-            infot.wait_for_publish()
-            topic = mqttTopicOutput + "telemetry/fspercent"
-            infot = mqttc.publish(topic, "{:.0f}".format(diskPercent), qos=mqttQos)
-            infot.wait_for_publish()
-        except:
-            logger.error("Uploading disk usage to MQTT didn't work!")
-
-    # #################################
+        if self.primary:
+            diskBytes, freeBytes = self.hw.diskUsage(os.getenv('HOME'))
+            diskSize    = diskBytes / 1024 / 1024 / 1024    # Size of filesystem in GB
+            diskFree    = freeBytes / 1024 / 1024 / 1024    # Free space in GB
+            diskPercent = 100 / diskSize * (diskSize - diskFree)
+            logger.info("Filesystem size: " + "{:.3f}".format(diskSize) + "GB")
+            logger.info("Filesystem free space: " + "{:.3f}".format(diskFree) + " GB")
+            logger.info("Filesystem percent used: " + "{:.0f}".format(diskPercent) + " %")
+            # Upload to MQTT
+            publisher.queue("telemetry/fssize", "{:.3f}".format(diskSize))
+            publisher.queue("telemetry/fsfree", "{:.3f}".format(diskFree))
+            publisher.queue("telemetry/fspercent", "{:.0f}".format(diskPercent))
+
+        # -----------------------------
+        # Energy per relay
+        # -----------------------------
+        # Learned draw in W and kWh over the last 24 h, "base" is everything not switched
+        draws = self.energyShares.draws()
+        for name, kWh in self.energyShares.rolling().items():
+            logger.info("Energy " + name + ": " + "{:.3f}".format(kWh) + " kWh in 24 h, " + "{:.0f}".format(draws[name]) + " W")
+            publisher.queue("energyshares/" + name + "/kwh24h", "{:.3f}".format(kWh))
+            publisher.queue("energyshares/" + name + "/watts", "{:.1f}".format(draws[name]))
+
+        # -----------------------------
+        # Local history
+        # -----------------------------
+        # Pages are written back by the OS anyway, this just bounds what a power cut can take
+        self.historyStore.flush()
+
+        # -----------------------------
+        # Scheduler statistics
+        # -----------------------------
+        if not self.primary:
+            return
+        for name, task in taskScheduler.tasks.items():
+            stats = task.stats
+            logger.info("Task " + name + ": " + str(stats.runs) + " runs, jitter mean "
+                + "{:.1f}".format(stats.jitterMean() * 1000) + " ms, max "
+                + "{:.1f}".format(stats.jitterMax * 1000) + " ms, runtime max "
+                + "{:.1f}".format(stats.runtimeMax * 1000) + " ms, "
+                + str(stats.overruns) + " overruns")
+            # Upload to MQTT
+            publisher.queue("telemetry/tasks/" + name + "/jittermean", "{:.1f}".format(stats.jitterMean() * 1000))
+            publisher.queue("telemetry/tasks/" + name + "/jittermax", "{:.1f}".format(stats.jitterMax * 1000))
+            publisher.queue("telemetry/tasks/" + name + "/runtimemax", "{:.1f}".format(stats.runtimeMax * 1000))
+            publisher.queue("telemetry/tasks/" + name + "/overruns", str(stats.overruns))
+
+    #######################################
+    # Confirm a command with the time from receiving it to switching the relay
+    #######################################
+    def acknowledge(self, command, result):
+        latency = self.commandQueue.latency(command)
+        if result == "done":
+            instruments.record(self.prefix + "command/" + command.name, latency)
+        self.logger.info("Command " + command.name + " " + result + " after " + "{:.1f}".format(latency * 1000) + " ms")
+        self.publisher.queue("commands/" + command.name, json.dumps({"result": result, "latency_ms": round(latency * 1000, 2)}))
+
+    #######################################
     # Actuators
-    # #################################
-    # ---------------------------------
-    # Circulation
-    # ---------------------------------
-    # If time since last circulation exceeded the setpoint:
-    if now > lastAirCirc + (airCircTime * 60) and not runFan:
-        # Turn fan on
-        runFan = True
-        logger.info("Turning circulation on")
-        # Send circ state
-        try:
-            topic = mqttTopicOutput + "runfan"
-            infot = mqttc.publish(topic, str(runFan), qos=mqttQos)
-            infot.wait_for_publish()
-        except:
-            logger.error("Uploading circulation state to MQTT didn't work!")
-    # If time since last circulation exceeded the setpoint + fan duration:
-    if now > lastAirCirc + (airCircTime * 60) + airCircDuration and runFan:
-        # Turn fan off and remember circulation time
-        runFan = False
-        lastAirCirc = now
-        logger.info("Turning circulation off")
-        # Send circ state
-        try:
-            topic = mqttTopicOutput + "runfan"
-            infot = mqttc.publish(topic, str(runFan), qos=mqttQos)
-            infot.wait_for_publish()
-        except:
-            logger.error("Uploading circulation state to MQTT didn't work!")
-
-    # ---------------------------------
-    # Exhaust
-    # ---------------------------------
-    # Currently exhaust is only done manually on MQTT request
-    if exhaustRequested != runExhaust:
+    #######################################
+    def controlOutputs(self, now):
+        logger      = self.logger
+
+        # ---------------------------------
+        # MQTT commands
+        # ---------------------------------
+        # Acknowledged once their relay is switched
+        acted = []
+        for command in self.commandQueue.take():
+            if command.superseded:
+                self.acknowledge(command, "superseded")
+            elif command.group == "exhaust":
+                self.exhaustRequested = command.state
+                acted.append(command)
+            elif command.group == "water":
+                # A request still waiting for the pump is replaced by the new one
+                if self.waterCommand is not None:
+                    self.acknowledge(self.waterCommand, "superseded")
+                self.waterCommand = command
+
+        # ---------------------------------
+        # Exhaust
+        # ---------------------------------
+        # Currently exhaust is only done manually on MQTT request
+        if self.exhaustRequested != self.runExhaust:
+            # Log requested state
+            if self.exhaustRequested:
+                logger.info("Turning exhaust on")
+            else:
+                logger.info("Turning exhaust off")
+            # Accept requested state
+            self.runExhaust = self.exhaustRequested
         # Upload to MQTT
-        try:
-            topic = mqttTopicOutput + "exhaust"
-            infot = mqttc.publish(topic, str(exhaustRequested), qos=mqttQos)
-            infot.wait_for_publish()
-        except:
-            logger.error("Uploading exhaust state to MQTT didn't work!")
-        # Log requested state
-        if exhaustRequested:
-            logger.info("Turning exhaust on")
-        else:
-            logger.info("Turning exhaust off")
-        # Accept requested state
-        runExhaust = exhaustRequested
-
-    # ---------------------------------
-    # Lighting
-    # ---------------------------------
-    # Lighting is turned on/off purely based on an on and off timer.
-    # Shadow at noon currently unsupported
-    currentHour = datetime.datetime.now().hour
-    runLight    = currentHour >= lightOnTime and currentHour < lightOffTime
-    if runLight != lastRunLight:
+        self.report("exhaust", self.runExhaust, now, retain=True)
+
+        # ---------------------------------
+        # Lighting
+        # ---------------------------------
+        # Lighting is turned on/off purely based on an on and off timer.
+        # Shadow at noon currently unsupported
+        currentHour     = self.hw.now().hour
+        self.runLight   = control.light(currentHour, self.lightOnTime, self.lightOffTime)
+        if self.runLight != self.lastRunLight:
+            # Log requested state
+            if self.runLight:
+                logger.info("Turning light on!")
+            else:
+                logger.info("Turning light off!")
+            # Accept requested state
+            self.lastRunLight = self.runLight
         # Upload to MQTT
-        try:
-            topic = mqttTopicOutput + "runlight"
-            infot = mqttc.publish(topic, str(runLight), qos=mqttQos)
-            infot.wait_for_publish()
-        except:
-            logger.error("Sending light state to MQTT didn't work!")
-        # Log requested state
-        if runLight:
-            logger.info("Turning light on!")
-        else:
-            logger.info("Turning light off!")
-        # Accept requested state
-        lastRunLight = runLight
-
-    # ---------------------------------
-    # Watering
-    # ---------------------------------
-    # Currently watering is only done manually on MQTT request
-    if waterRequested:
-        waterRequested = False
-        GPIO.output(relayWater, True)
-        logger.info("Water pump on")
-        time.sleep(wateringPulseOn) # (Blocking so we don't risk keeping water on)
-        GPIO.output(relayWater, False)
-        logger.info("Water pump off")
-        
-    # #################################
-    # HW Output
-    # #################################
-    GPIO.output(relayLight,     runLight)
-    GPIO.output(relayHeater,    runHeater)
-    GPIO.output(relayExhaust,   runExhaust)
-    GPIO.output(relayCirc,      runFan or runExhaust)
+        self.report("runlight", self.runLight, now, retain=True)
+
+        # ---------------------------------
+        # Watering
+        # ---------------------------------
+        # Currently watering is only done manually on MQTT request.
+        # The request stays pending while the pump has to stay off.
+        if self.waterCommand is not None and actuatorTimer.pulse(self.key + "water", self.wateringPulseOn):
+            acted.append(self.waterCommand)
+            self.waterCommand = None
+
+        # ---------------------------------
+        # Timed actuators
+        # ---------------------------------
+        # Circulation windows and watering pulses are switched by actuatorTimer,
+        # report what it did since the last cycle, then where they are now
+        actuatorTimer.runDue()
+        for name, state in actuatorTimer.popChanges(self.key):
+            name = name[len(self.key):]
+            logger.info("Turning " + name + (" on" if state else " off"))
+            self.report(actuatorTopics[name], state, now, retain=True)
+        for name, topic in actuatorTopics.items():
+            self.report(topic, actuatorTimer.isOn(self.key + name), now, retain=True)
+
+        # #################################
+        # HW Output
+        # #################################
+        with instruments.stage(self.prefix + "gpio/output"), outputLock:
+            self.setRelay("light",     self.runLight)
+            self.setRelay("heater",    self.runHeater)
+            self.setRelay("exhaust",   self.runExhaust)
+            self.setRelay("circ",      control.circ(self.runFan, self.runExhaust))
+
+        for command in acted:
+            self.acknowledge(command, "done")
+
+    #######################################
+    # Seconds until controlOutputs has something to do on its own
+    #######################################
+    def nextControlDeadline(self, now):
+        # Light schedule only changes on the full hour
+        current = datetime.datetime.fromtimestamp(now)
+        nextHour = current.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+        delay = (nextHour - current).total_seconds()
+        # Report timed actuator transitions right when they happen
+        timerDeadline = actuatorTimer.nextDeadline(self.key)
+        if timerDeadline is not None:
+            delay = min(delay, max(timerDeadline - now, 0))
+        # A pending water request is started as soon as the pump may run again,
+        # while the pump is still on its switch off above is the deadline
+        if self.waterCommand is not None:
+            blockedUntil = actuatorTimer.outputs[self.key + "water"].blockedUntil
+            if blockedUntil > now:
+                delay = min(delay, blockedUntil - now)
+        return delay
+
+    #######################################
+    # One full pass over everything that is due
+    #######################################
+    def machineCode(self):
+        # Remember timestamp
+        now = self.hw.time()
+
+        if now > self.lastSensors + self.sensorInterval:
+            self.measureSensors(now)
+        if now > self.lastSlow + self.slowInterval:
+            self.slowStuff(now)
+        self.controlOutputs(now)
+
+        # Confirm this cycle's messages as one batch after the outputs are set
+        self.publisher.flush()
+
+    #######################################
+    # Scheduler tasks
+    #######################################
+    def sensorTask(self, now):
+        with instruments.cycle(self.prefix + "sensors"):
+            self.measureSensors(now)
+            # Act on the new readings right away
+            self.controlOutputs(now)
+            self.publisher.flush()
+
+    def slowTask(self, now):
+        with instruments.cycle(self.prefix + "slow"):
+            self.slowStuff(now)
+            self.publisher.flush()
+
+    def controlTask(self, now):
+        with instruments.cycle(self.prefix + "control"):
+            self.controlOutputs(now)
+            self.publisher.flush()
+        return self.nextControlDeadline(now)
+
+    def energyTask(self, now):
+        # Polls for S0 pulses, history gets energy and power with the other readings
+        if self.energyMeter.collect():
+            power = self.energyMeter.power(now)
+            if power is not None:
+                self.report("power", power, now)
+            self.report("energy", self.energyMeter.total, now)
+            self.publisher.flush()
+        return None
+
+    def discoveryTask(self, now):
+        # Woken when a probe finished, otherwise runs when the next probe is due
+        self.scanSensors()
+        self.publisher.flush()
+        return self.discovery.nextScan()
+
+    def parameterTask(self, now):
+        # Confirm changed values, retained so dashboards get them on connect
+        for name in self.parameterStore.takeChanged():
+            self.publisher.queue("params/" + name, str(self.parameterStore.get(name)), qos=1, retain=True)
+        self.publisher.flush()
+        # Written once updates stopped coming in
+        delay = self.parameterStore.persistIn()
+        if delay == 0:
+            self.parameterStore.persist()
+            return None
+        return delay
+
+    def addTasks(self):
+        # Every task runs once right away and then when it's due
+        prefix = self.prefix
+        taskScheduler.add(prefix + "sensors",   self.sensorTask,    interval=self.sensorInterval)
+        taskScheduler.add(prefix + "slow",      self.slowTask,      interval=self.slowInterval)
+        taskScheduler.add(prefix + "control",   self.controlTask)
+        taskScheduler.add(prefix + "energy",    self.energyTask,    interval=energyPoll)
+        taskScheduler.add(prefix + "discovery", self.discoveryTask)
+        taskScheduler.add(prefix + "parameters", self.parameterTask)
+
+    #######################################
+    # Exit, keep what's not on disk yet
+    #######################################
+    def close(self):
+        self.energyMeter.close()
+        self.parameterStore.persist()
+        self.historyStore.close()
+
+#############################################################################
+##                          Shared by all tents                            ##
+#############################################################################
+#######################################
+# Controllers of all tents, with their parameters loaded
+#######################################
+def tentSetup():
+    global controllers
+    controllers = [Tent(config, primary=(idx == 0)) for idx, config in enumerate(tents)]
+    for tent in controllers:
+        tent.parameterSetup()
+
+#######################################
+# Paho connection established
+#######################################
+def on_connect(client, userdata, flags, rc, properties=None):
+    global mqttOK
+    logger.info("Connection established")
+    for tent in controllers:
+        mqttc.subscribe(tent.topic + mqttTopicInput + "#", qos=1)
+        # Current parameters, retained for dashboards
+        tent.parameterStore.announce()
+        taskScheduler.wake(tent.prefix + "parameters")
+    if haDiscovery:
+        mqttc.subscribe(haStatusTopic, qos=1)
+    mqttOK = True
+    # Retained, replaces the last will of the previous connection
+    mqttc.publish(statusTopic(), "online", qos=1, retain=True)
+    mqttc.publish(controllers[0].topic + mqttTopicOutput + mqttTopicSupervision + "state", supervisionState, qos=1, retain=True)
+    # Send whatever piled up while we were offline
+    taskScheduler.wake("replay")
+    taskScheduler.wake("advertise")
+
+#######################################
+# Paho connection lost
+#######################################
+def on_disconnect(client, userdata, flags, rc, properties=None):
+    global mqttOK
+    logger.error("Connection lost, spooling messages until it's back")
+    mqttOK = False
+
+#######################################
+# Callback on received message, handed to the tent it's for
+#######################################
+def callback(client, userdata, message):
+    topic   = message.topic
+    message = str(message.payload.decode("utf-8"))
+    logger.info("Message received: " + message)
+
+    if topic == haStatusTopic:
+        if message == "online" and advertiser is not None:
+            advertiser.forget()
+            taskScheduler.wake("advertise")
+        return
+    for tent in controllers:
+        inputs = tent.topic + mqttTopicInput
+        if topic.startswith(inputs):
+            tent.handle(topic[len(inputs):], message)
+            return
+
+#######################################
+# Subscription successful
+#######################################
+def on_subscribe(client, userdata, mid, granted_ops, properties=None):
+    logger.info("On subscribe called")
+
+#######################################
+# Paho setup, one connection for all tents
+#######################################
+def pahoSetup():
+    global mqttc, publisher, messageSpool, advertiser
+    mqttc = mqtt.Client(callback_api_version = mqtt.CallbackAPIVersion.VERSION2, client_id=mqttsecrets.ClientId)
+    messageSpool = spool.Spool(spoolPath, maxBytes=spoolMaxBytes, segmentBytes=spoolSegment)
+    # Every tent publishes below its own topic through a mqttpublisher.Prefixed
+    publisher = mqttpublisher.Publisher(
+        mqttc,
+        "",
+        defaultQos      = mqttQos,
+        topicQos        = mqttTopicQos,
+        maxInflight     = mqttMaxInflight,
+        flushTimeout    = mqttFlushTimeout,
+        spool           = messageSpool,
+        instruments     = instruments)
+    for tent in controllers:
+        tent.publisher = mqttpublisher.Prefixed(publisher, tent.topic + mqttTopicOutput)
+    mqttc.on_message = callback
+    mqttc.on_connect = on_connect
+    mqttc.on_disconnect = on_disconnect
+    mqttc.on_subscribe = on_subscribe
+    mqttc.username_pw_set(mqttsecrets.Username, mqttsecrets.Password)
+    mqttc.reconnect_delay_set(min_delay=1, max_delay=mqttReconnect)
+    mqttc.will_set(statusTopic(), "offline", qos=1, retain=True)
+    advertiser = homeassistant.Advertiser(haCachePath, mqttsecrets.Broker + ":" + str(mqttsecrets.Port))
+    # Connects in the background and keeps reconnecting, we don't wait for it
+    mqttc.connect_async(mqttsecrets.Broker, mqttsecrets.Port)
+    # Start the mqtt loop, no intension to ever end
+    mqttc.loop_start()
+
+#######################################
+# Availability of all tents, there's one connection for all of them
+#######################################
+def statusTopic():
+    return controllers[0].topic + mqttTopicStatus
+
+#######################################
+# Regular exit, the broker only sends the last will if we just vanish
+#######################################
+def goOffline():
+    try:
+        mqttc.publish(statusTopic(), "offline", qos=1, retain=True).wait_for_publish(mqttFlushTimeout)
+    except (RuntimeError, ValueError):
+        pass
+    mqttc.disconnect()
+
+#######################################
+# Supervision, called from the supervisor thread while the loop is stalled
+#######################################
+def safeState(outputs=None):
+    # Timed outputs stay off until recoverState()
+    actuatorTimer.hold()
+    # The stalled loop may hold outputLock for good, switch anyway after a second
+    locked = outputLock.acquire(timeout=1)
+    try:
+        for tent in controllers:
+            for name, state in (safeOutputs if outputs is None else outputs).items():
+                if state is None:
+                    continue
+                try:
+                    tent.setRelay(name, state)
+                except Exception:
+                    tent.logger.error("Safe state of " + name + " couldn't be set!")
+    finally:
+        if locked:
+            outputLock.release()
+
+def recoverState():
+    # Timed outputs run again and every tent sets its relays from scratch
+    actuatorTimer.release()
+    for tent in controllers:
+        taskScheduler.wake(tent.prefix + "control")
+
+def supervisionEvent(name, details):
+    global supervisionState
+    supervisionState = "ok" if name == "recovered" else name
+    payload = json.dumps(dict(details, event=name, timestamp=round(time.time(), 3)))
+    logger.warning("Supervision: " + payload)
+    # Straight to paho, the publisher belongs to the stalled loop
+    topic = controllers[0].topic + mqttTopicOutput + mqttTopicSupervision
+    mqttc.publish(topic + "event", payload, qos=1)
+    mqttc.publish(topic + "state", supervisionState, qos=1, retain=True)
+
+#######################################
+# MQTT command while the sensors are read, don't wait for them
+#######################################
+def commandsWhileReading():
+    for tent in controllers:
+        if tent.commandQueue.waiting():
+            tent.controlOutputs(tent.hw.time())
+    publisher.flush()
+
+#######################################
+# Shared scheduler tasks
+#######################################
+def telemetryTask(now):
+    # Stage timings in ms: median and 99th percentile of the last window and max
+    primary = controllers[0].publisher
+    for name, (p50, p99, maximum, count) in instruments.summary().items():
+        if p50 is None:
+            continue
+        primary.queue("telemetry/stages/" + name + "/p50", "{:.2f}".format(p50 * 1000))
+        primary.queue("telemetry/stages/" + name + "/p99", "{:.2f}".format(p99 * 1000))
+        primary.queue("telemetry/stages/" + name + "/max", "{:.2f}".format(maximum * 1000))
+    primary.queue("telemetry/overruns", str(instruments.overruns))
+    # Loop supervision, lateness in s
+    if supervisor is not None:
+        stats = supervisor.stats
+        primary.queue("telemetry/supervision/stalls", str(stats.stalls))
+        primary.queue("telemetry/supervision/safestates", str(stats.safeStates))
+        primary.queue("telemetry/supervision/longeststall", "{:.1f}".format(stats.longestStall))
+        primary.queue("telemetry/supervision/maxlateness", "{:.2f}".format(stats.maxLateness))
+        primary.queue("telemetry/supervision/slowesttask", str(stats.slowestTask))
+        primary.queue("telemetry/supervision/pings", str(stats.pings))
+    for tent in controllers:
+        # Readings held back by the report policies
+        tent.publisher.queue("telemetry/reporting/published", str(tent.reporter.published))
+        tent.publisher.queue("telemetry/reporting/suppressed", str(tent.reporter.suppressed))
+        # MQTT commands, and how many were replaced by a newer one before acting on them
+        tent.publisher.queue("telemetry/commands/received", str(tent.commandQueue.received))
+        tent.publisher.queue("telemetry/commands/coalesced", str(tent.commandQueue.coalesced))
+    publisher.flush()
+
+def advertiseTask(now):
+    # Woken on connect, Home Assistant configs of all tents that changed since they were sent
+    if not haDiscovery or not mqttOK:
+        return None
+    configs = {}
+    for tent in controllers:
+        configs.update(homeassistant.entities(tent, commandMap, mqttsecrets.ClientId, statusTopic()))
+    messages, hashes = advertiser.changes(configs)
+    if not messages:
+        return None
+    failed = sum(not publisher.queue(topic, payload, qos=1, retain=True, prefix=haPrefix) for topic, payload in messages)
+    failed += publisher.flush()
+    if failed:
+        # Nothing counts as sent, all of them again on the next try
+        logger.error(str(failed) + " of " + str(len(messages)) + " discovery configs not sent, trying again in " + str(haRetry) + " s")
+        advertiser.forget()
+        return haRetry
+    advertiser.commit(hashes)
+    logger.info("Sent " + str(len(messages)) + " of " + str(len(configs)) + " discovery configs")
+    return None
+
+def replayTask(now):
+    # Keep going batch by batch while the broker takes them
+    if publisher.replay():
+        return 0
+    return spoolRetry if messageSpool.pending() and mqttOK else None
 
 #############################################################################
 ##                               main()                                    ##
 #############################################################################
 def main():
-    global mqttOK, energyUsed, energyPath
-
-    # Configure logger
-    logging.basicConfig(
-        filename    = logPath,
-        format      = "%(asctime)s | %(levelname)s | %(message)s",
-        datefmt     = "%Y-%m-%d %H:%M:%S",
-        encoding    = "utf-8",
-        level       = logging.DEBUG
-    )
-    logger.addHandler(logging.StreamHandler())
+    global hw, logPipeline, startup, supervisor
+    startup = instrumentation.Phases(instruments)
+
+    # Relays off before anything else, whatever the GPIO defaults left them in.
+    # Drivers are only imported by the backend.
+    with startup.phase("safe"):
+        hw = hwBackend()
+        hw.setupPins(digitalOutputs, digitalInputs)
+        #for pin in pwmOutputs:
+        #    TODO
+
+    # Configure logger, file and console are written by a background thread
+    with startup.phase("logging"):
+        logPipeline = logpipeline.LogPipeline(
+            logPath,
+            level       = logLevel,
+            maxBytes    = logMaxBytes,
+            maxAge      = logMaxAge,
+            backups     = logBackups,
+            burst       = logBurst,
+            window      = logWindow,
+            limitLevel  = logLimitLevel)
+        atexit.register(logPipeline.stop)
 
     logger.info("---------------------")
     logger.info("---Starting  Grass---")
     logger.info("---------------------")
 
-    # Read out remembered energy if present
-    try:
-        with open(energyPath, 'r') as f:
-            energyUsed = float(f.read())
-            logger.info("Read out " + "{:.3f}".format(energyUsed) + " kWh energy used from memory!")
-    except:
-        logger.warning("No energy memory present. Starting at 0kwh!")
-
-    # Paho setup
-    while not mqttOK:
-        try:
-            pahoSetup()
-        except:
-            logger.error("MQTT connection failed! Retrying..")
-        time.sleep(3)
+    # Tents with their parameters, before anything uses them
+    with startup.phase("parameters"):
+        tentSetup()
+        logPipeline.setLevel(logLevel)
 
-    # Sensor setup
-    sensorSetup()
+    with startup.phase("storage"):
+        for tent in controllers:
+            tent.hw = hw
+            # Read out remembered energy if present
+            tent.energySetup()
+            # Local history of all readings
+            tent.historySetup()
+
+    # Paho setup, connects in the background, readings are spooled until the broker answers
+    with startup.phase("mqtt"):
+        # Stage timings for Prometheus
+        if metricsPort is not None:
+            try:
+                instruments.serve(metricsPort)
+            except OSError:
+                logger.error("Metrics port " + str(metricsPort) + " not available!")
+        pahoSetup()
+
+    # Sensors of all tents are probed at once in the background, the first
+    # sensor cycle waits for them
+    with startup.phase("probe"):
+        executor = concurrent.futures.ThreadPoolExecutor(sensorProbeThreads, thread_name_prefix="probe")
+        for tent in controllers:
+            tent.sensorSetup(executor)
+            tent.actuatorSetup()
+        # Probes already submitted still run
+        executor.shutdown(wait=False)
+
+        # Whatever happens to us, SIGTERM included, don't leave the pump or the heater
+        # running. atexit runs these in reverse: timed outputs off, all relays safe,
+        # only then the files of every tent are written (a hanging SD card can't
+        # keep the relays on), then offline.
+        atexit.register(goOffline)
+        for tent in controllers:
+            atexit.register(tent.close)
+        atexit.register(safeState, exitOutputs)
+        atexit.register(actuatorTimer.failSafe)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        actuatorTimer.start()
+
+    # Light schedule and timed actuators don't need to wait for the sensors
+    with startup.phase("control"):
+        for tent in controllers:
+            tent.controlOutputs(hw.time())
+    logger.info("Startup: " + startup.summary() + ", first control decision after "
+        + "{:.0f}".format(startup.elapsed * 1000) + " ms")
+
+    # Machine code, every task runs once right away and then when it's due
+    for tent in controllers:
+        tent.addTasks()
+    taskScheduler.add("replay",  replayTask)
+    taskScheduler.add("advertise", advertiseTask)
+    taskScheduler.add("telemetry", telemetryTask, interval=telemetryInterval)
 
-    # Machine code
-    while(1):
-        machineCode()
-        time.sleep(1)
+    # Watches the loop from its own thread, tells systemd we're ready and pings its watchdog
+    supervisor = supervision.Supervisor(
+        taskScheduler,
+        stallAfter  = stallAfter,
+        safeAfter   = safeAfter,
+        safeState   = safeState,
+        recover     = recoverState,
+        onEvent     = supervisionEvent)
+    atexit.register(supervisor.stop)
+    supervisor.start()
+    taskScheduler.runForever()
 
 
 #############################################################################
@@ -0,0 +1,153 @@
+#############################################################################
+##                       Hardware abstraction layer                        ##
+#############################################################################
+# Everything grass.py needs from the outside world goes through a backend:
+# GPIO, the I2C sensors, 1-Wire, sysfs and the clock. PiPlcBackend talks to
+# the real hardware, simulation.SimBackend to a modelled grow box so the
+# control logic can run on any Linux machine.
+
+import os
+import abc
+import glob
+import time
+import datetime
+
+#######################################
+# Backend interface
+#######################################
+class Backend(abc.ABC):
+    # Clock
+    @abc.abstractmethod
+    def time(self):
+        ...
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.time())
+
+    # GPIO
+    @abc.abstractmethod
+    def setupPins(self, outputs, inputs):
+        ...
+
+    @abc.abstractmethod
+    def output(self, pin, state):
+        ...
+
+    @abc.abstractmethod
+    def onFallingEdge(self, pin, callback, bouncetime):
+        ...
+
+    # I2C sensors, raise if the device can't be found
+    @abc.abstractmethod
+    def i2c(self, channel=None):
+        # Bus, or channel of the TCA9548A multiplexer
+        ...
+
+    @abc.abstractmethod
+    def soilSensor(self, bus, address):
+        ...
+
+    @abc.abstractmethod
+    def lightSensor(self, bus):
+        ...
+
+    @abc.abstractmethod
+    def airSensor(self, bus):
+        ...
+
+    # 1-Wire
+    @abc.abstractmethod
+    def findOneWire(self, serial=None):
+        # Path of the DS18B20 with serial (28-...), or of the first one, None if there is none
+        ...
+
+    @abc.abstractmethod
+    def readOneWire(self, path):
+        # Temperature in °C
+        ...
+
+    # sysfs / OS
+    @abc.abstractmethod
+    def readThermal(self):
+        # SOC temperature in °C
+        ...
+
+    @abc.abstractmethod
+    def diskUsage(self, path):
+        # (size, free) in bytes
+        ...
+
+#######################################
+# PiPLC / Raspberry Pi hardware
+#######################################
+class PiPlcBackend(Backend):
+    ONE_WIRE_PATH   = "/sys/bus/w1/devices/"
+    THERMAL_PATH    = "/sys/class/thermal/thermal_zone0/temp"
+
+    def __init__(self):
+        # Drivers are only imported once we know we're on the real thing
+        import RPi.GPIO as GPIO
+        self.GPIO   = GPIO
+        self.bus    = None
+        self.mux    = None
+
+    def time(self):
+        return time.time()
+
+    def setupPins(self, outputs, inputs):
+        GPIO = self.GPIO
+        GPIO.setmode(GPIO.BCM)
+        for pin in outputs:
+            GPIO.setup(pin, GPIO.OUT, initial=GPIO.LOW)
+        for pin in inputs:
+            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+    def output(self, pin, state):
+        self.GPIO.output(pin, state)
+
+    def onFallingEdge(self, pin, callback, bouncetime):
+        self.GPIO.add_event_detect(
+            pin,
+            edge = self.GPIO.FALLING,
+            callback = callback,
+            bouncetime = bouncetime)
+
+    def i2c(self, channel=None):
+        import board
+        if self.bus is None:
+            self.bus = board.I2C()
+        if channel is None:
+            return self.bus
+        # Sensors of every tent have the same addresses, each tent gets a multiplexer channel
+        if self.mux is None:
+            import adafruit_tca9548a
+            self.mux = adafruit_tca9548a.TCA9548A(self.bus)
+        return self.mux[channel]
+
+    def soilSensor(self, bus, address):
+        from adafruit_seesaw.seesaw import Seesaw
+        return Seesaw(bus, addr=address)
+
+    def lightSensor(self, bus):
+        import adafruit_bh1750
+        return adafruit_bh1750.BH1750(bus)
+
+    def airSensor(self, bus):
+        import adafruit_ahtx0
+        return adafruit_ahtx0.AHTx0(bus)
+
+    def findOneWire(self, serial=None):
+        folders = sorted(glob.glob(self.ONE_WIRE_PATH + (serial if serial is not None else '28*')))
+        return folders[0] + '/temperature' if folders else None
+
+    def readOneWire(self, path):
+        with open(path, 'r') as f:
+            return float(f.read()) / 1000.0
+
+    def readThermal(self):
+        with open(self.THERMAL_PATH, 'r') as f:
+            return float(f.read()) / 1000
+
+    def diskUsage(self, path):
+        statvfs = os.statvfs(path)
+        return statvfs.f_frsize * statvfs.f_blocks, statvfs.f_frsize * statvfs.f_bavail
@@ -0,0 +1,246 @@
+#############################################################################
+##                           Local history                                 ##
+#############################################################################
+# Embedded time series store for all measured channels. Every channel keeps
+# one ring buffer file per tier (raw readings, 1 min and 1 h rollups), each
+# memory-mapped so appending and querying a window only touches the pages
+# involved instead of loading whole files. The ring size of a tier is its
+# retention, older data is overwritten. Rollup buckets still being filled
+# are written on close() and picked up again by the next start.
+
+import os
+import mmap
+import math
+import struct
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MAGIC       = b"GRTS"
+FILE_HEADER = struct.Struct("<4sIQQ")   # magic | record size | capacity | records written
+RAW         = struct.Struct("<df")      # timestamp | value
+ROLLUP      = struct.Struct("<dfffI")   # bucket start | mean | min | max | sample count
+
+# (name, resolution in s, retention in s), resolution 0 is the raw tier
+DEFAULT_TIERS = [
+    ("raw", 0,      7 * 24 * 3600),
+    ("1m",  60,     30 * 24 * 3600),
+    ("1h",  3600,   2 * 365 * 24 * 3600),
+]
+
+#######################################
+# Memory-mapped ring of fixed size records
+#######################################
+class Ring:
+    def __init__(self, path, record, capacity):
+        self.record     = record
+        exists          = os.path.exists(path)
+        self.file       = open(path, 'r+b' if exists else 'w+b')
+        if exists:
+            magic, recordSize, capacity, written = FILE_HEADER.unpack(self.file.read(FILE_HEADER.size))
+            if magic != MAGIC or recordSize != record.size:
+                raise ValueError("Not a history file: " + path)
+        else:
+            written = 0
+            self.file.write(FILE_HEADER.pack(MAGIC, record.size, capacity, 0))
+            self.file.truncate(FILE_HEADER.size + capacity * record.size)
+        self.capacity   = capacity
+        self.written    = written
+        self.map        = mmap.mmap(self.file.fileno(), 0)
+
+    def offset(self, index):
+        return FILE_HEADER.size + (index % self.capacity) * self.record.size
+
+    def first(self):
+        return max(0, self.written - self.capacity)
+
+    def get(self, index):
+        return self.record.unpack_from(self.map, self.offset(index))
+
+    def timestamp(self, index):
+        return struct.unpack_from("<d", self.map, self.offset(index))[0]
+
+    def append(self, *values):
+        self.record.pack_into(self.map, self.offset(self.written), *values)
+        self.written += 1
+        FILE_HEADER.pack_into(self.map, 0, MAGIC, self.record.size, self.capacity, self.written)
+
+    def dropLast(self):
+        # The last record is written again, e.g. a rollup bucket that got more samples
+        self.written -= 1
+        FILE_HEADER.pack_into(self.map, 0, MAGIC, self.record.size, self.capacity, self.written)
+
+    def lastTimestamp(self):
+        return self.timestamp(self.written - 1) if self.written else None
+
+    #######################################
+    # First index with timestamp >= t, by bisection over the ring
+    #######################################
+    def bisect(self, t):
+        low, high = self.first(), self.written
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < t:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def window(self, start, end):
+        return [self.get(i) for i in range(self.bisect(start), self.bisect(end))]
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+#######################################
+# Rollup bucket being filled
+#######################################
+class Bucket:
+    __slots__ = ("start", "sum", "min", "max", "count")
+
+    def __init__(self, start):
+        self.start  = start
+        self.sum    = 0.0
+        self.min    = math.inf
+        self.max    = -math.inf
+        self.count  = 0
+
+    @classmethod
+    def restore(cls, record):
+        start, mean, low, high, count = record
+        bucket          = cls(start)
+        bucket.sum      = mean * count
+        bucket.min      = low
+        bucket.max      = high
+        bucket.count    = count
+        return bucket
+
+    def add(self, value):
+        self.sum   += value
+        self.min    = min(self.min, value)
+        self.max    = max(self.max, value)
+        self.count += 1
+
+class History:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, path, tiers=None, rawInterval=60):
+        self.path           = path
+        self.tiers          = tiers or DEFAULT_TIERS
+        self.rawInterval    = rawInterval   # Expected seconds between raw samples, sizes the raw ring
+        self.rings          = {}            # (channel, tier) -> Ring
+        self.buckets        = {}            # (channel, tier) -> Bucket
+        self.lock           = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    #######################################
+    # Ring of a channel, opened on first use
+    #######################################
+    def ring(self, channel, tier):
+        key = (channel, tier)
+        ring = self.rings.get(key)
+        if ring is None:
+            name, resolution, retention = tier
+            fileName = channel.replace("/", "_") + "." + name + ".ts"
+            if resolution:
+                ring = Ring(os.path.join(self.path, fileName), ROLLUP, retention // resolution)
+            else:
+                ring = Ring(os.path.join(self.path, fileName), RAW, retention // self.rawInterval)
+            self.rings[key] = ring
+        return ring
+
+    #######################################
+    # Store a reading
+    #######################################
+    def append(self, channel, timestamp, value):
+        if value is None:
+            return
+        value = float(value)
+        with self.lock:
+            for tier in self.tiers:
+                name, resolution, retention = tier
+                if not resolution:
+                    ring = self.ring(channel, tier)
+                    last = ring.lastTimestamp()
+                    if last is not None and timestamp <= last:
+                        # Clock went backwards, keep the ring ordered
+                        return
+                    ring.append(timestamp, value)
+                    continue
+
+                # Rollups are written once their bucket is complete
+                start   = timestamp - timestamp % resolution
+                bucket  = self.buckets.get((channel, name))
+                if bucket is not None and bucket.start != start:
+                    self.ring(channel, tier).append(bucket.start, bucket.sum / bucket.count, bucket.min, bucket.max, bucket.count)
+                    bucket = None
+                if bucket is None:
+                    # Written partly by close() before a restart, continue it
+                    ring = self.ring(channel, tier)
+                    if ring.lastTimestamp() == start:
+                        bucket = Bucket.restore(ring.get(ring.written - 1))
+                        ring.dropLast()
+                    else:
+                        bucket = Bucket(start)
+                    self.buckets[(channel, name)] = bucket
+                bucket.add(value)
+
+    #######################################
+    # Readings between start and end
+    #######################################
+    def query(self, channel, start, end, tier=None, maxPoints=1000):
+        # Without a tier the finest one still covering start in at most
+        # maxPoints records is picked. Returns (tier name, records), records
+        # are (timestamp, value) for raw and (start, mean, min, max, count)
+        # for rollups.
+        with self.lock:
+            if tier is None:
+                tier = self.pickTier(channel, start, end, maxPoints)
+            else:
+                tier = next(t for t in self.tiers if t[0] == tier)
+            return tier[0], self.ring(channel, tier).window(start, end)
+
+    def pickTier(self, channel, start, end, maxPoints):
+        for tier in self.tiers:
+            name, resolution, retention = tier
+            ring = self.ring(channel, tier)
+            if ring.written == 0:
+                continue
+            covered = ring.timestamp(ring.first()) <= start or ring.written < ring.capacity
+            points  = (end - start) / (resolution or self.rawInterval)
+            if covered and points <= maxPoints:
+                return tier
+        return self.tiers[-1]
+
+    #######################################
+    # Channels with data on disk
+    #######################################
+    def channels(self):
+        raw = self.tiers[0][0]
+        suffix = "." + raw + ".ts"
+        return sorted(f[:-len(suffix)].replace("_", "/") for f in os.listdir(self.path) if f.endswith(suffix))
+
+    #######################################
+    # Write dirty pages, called now and then
+    #######################################
+    def flush(self):
+        with self.lock:
+            for ring in self.rings.values():
+                ring.flush()
+
+    def close(self):
+        with self.lock:
+            # Buckets still being filled, continued on the next start
+            for (channel, name), bucket in self.buckets.items():
+                tier = next(t for t in self.tiers if t[0] == name)
+                self.ring(channel, tier).append(bucket.start, bucket.sum / bucket.count, bucket.min, bucket.max, bucket.count)
+            self.buckets = {}
+            for ring in self.rings.values():
+                ring.close()
+            self.rings = {}
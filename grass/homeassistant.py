@@ -0,0 +1,200 @@
+#############################################################################
+##                    Home Assistant MQTT discovery                        ##
+#############################################################################
+# Discovery configs for everything a tent exposes: readings as sensors,
+# relays and sensor states as binary sensors, commands as buttons and the
+# runtime parameters as number / select entities writing to their input
+# topic. All entities share the availability topic of the connection, which
+# the broker sets to "offline" as last will.
+#
+# Configs are sent retained, so Home Assistant gets them from the broker
+# whenever it starts. The hash of every config sent is kept in a small cache
+# file and a config is only sent again once it changed, reconnects send
+# nothing but "online". Entities that are gone are deleted with an empty
+# retained config. Deleting the cache file sends everything again, and so
+# does Home Assistant announcing "online" on its status topic, in case the
+# broker lost the retained configs.
+
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Readings: (channel below the output topic, name, device class, unit, state class)
+SENSORS = [
+    ("airtemp",     "Air temperature",      "temperature",  "°C",   "measurement"),
+    ("airhum",      "Air humidity",         "humidity",     "%",    "measurement"),
+    ("watertemp",   "Water temperature",    "temperature",  "°C",   "measurement"),
+    ("brightness",  "Brightness",           "illuminance",  "lx",   "measurement"),
+    ("energy",      "Energy",               "energy",       "kWh",  "total_increasing"),
+    ("power",       "Power",                "power",        "W",    "measurement"),
+]
+# Of the Pi itself, only with the first tent
+TELEMETRY = [
+    ("telemetry/soctemp",   "SOC temperature",  "temperature",  "°C",   "measurement"),
+    ("telemetry/fspercent", "Disk used",        None,           "%",    "measurement"),
+]
+# Relays as published on change: (channel, name)
+RELAYS = [
+    ("runlight",    "Light"),
+    ("runheater",   "Heater"),
+    ("exhaust",     "Exhaust"),
+    ("runfan",      "Circulation"),
+    ("runwater",    "Water"),
+]
+SENSOR_STATES = ["soil", "light", "air"]
+
+#######################################
+# All configs of a tent, {config topic below the discovery prefix: config}
+#######################################
+def entities(tent, commands, clientId, statusTopic):
+    node    = clientId + "_" + tent.name
+    output  = tent.topic + "outputs/"
+    inputs  = tent.topic + "inputs/"
+    device  = {
+        "identifiers"   : [node],
+        "name"          : "Grass " + tent.name,
+        "manufacturer"  : "Grass",
+        "model"         : "PiPLC",
+    }
+    configs = {}
+
+    def add(component, objectId, config):
+        objectId = objectId.replace("/", "_")
+        config.update({
+            "unique_id"             : node + "_" + objectId,
+            "object_id"             : node + "_" + objectId,
+            "device"                : device,
+            "availability_topic"    : statusTopic,
+        })
+        configs[component + "/" + node + "/" + objectId + "/config"] = config
+
+    def sensor(channel, name, deviceClass, unit, stateClass, category=None):
+        config = {"name": name, "state_topic": output + channel, "unit_of_measurement": unit, "state_class": stateClass}
+        if deviceClass is not None:
+            config["device_class"] = deviceClass
+        if category is not None:
+            config["entity_category"] = category
+        add("sensor", channel, config)
+
+    # Readings
+    for idx in range(len(tent.soilAddresses)):
+        sensor("bucketmoists/" + str(idx), "Bucket " + str(idx) + " moisture", None, None, "measurement")
+        sensor("buckettemps/" + str(idx), "Bucket " + str(idx) + " temperature", "temperature", "°C", "measurement")
+    for entry in SENSORS:
+        sensor(*entry)
+    if tent.primary:
+        for entry in TELEMETRY:
+            sensor(*entry, category="diagnostic")
+
+    # Relays and sensor states
+    for channel, name in RELAYS:
+        add("binary_sensor", channel, {
+            "name"          : name,
+            "state_topic"   : output + channel,
+            "payload_on"    : "True",
+            "payload_off"   : "False",
+            "device_class"  : "running",
+        })
+    for name in SENSOR_STATES:
+        add("binary_sensor", "sensorstates/" + name, {
+            "name"              : name.capitalize() + " sensor",
+            "state_topic"       : output + "sensorstates/" + name,
+            "payload_on"        : "True",
+            "payload_off"       : "False",
+            "device_class"      : "connectivity",
+            "entity_category"   : "diagnostic",
+        })
+
+    # Commands, any topic below inputs/ that isn't a parameter takes them
+    for name in commands:
+        add("button", "command/" + name, {
+            "name"          : name,
+            "command_topic" : inputs + "command",
+            "payload_press" : name,
+        })
+
+    # Parameters, the value in use is published retained below params/
+    for name, parameter in tent.parameterStore.parameters.items():
+        config = {
+            "name"              : name,
+            "state_topic"       : output + "params/" + name,
+            "command_topic"     : inputs + "params/" + name,
+            "entity_category"   : "config",
+        }
+        if parameter.choices is not None:
+            config["options"] = [str(choice) for choice in parameter.choices]
+            add("select", "params/" + name, config)
+            continue
+        if parameter.kind is bool:
+            config.update({"payload_on": "True", "payload_off": "False", "state_on": "True", "state_off": "False"})
+            add("switch", "params/" + name, config)
+            continue
+        if parameter.kind is str:
+            add("text", "params/" + name, config)
+            continue
+        config["mode"] = "box"
+        config["step"] = 1 if parameter.kind is int else 0.1
+        if parameter.minimum is not None:
+            config["min"] = parameter.minimum
+        if parameter.maximum is not None:
+            config["max"] = parameter.maximum
+        add("number", "params/" + name, config)
+    return configs
+
+class Advertiser:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, cachePath, broker):
+        self.cachePath  = cachePath
+        self.broker     = broker    # Cached hashes only count for the broker they were sent to
+        self.hashes     = {}        # Config topic -> hash of the config sent
+        self.forgotten  = False     # Send everything on the next changes()
+        try:
+            with open(cachePath) as f:
+                cache = json.load(f)
+            if cache.get("broker") == broker:
+                self.hashes = cache["configs"]
+        except (OSError, ValueError, KeyError):
+            logger.info("No discovery cache for " + broker + ", sending all configs")
+
+    #######################################
+    # Messages to send for these configs: changed and new ones, empty ones
+    # for configs that are gone. Returns them with the hashes to commit()
+    # once the broker took them all.
+    #######################################
+    def changes(self, configs):
+        messages = []
+        hashes   = {}
+        resend, self.forgotten = self.forgotten, False
+        for topic, config in sorted(configs.items()):
+            payload = json.dumps(config, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+            digest  = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+            hashes[topic] = digest
+            if resend or self.hashes.get(topic) != digest:
+                messages.append((topic, payload))
+        for topic in sorted(set(self.hashes) - set(hashes)):
+            messages.append((topic, ""))
+        return messages, hashes
+
+    def commit(self, hashes):
+        self.hashes = hashes
+        self.persist()
+
+    #######################################
+    # Send all configs again on the next changes(), safe from any thread
+    #######################################
+    def forget(self):
+        self.forgotten = True
+
+    def persist(self):
+        tmpPath = self.cachePath + ".tmp"
+        try:
+            with open(tmpPath, 'w') as f:
+                json.dump({"broker": self.broker, "configs": self.hashes}, f, indent=1, sort_keys=True)
+            os.replace(tmpPath, self.cachePath)
+        except OSError:
+            logger.error("Writing the discovery cache " + self.cachePath + " didn't work!")
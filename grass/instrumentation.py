@@ -0,0 +1,305 @@
+#############################################################################
+##                           Instrumentation                               ##
+#############################################################################
+# Per stage timing of the control loop. Every stage (sensor reads, MQTT,
+# energy persistence, GPIO output, setup) feeds a histogram with fixed,
+# exponentially growing buckets, so recording a sample is a bisect and two
+# increments. Quantiles are taken over a rolling window, the lifetime
+# totals are served in Prometheus text format.
+#
+# Optionally a sampling profiler watches the control thread while a cycle
+# runs and keeps the collected stacks of cycles that went over budget.
+
+import os
+import sys
+import time
+import bisect
+import logging
+import threading
+import collections
+
+logger = logging.getLogger(__name__)
+
+# Bucket upper bounds in seconds, 50 µs doubling up to ~52 s
+BOUNDS = [50e-6 * 2 ** k for k in range(21)]
+
+#######################################
+# Rolling histogram
+#######################################
+class Histogram:
+    __slots__ = ("counts", "previous", "total", "sum", "max", "previousMax", "windowStart")
+
+    def __init__(self, now):
+        self.counts     = [0] * (len(BOUNDS) + 1)   # Current window, last bucket is +Inf
+        self.previous   = [0] * (len(BOUNDS) + 1)   # Window before
+        self.total      = [0] * (len(BOUNDS) + 1)   # Since start, for Prometheus
+        self.sum        = 0.0
+        self.max        = 0.0   # Of the current window
+        self.previousMax = 0.0
+        self.windowStart = now
+
+    def add(self, seconds):
+        idx = bisect.bisect_left(BOUNDS, seconds)
+        self.counts[idx] += 1
+        self.total[idx] += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def rotate(self, now):
+        self.previous       = self.counts
+        self.counts         = [0] * (len(BOUNDS) + 1)
+        self.windowStart    = now
+        self.previousMax    = self.max
+        self.max            = 0.0
+
+    def maximum(self):
+        return max(self.max, self.previousMax)
+
+    def quantile(self, q):
+        counts = [a + b for a, b in zip(self.counts, self.previous)]
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        for idx, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                # Bucket bound, but never more than was actually seen
+                return min(BOUNDS[idx], self.maximum()) if idx < len(BOUNDS) else self.maximum()
+        return self.maximum()
+
+    def count(self):
+        return sum(self.total)
+
+#######################################
+# Sampling profiler for the control thread
+#######################################
+class Profiler:
+    def __init__(self, interval=0.005):
+        self.interval   = interval
+        self.active     = threading.Event()
+        self.stacks     = collections.Counter()
+        self.threadId   = None
+        self.lock       = threading.Lock()  # Guards stacks, the sampler may be halfway through a sample
+        threading.Thread(target=self.run, name="profiler", daemon=True).start()
+
+    def start(self):
+        with self.lock:
+            self.stacks     = collections.Counter()
+            self.threadId   = threading.get_ident()
+            self.active.set()
+
+    def stop(self):
+        # A copy, samples finishing after this don't count
+        with self.lock:
+            self.active.clear()
+            return collections.Counter(self.stacks)
+
+    def run(self):
+        while True:
+            self.active.wait()
+            frame = sys._current_frames().get(self.threadId)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(os.path.basename(code.co_filename) + ":" + code.co_name + ":" + str(frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                with self.lock:
+                    if self.active.is_set():
+                        self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+#######################################
+# Stage timer context
+#######################################
+class Stage:
+    __slots__ = ("instruments", "name", "start")
+
+    def __init__(self, instruments, name):
+        self.instruments    = instruments
+        self.name           = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.instruments.record(self.name, time.perf_counter() - self.start)
+        return False
+
+#######################################
+# Startup, phases timed one after the other
+#######################################
+class Phases:
+    def __init__(self, instruments):
+        self.instruments    = instruments
+        self.start          = time.perf_counter()
+        self.durations      = {}    # Phase -> seconds, in order
+        self.elapsed        = None  # Seconds from start to the end of the last phase
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def done(self, name, seconds):
+        self.durations[name] = seconds
+        self.elapsed = time.perf_counter() - self.start
+        self.instruments.record("startup/" + name, seconds)
+
+    def summary(self):
+        return ", ".join(name + " " + "{:.0f}".format(seconds * 1000) + " ms" for name, seconds in self.durations.items())
+
+class Phase:
+    __slots__ = ("phases", "name", "start")
+
+    def __init__(self, phases, name):
+        self.phases = phases
+        self.name   = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.phases.done(self.name, time.perf_counter() - self.start)
+        return False
+
+class Instruments:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, window=600, cycleBudget=2.0, profileOnOverrun=False, profilePath=None):
+        self.window             = window            # Seconds per rolling window
+        self.cycleBudget        = cycleBudget       # Seconds a cycle may take before it counts as overrun
+        self.profileOnOverrun   = profileOnOverrun  # Sample stacks of cycles and keep the slow ones
+        self.profilePath        = profilePath       # Folder for collapsed stack files, None to only log
+        self.histograms         = {}
+        self.lock               = threading.Lock()
+        self.profiler           = Profiler() if profileOnOverrun else None
+        self.overruns           = 0
+
+    #######################################
+    # Recording
+    #######################################
+    def record(self, name, seconds):
+        now = time.monotonic()
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = Histogram(now)
+                self.histograms[name] = histogram
+            elif now - histogram.windowStart > self.window:
+                histogram.rotate(now)
+            histogram.add(seconds)
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def timed(self, name, function):
+        # Wraps function so every call is recorded under name
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    #######################################
+    # A whole control cycle, profiled if enabled
+    #######################################
+    def cycle(self, name):
+        return Cycle(self, name)
+
+    def cycleDone(self, name, seconds, stacks):
+        self.record("cycle/" + name, seconds)
+        if seconds <= self.cycleBudget:
+            return
+        self.overruns += 1
+        logger.warning("Cycle " + name + " took " + "{:.0f}".format(seconds * 1000) + " ms, over budget!")
+        if not stacks:
+            return
+        for stack, count in stacks.most_common(3):
+            logger.warning("  " + str(count) + " samples in " + stack.split(";")[-1])
+        if self.profilePath is not None:
+            os.makedirs(self.profilePath, exist_ok=True)
+            fileName = os.path.join(self.profilePath, time.strftime("%Y%m%d-%H%M%S") + "-" + name + ".txt")
+            with open(fileName, 'w') as f:
+                for stack, count in stacks.items():
+                    f.write(stack + " " + str(count) + "\n")
+
+    #######################################
+    # Summary per stage, quantiles in seconds
+    #######################################
+    def summary(self):
+        with self.lock:
+            return {name: (h.quantile(0.5), h.quantile(0.99), h.maximum(), h.count()) for name, h in self.histograms.items()}
+
+    #######################################
+    # Prometheus text exposition
+    #######################################
+    def prometheus(self):
+        lines = [
+            "# HELP grass_stage_seconds Time spent in a stage of the control loop",
+            "# TYPE grass_stage_seconds histogram",
+        ]
+        with self.lock:
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                cumulative = 0
+                for idx, count in enumerate(histogram.total):
+                    cumulative += count
+                    le = "%g" % BOUNDS[idx] if idx < len(BOUNDS) else "+Inf"
+                    lines.append('grass_stage_seconds_bucket{stage="%s",le="%s"} %d' % (name, le, cumulative))
+                lines.append('grass_stage_seconds_sum{stage="%s"} %f' % (name, histogram.sum))
+                lines.append('grass_stage_seconds_count{stage="%s"} %d' % (name, cumulative))
+        lines.append("# TYPE grass_cycle_overruns_total counter")
+        lines.append("grass_cycle_overruns_total %d" % self.overruns)
+        return "\n".join(lines) + "\n"
+
+    #######################################
+    # Local /metrics endpoint
+    #######################################
+    def serve(self, port, host="0.0.0.0"):
+        # Imported here, it's a good part of our import time
+        import http.server
+        instruments = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = instruments.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        logger.info("Serving metrics on port " + str(port))
+        return server
+
+class Cycle:
+    __slots__ = ("instruments", "name", "start")
+
+    def __init__(self, instruments, name):
+        self.instruments    = instruments
+        self.name           = name
+
+    def __enter__(self):
+        if self.instruments.profiler is not None:
+            self.instruments.profiler.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        seconds = time.perf_counter() - self.start
+        stacks = self.instruments.profiler.stop() if self.instruments.profiler is not None else None
+        self.instruments.cycleDone(self.name, seconds, stacks)
+        return False
@@ -0,0 +1,154 @@
+#############################################################################
+##                           Logging pipeline                              ##
+#############################################################################
+# Keeps log I/O out of the control loop. Records are only put on a queue by
+# the calling thread, a listener thread formats them and writes them to the
+# console and to a log file that is rotated by size and age, old files are
+# gzipped. Warnings and errors repeating more than burst times within
+# window seconds are dropped and summed up once they show up again in a
+# later window. The message that starts dropping is marked with
+# SUPPRESSED, so tools reading the log can tell it has gaps. INFO and
+# below (readings, relay switches) are never dropped, replay.py needs them.
+# The level can be changed at runtime through setLevel().
+
+import os
+import gzip
+import time
+import queue
+import shutil
+import logging
+import threading
+import logging.handlers
+
+LEVELS      = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+SUPPRESSED  = " (repeats suppressed for {:.0f} s)"   # Appended to the first message dropped, which is let through
+
+#######################################
+# Drops repeating messages
+#######################################
+class RateLimiter(logging.Filter):
+    def __init__(self, burst=5, window=300, maxKeys=1000, minLevel=logging.WARNING, clock=time.monotonic):
+        super().__init__()
+        self.burst      = burst     # Identical messages let through per window
+        self.minLevel   = minLevel  # Messages below aren't limited
+        self.window     = window    # Seconds
+        self.maxKeys    = maxKeys   # Distinct messages remembered before expired ones are forgotten
+        self.clock      = clock
+        self.seen       = {}        # (logger, level, message) -> [window start, count, suppressed]
+        # Filters run in every logging thread, before the queue
+        self.lock       = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.minLevel:
+            return True
+        now = self.clock()
+        message = record.getMessage()
+        key = (record.name, record.levelno, message)
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is None:
+                if len(self.seen) >= self.maxKeys:
+                    self.prune(now)
+                self.seen[key] = [now, 1, 0]
+                return True
+
+            if now - entry[0] >= self.window:
+                suppressed = entry[2]
+                entry[:] = [now, 1, 0]
+            else:
+                entry[1] += 1
+                if entry[1] <= self.burst:
+                    return True
+                entry[2] += 1
+                if entry[2] > 1:
+                    return False
+                # The first one dropped goes through as the marker of the gap
+                record.msg  = message + SUPPRESSED.format(self.window - (now - entry[0]))
+                record.args = None
+                return True
+        if suppressed > 1:
+            record.msg  = message + " (repeated " + str(suppressed - 1) + " more times before)"
+            record.args = None
+        return True
+
+    def prune(self, now):
+        # Called with the lock held
+        for key in [key for key, entry in self.seen.items() if now - entry[0] >= self.window]:
+            del self.seen[key]
+
+#######################################
+# Rotates by size and age, compresses old files
+#######################################
+class CompressingFileHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, filename, maxBytes=0, maxAge=None, backupCount=0, encoding=None):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount, encoding=encoding)
+        self.maxAge     = maxAge    # Seconds a file is written to before it's rotated, None for size only
+        self.rolloverAt = self.nextRollover()
+        self.namer      = lambda name: name + ".gz"
+        self.rotator    = self.compress
+
+    def nextRollover(self):
+        return time.time() + self.maxAge if self.maxAge else None
+
+    def shouldRollover(self, record):
+        if self.rolloverAt is not None and time.time() >= self.rolloverAt:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rolloverAt = self.nextRollover()
+
+    @staticmethod
+    def compress(source, dest):
+        with open(source, 'rb') as f, gzip.open(dest, 'wb') as g:
+            shutil.copyfileobj(f, g)
+        os.remove(source)
+
+class LogPipeline:
+    #######################################
+    # Init, takes over the root logger
+    #######################################
+    def __init__(self, path, level="INFO", maxBytes=5 * 1024 * 1024, maxAge=7 * 24 * 3600, backups=8, burst=5, window=300,
+                 limitLevel="WARNING", console=True):
+        formatter = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+        handlers = []
+        fileHandler = CompressingFileHandler(path, maxBytes=maxBytes, maxAge=maxAge, backupCount=backups, encoding="utf-8")
+        fileHandler.setFormatter(formatter)
+        handlers.append(fileHandler)
+        if console:
+            streamHandler = logging.StreamHandler()
+            streamHandler.setFormatter(formatter)
+            handlers.append(streamHandler)
+
+        self.limiter    = RateLimiter(burst=burst, window=window, minLevel=logging.getLevelName(limitLevel))
+        self.queue      = queue.SimpleQueue()
+        queueHandler    = logging.handlers.QueueHandler(self.queue)
+        queueHandler.addFilter(self.limiter)
+        self.listener   = logging.handlers.QueueListener(self.queue, *handlers)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queueHandler)
+        self.setLevel(level)
+        self.listener.start()
+
+    #######################################
+    # Change the level of everything, returns False for unknown levels
+    #######################################
+    def setLevel(self, level):
+        level = str(level).strip().upper()
+        if level not in LEVELS:
+            return False
+        logging.getLogger().setLevel(level)
+        return True
+
+    def level(self):
+        return logging.getLevelName(logging.getLogger().level)
+
+    #######################################
+    # Write out what's still queued
+    #######################################
+    def stop(self):
+        self.listener.stop()
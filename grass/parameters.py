@@ -0,0 +1,184 @@
+#############################################################################
+##                          Runtime parameters                             ##
+#############################################################################
+# Typed store for the control parameters. Every parameter is bound to an
+# attribute of a target (the grass module), so the control loop keeps
+# reading plain globals. Values come from defaults, then a JSON config file,
+# then MQTT at runtime. Updates are validated, written to the target right
+# away and persisted to the config file once no further update came in for
+# debounce seconds, written atomically so a power cut leaves either the
+# old or the new file.
+
+import os
+import json
+import math
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# A single typed parameter
+#######################################
+class Parameter:
+    __slots__ = ("name", "kind", "value", "minimum", "maximum", "choices", "onChange", "target")
+
+    def __init__(self, name, kind, value, minimum=None, maximum=None, choices=None, onChange=None, target=None):
+        self.name       = name
+        self.kind       = kind      # int, float, bool or str
+        self.value      = value
+        self.minimum    = minimum
+        self.maximum    = maximum
+        self.choices    = choices   # Allowed values, None for any
+        self.onChange   = onChange  # Called with the new value after runtime updates
+        self.target     = target    # Object the value is written to as attribute
+
+    #######################################
+    # Raw value from MQTT or the config file to a checked value, raises ValueError
+    #######################################
+    def convert(self, raw):
+        if isinstance(raw, bytes):
+            raw = raw.decode("utf-8")
+        if isinstance(raw, str):
+            raw = raw.strip()
+        if self.kind is bool:
+            if isinstance(raw, str):
+                if raw.lower() not in ("true", "false", "1", "0", "on", "off"):
+                    raise ValueError(self.name + " must be true or false")
+                value = raw.lower() in ("true", "1", "on")
+            else:
+                value = bool(raw)
+        elif self.kind in (int, float):
+            value = float(raw)
+            if not math.isfinite(value):
+                raise ValueError(self.name + " must be a finite number")
+            if self.kind is int:
+                if value != int(value):
+                    raise ValueError(self.name + " must be a whole number")
+                value = int(value)
+        else:
+            value = str(raw)
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError(self.name + " must be at least " + str(self.minimum))
+        if self.maximum is not None and value > self.maximum:
+            raise ValueError(self.name + " must be at most " + str(self.maximum))
+        if self.choices is not None and value not in self.choices:
+            raise ValueError(self.name + " must be one of " + ", ".join(str(c) for c in self.choices))
+        return value
+
+class ParameterStore:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, path, target, debounce=30, clock=time.monotonic):
+        self.path       = path      # JSON config file
+        self.target     = target    # Object the values are written to as attributes
+        self.debounce   = debounce  # Seconds without updates before the file is written
+        self.clock      = clock
+        self.parameters = {}
+        self.lock       = threading.Lock()
+        self.lastChange = None      # Clock of the last unsaved update, None if saved
+        self.changed    = set()     # Names to be announced
+
+    #######################################
+    # Add a parameter, its default is the target's current attribute.
+    # target overrides the store's target for this parameter.
+    #######################################
+    def define(self, name, kind, minimum=None, maximum=None, choices=None, onChange=None, target=None):
+        if target is None:
+            target = self.target
+        value = getattr(target, name)
+        self.parameters[name] = Parameter(name, kind, value, minimum, maximum, choices, onChange, target)
+
+    def get(self, name):
+        return self.parameters[name].value
+
+    #######################################
+    # Values from the config file, before anything runs
+    #######################################
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                stored = json.load(f)
+        except OSError:
+            logger.info("No parameter file, using defaults")
+            return
+        except ValueError:
+            logger.error("Parameter file " + self.path + " is broken, using defaults!")
+            return
+        loaded = 0
+        for name, raw in stored.items():
+            parameter = self.parameters.get(name)
+            if parameter is None:
+                logger.warning("Unknown parameter " + name + " in " + self.path)
+                continue
+            try:
+                parameter.value = parameter.convert(raw)
+            except (TypeError, ValueError) as e:
+                logger.error("Ignoring " + name + " from " + self.path + ": " + str(e))
+                continue
+            setattr(parameter.target, name, parameter.value)
+            loaded += 1
+        logger.info("Loaded " + str(loaded) + " parameters from " + self.path)
+
+    #######################################
+    # Runtime update, from any thread. Raises KeyError or ValueError.
+    #######################################
+    def set(self, name, raw):
+        parameter = self.parameters[name]
+        value = parameter.convert(raw)
+        with self.lock:
+            if value == parameter.value:
+                # Still announce it, whoever sent it wants to see it confirmed
+                self.changed.add(name)
+                return value
+            parameter.value = value
+            setattr(parameter.target, name, value)
+            self.lastChange = self.clock()
+            self.changed.add(name)
+        if parameter.onChange is not None:
+            parameter.onChange(value)
+        logger.warning("Parameter " + name + " set to " + str(value))
+        return value
+
+    #######################################
+    # Names to publish since the last call
+    #######################################
+    def announce(self, name=None):
+        with self.lock:
+            self.changed.update(self.parameters if name is None else [name])
+
+    def takeChanged(self):
+        with self.lock:
+            changed, self.changed = self.changed, set()
+        return sorted(changed)
+
+    #######################################
+    # Debounced persistence
+    #######################################
+    def persistIn(self):
+        # Seconds until the file should be written, None if nothing changed
+        with self.lock:
+            if self.lastChange is None:
+                return None
+            return max(self.lastChange + self.debounce - self.clock(), 0)
+
+    def persist(self):
+        with self.lock:
+            if self.lastChange is None:
+                return
+            values = {name: parameter.value for name, parameter in self.parameters.items()}
+            self.lastChange = None
+        tmpPath = self.path + ".tmp"
+        try:
+            with open(tmpPath, 'w') as f:
+                json.dump(values, f, indent=4, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpPath, self.path)
+        except OSError:
+            logger.error("Writing parameters to " + self.path + " didn't work!")
+            with self.lock:
+                # Try again after the next debounce
+                self.lastChange = self.clock()
@@ -0,0 +1,458 @@
+#############################################################################
+##                        Replay / backtesting                             ##
+#############################################################################
+# Runs recorded sensor traces through the relay decisions of control.py,
+# the same ones grass.Tent uses, to try other parameters offline. Reports
+# relay switch counts, duty cycles, time out of the temperature band and
+# the estimated energy, for a single parameter set or a whole grid of them
+# spread over all cores.
+#
+# Traces come from:
+#   - an MQTT capture of the output topics, with the receive time in front:
+#     mosquitto_sub -v -F "%U %t %p" -t "grass/outputs/#" > capture.txt
+#     (snapshots work as well, binary ones captured with %x instead of %p)
+#   - the log file (~/GrassLog.txt, rotated .gz files too)
+#   - the local history (~/GrassHistory), readings only
+#
+# The air temperature drives the heater, the hour the light, the circulation
+# runs in its windows, exhaust and watering follow what was requested back
+# then (or a watering rule). Recorded temperatures still carry the heater as
+# it was switched when they were recorded. With heaterGain the difference
+# between the replayed and the recorded heater is added to them as a first
+# order lag (steady state heaterGain °C, time constant heaterTau), otherwise
+# they're taken as they are.
+#
+# Usage: python grass/replay.py --capture FILE [--set airTempHyst=0.3] [--grid airTempSet=19:22:0.5]
+
+import os
+import re
+import gzip
+import json
+import math
+import time
+import logging
+import argparse
+import datetime
+import itertools
+import multiprocessing
+
+import control
+import actuators
+
+logger = logging.getLogger(__name__)
+
+# Parameters of grass.Tent the decisions depend on
+PARAMETERS  = ["airTempSet", "airTempHyst", "airCircDuration", "airCircTime", "lightOnTime", "lightOffTime",
+               "wateringPulseOn", "wateringPulseOff"]
+RELAYS      = ["light", "heater", "exhaust", "circ", "water"]
+
+# Event kinds of a trace
+READING     = 0     # value is (channel, float)
+HEATER      = 1     # Recorded heater state
+EXHAUST     = 2     # Requested exhaust state
+WATER       = 3     # Watering request
+HOUR        = 4     # Full hour, value is the hour
+
+# Recorded channels and what they are, readings by prefix
+READINGS    = ("airtemp", "airhum", "watertemp", "brightness", "bucketmoists/", "buckettemps/")
+STATES      = {"runheater": HEATER, "exhaust": EXHAUST, "runwater": WATER}
+
+# Draw of the relays in W when the trace doesn't have energyshares/<relay>/watts
+relayWatts  = {
+    "light"     : 150.0,
+    "heater"    : 100.0,
+    "exhaust"   : 30.0,
+    "circ"      : 10.0,
+    "water"     : 20.0,
+    "base"      : 5.0,
+}
+
+#######################################
+# Recorded events in time order
+#######################################
+class Trace:
+    def __init__(self):
+        self.events = []    # (timestamp, kind, value)
+        self.watts  = {}    # Learned draws found in the trace
+        self.start  = None
+        self.end    = None
+
+    def add(self, timestamp, channel, value):
+        kind = STATES.get(channel)
+        if kind is not None:
+            self.events.append((timestamp, kind, value in (True, "True", "true", "1")))
+        elif channel.startswith(READINGS):
+            try:
+                self.events.append((timestamp, READING, (channel, float(value))))
+            except ValueError:
+                pass
+        elif channel.startswith("energyshares/") and channel.endswith("/watts"):
+            self.watts[channel.split("/")[1]] = float(value)
+
+    #######################################
+    # Sort and add the full hours, done once for all replays
+    #######################################
+    def finish(self):
+        self.events.sort(key=lambda event: event[0])
+        if not self.events:
+            raise ValueError("No usable records in the trace")
+        self.start  = self.events[0][0]
+        self.end    = self.events[-1][0]
+        hours       = [(self.start, HOUR, datetime.datetime.fromtimestamp(self.start).hour)]
+        current     = datetime.datetime.fromtimestamp(self.start).replace(minute=0, second=0, microsecond=0)
+        while True:
+            current += datetime.timedelta(hours=1)
+            timestamp = current.timestamp()
+            if timestamp > self.end:
+                break
+            hours.append((timestamp, HOUR, current.hour))
+        # Stable, so the hour comes before readings at the same moment
+        self.events = sorted(hours + self.events, key=lambda event: event[0])
+        return self
+
+#######################################
+# Text files, gzipped or not
+#######################################
+def openText(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+#######################################
+# MQTT capture, "<unix time> <topic> <payload>" per line
+#######################################
+def loadCapture(paths, topic="grass/outputs/"):
+    import snapshot
+
+    trace = Trace()
+    for path in paths:
+        with openText(path) as file:
+            for line in file:
+                parts = line.rstrip("\n").split(" ", 2)
+                if len(parts) < 3 or not parts[1].startswith(topic):
+                    continue
+                try:
+                    timestamp = float(parts[0])
+                except ValueError:
+                    continue
+                subtopic = parts[1][len(topic):]
+                if subtopic in ("snapshot", "snapshot/bin"):
+                    try:
+                        if subtopic == "snapshot":
+                            frame = snapshot.fromJson(parts[2])
+                        else:
+                            frame = snapshot.fromBinary(bytes.fromhex(parts[2]))
+                    except ValueError:
+                        continue
+                    for channel, value in frame.values.items():
+                        if channel not in frame.stale:
+                            trace.add(frame.timestamp, channel, value)
+                    trace.add(frame.timestamp, "runheater", frame.relays.get("heater", False))
+                else:
+                    trace.add(timestamp, subtopic, parts[2])
+    return trace.finish()
+
+#######################################
+# Log file, tent is the name in front of the messages of further tents
+#######################################
+LOG_LINE        = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) \| \w+ \| (?:\[([^\]]+)\] )?(.*)$")
+LOG_MESSAGES    = [
+    (re.compile(r"^Air temperature: (-?[\d.]+) C$"),    "airtemp"),
+    (re.compile(r"^Air humidity: (-?[\d.]+) %$"),       "airhum"),
+    (re.compile(r"^Heater (On|Off)$"),                  "runheater"),
+    (re.compile(r"^Turning exhaust (on|off)$"),         "exhaust"),
+    (re.compile(r"^Turning water (on|off)$"),           "runwater"),
+]
+
+# Marker of logpipeline.RateLimiter, the message was dropped for a while after this one
+LOG_SUPPRESSED  = re.compile(r"^(.*) \(repeats suppressed for \d+ s\)$")
+
+def loadLog(paths, tent=None):
+    trace = Trace()
+    for path in paths:
+        with openText(path) as file:
+            for line in file:
+                match = LOG_LINE.match(line.rstrip("\n"))
+                if match is None or match.group(2) != tent:
+                    continue
+                message = match.group(3)
+                gap = LOG_SUPPRESSED.match(message)
+                if gap is not None and any(pattern.match(gap.group(1)) for pattern, channel in LOG_MESSAGES):
+                    # Switches or readings missing from the log would replay wrong
+                    raise ValueError(path + " has gaps, \"" + gap.group(1) + "\" was rate limited at " + match.group(1))
+                for pattern, channel in LOG_MESSAGES:
+                    found = pattern.match(message)
+                    if found is None:
+                        continue
+                    timestamp = datetime.datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S").timestamp()
+                    value = found.group(1)
+                    trace.add(timestamp, channel, value in ("On", "on") if channel in STATES else value)
+                    break
+    return trace.finish()
+
+#######################################
+# Local history, raw readings between start and end
+#######################################
+def loadHistory(path, start=None, end=None):
+    import history
+
+    store = history.History(path)
+    trace = Trace()
+    try:
+        for channel in store.channels():
+            if not channel.startswith(READINGS):
+                continue
+            tier, records = store.query(channel, start or 0, end or math.inf, tier="raw")
+            for timestamp, value in records:
+                trace.add(timestamp, channel, value)
+    finally:
+        store.close()
+    return trace.finish()
+
+#######################################
+# One replay of a trace with one parameter set
+#######################################
+class Replay:
+    def __init__(self, trace, params, watts=None, heaterGain=None, heaterTau=1800.0, waterRule=None):
+        self.trace      = trace
+        self.params     = params
+        self.watts      = dict(relayWatts, **trace.watts) if watts is None else watts
+        self.heaterGain = heaterGain    # °C the heater adds in steady state, None to take temperatures as recorded
+        self.heaterTau  = heaterTau
+        self.waterRule  = waterRule     # Called with (readings, params) after every reading, True requests a pulse.
+                                        # Replaces the recorded watering requests.
+        self.now        = trace.start
+        self.relays     = dict.fromkeys(RELAYS, False)
+        self.onTime     = dict.fromkeys(RELAYS, 0.0)   # Up to the last switch off
+        self.onSince    = dict.fromkeys(RELAYS, 0.0)   # Last switch on
+        self.switches   = dict.fromkeys(RELAYS, 0)
+        self.runFan     = False
+        self.runExhaust = False
+        self.readings   = {}
+        self.airTemp    = None      # Last recorded air temperature
+        self.recorded   = False     # Heater as recorded
+        self.offset     = 0.0       # Effect of the replayed vs. the recorded heater on the air temperature
+        self.measured   = 0.0       # Seconds with an air temperature
+        self.outOfBand  = 0.0
+        self.low        = params["airTempSet"] - params["airTempHyst"]
+        self.high       = params["airTempSet"] + params["airTempHyst"]
+
+    def setRelay(self, name, state):
+        # On time is counted at the transitions, not on every event
+        if state != self.relays[name]:
+            self.relays[name] = state
+            self.switches[name] += 1
+            if state:
+                self.onSince[name] = self.now
+            else:
+                self.onTime[name] += self.now - self.onSince[name]
+
+    def applyCirc(self, state):
+        self.runFan = state
+        self.setRelay("circ", control.circ(self.runFan, self.runExhaust))
+
+    #######################################
+    # Time passes with the relays as they are
+    #######################################
+    def elapse(self, timestamp):
+        dt = timestamp - self.now
+        if dt <= 0:
+            return
+        if self.airTemp is not None:
+            airTemp = self.airTemp + self.offset
+            self.measured += dt
+            if not (self.low <= airTemp <= self.high):
+                self.outOfBand += dt
+            if self.heaterGain is not None:
+                target = self.heaterGain * (self.relays["heater"] - self.recorded)
+                self.offset += (target - self.offset) * (1 - math.exp(-dt / self.heaterTau))
+        self.now = timestamp
+
+    #######################################
+    # Replay the whole trace
+    #######################################
+    def run(self):
+        params      = self.params
+        airTempSet  = params["airTempSet"]
+        airTempHyst = params["airTempHyst"]
+        lightOnTime = params["lightOnTime"]
+        lightOffTime= params["lightOffTime"]
+        pulseOn     = params["wateringPulseOn"]
+        waterRule   = self.waterRule
+        relays      = self.relays
+        elapse      = self.elapse
+        setRelay    = self.setRelay
+
+        timer = actuators.ActuatorTimer(clock=lambda: self.now)
+        timer.addOutput("water", lambda state: setRelay("water", state), minOff=params["wateringPulseOff"])
+        timer.addWindow("circ", self.applyCirc, period=params["airCircTime"] * 60, duration=params["airCircDuration"])
+        # Only changes with the timer's own transitions and new pulses
+        deadline = timer.nextDeadline()
+
+        for timestamp, kind, value in self.trace.events:
+            # Circulation windows and watering pulses switch in between events
+            while deadline is not None and deadline <= timestamp:
+                elapse(deadline)
+                timer.runDue(deadline)
+                deadline = timer.nextDeadline()
+            elapse(timestamp)
+
+            if kind == READING:
+                channel, reading = value
+                self.readings[channel] = reading
+                if channel == "airtemp":
+                    self.airTemp = reading
+                    setRelay("heater", control.heater(reading + self.offset, relays["heater"], airTempSet, airTempHyst))
+                if waterRule is not None and waterRule(self.readings, params):
+                    timer.pulse("water", pulseOn)
+                    deadline = timer.nextDeadline()
+            elif kind == HOUR:
+                setRelay("light", control.light(value, lightOnTime, lightOffTime))
+            elif kind == HEATER:
+                self.recorded = value
+            elif kind == EXHAUST:
+                self.runExhaust = value
+                setRelay("exhaust", value)
+                setRelay("circ", control.circ(self.runFan, self.runExhaust))
+            elif kind == WATER:
+                if value and waterRule is None:
+                    timer.pulse("water", pulseOn)
+                    deadline = timer.nextDeadline()
+
+        # Relays still on at the end of the trace
+        for name in RELAYS:
+            if relays[name]:
+                self.onTime[name] += self.now - self.onSince[name]
+        duration    = self.trace.end - self.trace.start
+        energy      = (sum(self.onTime[name] * self.watts.get(name, 0.0) for name in RELAYS)
+                       + duration * self.watts.get("base", 0.0)) / 3600 / 1000
+        return {
+            "params"        : params,
+            "duration"      : duration,
+            "switches"      : self.switches,
+            "dutyCycles"    : {name: self.onTime[name] / duration if duration else 0.0 for name in RELAYS},
+            "outOfBand"     : self.outOfBand / self.measured if self.measured else 0.0,
+            "energy"        : energy,
+        }
+
+#######################################
+# Parameter grids, spread over processes
+#######################################
+workerTrace     = None  # Set once per worker process, so the trace isn't sent with every task
+workerOptions   = None
+
+def initWorker(trace, options):
+    global workerTrace, workerOptions
+    workerTrace     = trace
+    workerOptions   = options
+
+def runWorker(params):
+    return Replay(workerTrace, params, **workerOptions).run()
+
+def sweep(trace, grid, params, processes=None, **options):
+    # grid maps parameter names to the values to try, all combinations are
+    # replayed on top of params. Results in the order of the combinations.
+    names   = sorted(grid)
+    combos  = [dict(params, **dict(zip(names, values))) for values in itertools.product(*(grid[name] for name in names))]
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(combos) == 1:
+        return [Replay(trace, combo, **options).run() for combo in combos]
+    with multiprocessing.Pool(processes, initializer=initWorker, initargs=(trace, options)) as pool:
+        return pool.map(runWorker, combos, chunksize=max(1, len(combos) // (processes * 4)))
+
+#######################################
+# Parameters of the running setup: grass defaults and its parameter file
+#######################################
+def defaults(parameterPath=None):
+    import grass
+
+    params = {name: getattr(grass, name) for name in PARAMETERS}
+    if parameterPath is not None:
+        with open(parameterPath) as file:
+            stored = json.load(file)
+        params.update((name, value) for name, value in stored.items() if name in params)
+    return params
+
+def parseValues(text):
+    # "1,2,3" or "start:stop:step" including stop
+    if ":" in text:
+        start, stop, step = (float(part) for part in text.split(":"))
+        count = int(math.floor((stop - start) / step + 1e-9)) + 1
+        return [round(start + idx * step, 6) for idx in range(count)]
+    return [float(value) for value in text.split(",")]
+
+#######################################
+# main()
+#######################################
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded traces through the Grass control decisions")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--capture", nargs="+", help="MQTT capture(s), mosquitto_sub -v -F \"%%U %%t %%p\"")
+    source.add_argument("--log", nargs="+", help="Grass log file(s), .gz too")
+    source.add_argument("--history", help="Local history folder")
+    parser.add_argument("--topic", default="grass/outputs/", help="Output topic of the tent in the capture")
+    parser.add_argument("--tent", default=None, help="Tent name in the log, none for the first tent")
+    parser.add_argument("--parameters", default=None, help="Parameter file to start from instead of the defaults")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="Parameter to change")
+    parser.add_argument("--grid", action="append", default=[], metavar="NAME=A,B,..|START:STOP:STEP", help="Parameter to sweep")
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes for grids, all cores by default")
+    parser.add_argument("--heater-gain", type=float, default=None, help="°C the heater adds, models the replayed heater's effect")
+    parser.add_argument("--heater-tau", type=float, default=1800.0, help="Time constant of the heater's effect in s")
+    parser.add_argument("--top", type=int, default=10, help="Grid results shown")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    loaded = time.perf_counter()
+    if args.capture:
+        trace = loadCapture(args.capture, args.topic)
+    elif args.log:
+        try:
+            trace = loadLog(args.log, args.tent)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        trace = loadHistory(args.history)
+    loaded = time.perf_counter() - loaded
+    if args.heater_gain is not None and not any(event[1] == HEATER for event in trace.events):
+        logger.warning("No recorded heater states in the trace, its effect is modelled against a heater that was off")
+
+    params = defaults(args.parameters)
+    for assignment in args.set:
+        name, value = assignment.split("=", 1)
+        if name not in params:
+            parser.error("Unknown parameter " + name)
+        params[name] = float(value)
+    grid = {}
+    for assignment in args.grid:
+        name, values = assignment.split("=", 1)
+        if name not in params:
+            parser.error("Unknown parameter " + name)
+        grid[name] = parseValues(values)
+
+    wall    = time.perf_counter()
+    results = sweep(trace, grid, params, args.processes, heaterGain=args.heater_gain, heaterTau=args.heater_tau)
+    wall    = time.perf_counter() - wall
+    print("%d events over %.1f days loaded in %.2f s, %d replays in %.2f s" % (
+        len(trace.events), (trace.end - trace.start) / 86400, loaded, len(results), wall))
+
+    if not grid:
+        result = results[0]
+        print("Air temperature out of band %.1f %% of the time" % (result["outOfBand"] * 100))
+        print("Energy %.3f kWh estimated" % result["energy"])
+        for name in RELAYS:
+            print("  %-8s duty %5.1f %%  switched %d times" % (name, result["dutyCycles"][name] * 100, result["switches"][name]))
+        return
+
+    # Best first: least time out of band, then least switching
+    names = sorted(grid)
+    results.sort(key=lambda result: (round(result["outOfBand"], 3), sum(result["switches"].values())))
+    print("".join("%14s" % name for name in names) + "%12s%12s%12s%12s" % ("out of band", "switches", "heater", "kWh"))
+    for result in results[:args.top]:
+        print("".join("%14g" % result["params"][name] for name in names) + "%11.1f%%%12d%11.1f%%%12.3f" % (
+            result["outOfBand"] * 100,
+            sum(result["switches"].values()),
+            result["dutyCycles"]["heater"] * 100,
+            result["energy"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#############################################################################
+##                        Report by exception                              ##
+#############################################################################
+# Decides which readings are worth sending. A channel is only published
+# when it moved out of its deadband around the last published value, but
+# never more often than minInterval and at least every maxInterval (the
+# heartbeat) so subscribers like Home Assistant never see a value expire.
+# That allows sampling much faster than anyone wants to receive.
+
+import math
+
+#######################################
+# Policy of a channel
+#######################################
+class Policy:
+    __slots__ = ("deadband", "percent", "minInterval", "maxInterval")
+
+    def __init__(self, deadband=0.0, percent=None, minInterval=0.0, maxInterval=600.0):
+        self.deadband       = deadband      # Absolute change needed to publish, the least change with percent
+        self.percent        = percent       # Relative change in % of the last value
+        self.minInterval    = minInterval   # Seconds at least between two messages
+        self.maxInterval    = maxInterval   # Seconds at most between two messages, None for no heartbeat
+
+    def exceeded(self, value, last):
+        # Strings, booleans, tuples: any change counts
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or not isinstance(last, (int, float)):
+            return value != last
+        if math.isnan(value) or math.isnan(last):
+            return not (math.isnan(value) and math.isnan(last))
+        threshold = self.deadband
+        if self.percent is not None:
+            # Around zero any percentage of the last value is nothing, the deadband still holds
+            threshold = max(abs(last) * self.percent / 100, threshold)
+        return abs(value - last) >= threshold if threshold else value != last
+
+#######################################
+# Last published state of a channel
+#######################################
+class Sent:
+    __slots__ = ("value", "timestamp")
+
+    def __init__(self, value, timestamp):
+        self.value      = value
+        self.timestamp  = timestamp
+
+class Reporter:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, policies=None, default=None):
+        self.policies   = policies or {}        # Policy per subtopic, longest matching prefix wins
+        self.default    = default or Policy()   # For everything not found in policies
+        self.sent       = {}                    # subtopic -> Sent
+        self.published  = 0
+        self.suppressed = 0
+
+        # Longest prefix first so "telemetry/soctemp" beats "telemetry/"
+        self.prefixes   = sorted(self.policies, key=len, reverse=True)
+
+    def policyFor(self, subtopic):
+        for prefix in self.prefixes:
+            if subtopic.startswith(prefix):
+                return self.policies[prefix]
+        return self.default
+
+    #######################################
+    # Should this reading be published? Remembers it if so.
+    #######################################
+    def due(self, subtopic, value, now):
+        last = self.sent.get(subtopic)
+        if last is None:
+            self.sent[subtopic] = Sent(value, now)
+            self.published += 1
+            return True
+
+        policy  = self.policyFor(subtopic)
+        age     = now - last.timestamp
+        if age < 0:
+            # Clock went backwards, start over from here
+            age = policy.maxInterval or 0.0
+        heartbeat = policy.maxInterval is not None and age >= policy.maxInterval
+        if heartbeat or (age >= policy.minInterval and policy.exceeded(value, last.value)):
+            last.value      = value
+            last.timestamp  = now
+            self.published += 1
+            return True
+        self.suppressed += 1
+        return False
+
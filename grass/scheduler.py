@@ -0,0 +1,194 @@
+#############################################################################
+##                              Scheduler                                  ##
+#############################################################################
+# Runs the control loop's tasks at their deadline instead of polling every
+# second. Tasks sit in a priority queue ordered by their next due time, the
+# scheduler sleeps until the earliest one and can be woken at any time by
+# external events (MQTT commands, GPIO interrupts) through wake().
+#
+# Deadlines are kept on the monotonic clock so an NTP jump after boot (the
+# Pi has no RTC) doesn't stall or burst the loop.
+
+import time
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Jitter / overrun statistics per task
+#######################################
+class TaskStats:
+    __slots__ = ("runs", "jitterSum", "jitterMax", "runtimeSum", "runtimeMax", "overruns")
+
+    def __init__(self):
+        self.runs       = 0
+        self.jitterSum  = 0.0   # Seconds started after being due
+        self.jitterMax  = 0.0
+        self.runtimeSum = 0.0   # Seconds spent running
+        self.runtimeMax = 0.0
+        self.overruns   = 0     # Runs that took longer than the task's interval
+
+    def jitterMean(self):
+        return self.jitterSum / self.runs if self.runs else 0.0
+
+    def runtimeMean(self):
+        return self.runtimeSum / self.runs if self.runs else 0.0
+
+#######################################
+# Task
+#######################################
+class Task:
+    __slots__ = ("name", "run", "interval", "due", "stats")
+
+    def __init__(self, name, run, interval, due):
+        self.name       = name
+        self.run        = run       # Called with time.time(), may return seconds until next run
+        self.interval   = interval  # Fixed period in seconds, None for tasks that pick their own
+        self.due        = due       # Monotonic timestamp, None while only waiting for wake()
+        self.stats      = TaskStats()
+
+class Scheduler:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self):
+        self.tasks      = {}
+        self.queue      = []    # Heap of (due, seq, name), stale entries are skipped
+        self.seq        = 0
+        self.condition  = threading.Condition()
+        self.running    = None  # (name, monotonic start) of the task running right now
+        self.intervals  = {}    # Intervals set before their task was added
+
+    #######################################
+    # Add a task, first run is right away
+    #######################################
+    def add(self, name, run, interval=None):
+        with self.condition:
+            if interval is not None:
+                interval = self.intervals.pop(name, interval)
+            task = Task(name, run, interval, time.monotonic())
+            self.tasks[name] = task
+            self.push(task)
+
+    def push(self, task):
+        self.seq += 1
+        heapq.heappush(self.queue, (task.due, self.seq, task.name))
+        self.condition.notify()
+
+    #######################################
+    # Make a task due now, safe to call from any thread
+    #######################################
+    def wake(self, name):
+        with self.condition:
+            task = self.tasks.get(name)
+            if task is None:
+                return
+            now = time.monotonic()
+            if task.due is None or task.due > now:
+                task.due = now
+                self.push(task)
+
+    #######################################
+    # Change the interval of a periodic task, used by add() if it isn't there yet
+    #######################################
+    def setInterval(self, name, interval):
+        with self.condition:
+            task = self.tasks.get(name)
+            if task is None:
+                self.intervals[name] = interval
+                return
+            if task.due is not None:
+                task.due = task.due - task.interval + interval
+                self.push(task)
+            task.interval = interval
+
+    #######################################
+    # Seconds until the next task is due, None if nothing is scheduled
+    #######################################
+    def timeout(self):
+        while self.queue:
+            due, _, name = self.queue[0]
+            if self.tasks[name].due != due:
+                heapq.heappop(self.queue)   # Superseded by wake() or setInterval()
+                continue
+            return max(due - time.monotonic(), 0)
+        return None
+
+    #######################################
+    # Task holding up the loop and by how many seconds: the one running, or
+    # else the most overdue one. (None, 0) while nothing is due. Safe to call
+    # from any thread.
+    #######################################
+    def lateness(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        running = self.running
+        if running is not None:
+            return running[0], now - running[1]
+        with self.condition:
+            due = [(task.due, name) for name, task in self.tasks.items() if task.due is not None]
+        if not due:
+            return None, 0.0
+        due, name = min(due)
+        return name, max(now - due, 0.0)
+
+    #######################################
+    # Run every task that is due
+    #######################################
+    def runPending(self):
+        while True:
+            with self.condition:
+                timeout = self.timeout()
+                if timeout is None or timeout > 0:
+                    return
+                due, _, name = heapq.heappop(self.queue)
+                task = self.tasks[name]
+                task.due = None
+
+            start = time.monotonic()
+            self.running = (name, start)
+            try:
+                delay = task.run(time.time())
+            except Exception:
+                logger.exception("Task " + name + " failed!")
+                delay = None
+            end = time.monotonic()
+            self.running = None
+
+            stats = task.stats
+            stats.runs       += 1
+            stats.jitterSum  += start - due
+            stats.jitterMax   = max(stats.jitterMax, start - due)
+            stats.runtimeSum += end - start
+            stats.runtimeMax  = max(stats.runtimeMax, end - start)
+
+            with self.condition:
+                if task.interval is not None:
+                    if end - start > task.interval:
+                        stats.overruns += 1
+                        logger.warning("Task " + name + " overran its interval!")
+                    # Keep the period, unless we fell behind by more than one
+                    nextDue = due + task.interval
+                    if nextDue < end:
+                        nextDue = end
+                elif delay is not None:
+                    nextDue = end + delay
+                else:
+                    nextDue = None
+                # A wake() during the run may have scheduled it earlier already
+                if nextDue is not None and (task.due is None or task.due > nextDue):
+                    task.due = nextDue
+                    self.push(task)
+
+    #######################################
+    # Sleep until the next deadline or wake(), forever
+    #######################################
+    def runForever(self):
+        while True:
+            self.runPending()
+            with self.condition:
+                timeout = self.timeout()
+                if timeout is None or timeout > 0:
+                    self.condition.wait(timeout)
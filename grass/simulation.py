@@ -0,0 +1,432 @@
+#############################################################################
+##                             Simulation                                  ##
+#############################################################################
+# Simulated grow box for running the control loop without a Pi. SimBackend
+# implements the hal.Backend interface on top of a simple first order
+# thermal / humidity / soil moisture model driven by the relay outputs, and
+# a virtual clock that only moves when the simulation says so. That lets
+# machineCode run through weeks of simulated time in seconds.
+#
+# Usage: python grass/simulation.py [--days N] [--tents N]
+
+import os
+import math
+import time
+import random
+import logging
+import argparse
+import tempfile
+import datetime
+
+import hal
+
+#######################################
+# Virtual clock
+#######################################
+class VirtualClock:
+    def __init__(self, start):
+        self.current = start
+
+    def time(self):
+        return self.current
+
+    def set(self, timestamp):
+        self.current = timestamp
+
+#######################################
+# Grow box model
+#######################################
+class BoxModel:
+    # Steady state offsets over ambient, in °C / %
+    HEATER_GAIN     = 8.0
+    LIGHT_GAIN      = 4.0
+    TRANSPIRATION   = 25.0
+    # Time constants in seconds
+    TAU_CLOSED      = 1800.0
+    TAU_VENTED      = 300.0
+    # Soil moisture in raw Seesaw units per second
+    SOIL_DRYING     = 0.004
+    PUMP_FLOW       = 2.0
+    # Power draw in W
+    POWER           = {"light": 150.0, "heater": 100.0, "exhaust": 30.0, "circ": 10.0, "water": 20.0}
+    POWER_BASE      = 5.0
+
+    def __init__(self, buckets=3, seed=0):
+        self.random     = random.Random(seed)
+        self.airTemp    = 19.0
+        self.airHum     = 60.0
+        self.waterTemp  = 18.0
+        self.soilMoist  = [800.0 + 50 * i for i in range(buckets)]
+        self.socTemp    = 45.0
+
+    #######################################
+    # Ambient conditions outside the tent
+    #######################################
+    def ambient(self, timestamp):
+        hour = datetime.datetime.fromtimestamp(timestamp).hour + (timestamp % 3600) / 3600
+        temp = 18.0 + 3.0 * math.sin((hour - 9) / 24 * 2 * math.pi)
+        return temp, 55.0
+
+    #######################################
+    # Integrate the model over dt seconds with the given relays
+    #######################################
+    def step(self, timestamp, dt, relays):
+        ambientTemp, ambientHum = self.ambient(timestamp)
+        vented  = relays["exhaust"]
+        tau     = self.TAU_VENTED if vented else self.TAU_CLOSED
+        k       = 1 - math.exp(-dt / tau)
+
+        targetTemp = ambientTemp
+        if relays["heater"]:
+            targetTemp += self.HEATER_GAIN
+        if relays["light"]:
+            targetTemp += self.LIGHT_GAIN
+        self.airTemp += (targetTemp - self.airTemp) * k
+
+        targetHum = ambientHum + (0 if vented else self.TRANSPIRATION * (1.0 if relays["light"] else 0.5))
+        self.airHum += (min(targetHum, 99.0) - self.airHum) * k
+
+        self.waterTemp += (ambientTemp - self.waterTemp) * (1 - math.exp(-dt / 7200))
+        self.socTemp = 40.0 + (self.airTemp - 20.0)
+
+        for idx in range(len(self.soilMoist)):
+            drying = self.SOIL_DRYING * (1.5 if relays["light"] else 1.0)
+            self.soilMoist[idx] -= drying * dt
+            if relays["water"]:
+                self.soilMoist[idx] += self.PUMP_FLOW * dt
+            self.soilMoist[idx] = min(max(self.soilMoist[idx], 200.0), 2000.0)
+
+    def power(self, relays):
+        return self.POWER_BASE + sum(self.POWER[name] for name, on in relays.items() if on)
+
+    def noise(self, sigma):
+        return self.random.gauss(0, sigma)
+
+#######################################
+# Simulated sensors
+#######################################
+class SimSoilSensor:
+    GLITCH = 0.03   # Share of moisture reads returning garbage, like the real Seesaw does now and then
+
+    def __init__(self, model, idx):
+        self.model  = model
+        self.idx    = idx
+
+    def moisture_read(self):
+        if self.model.random.random() < self.GLITCH:
+            return 65535
+        return int(self.model.soilMoist[self.idx] + self.model.noise(30))
+
+    def get_temp(self):
+        return self.model.airTemp - 1.0 + self.model.noise(0.2)
+
+class SimLightSensor:
+    def __init__(self, box):
+        self.box = box
+
+    @property
+    def lux(self):
+        return (20000.0 if self.box.relays["light"] else 5.0) + self.box.model.noise(50)
+
+class SimAirSensor:
+    def __init__(self, model):
+        self.model = model
+
+    @property
+    def temperature(self):
+        return self.model.airTemp + self.model.noise(0.1)
+
+    @property
+    def relative_humidity(self):
+        return self.model.airHum + self.model.noise(0.5)
+
+#######################################
+# One simulated tent: model, relays, S0 meter and statistics
+#######################################
+class SimBox:
+    def __init__(self, pins, buckets=3, seed=0, s0Pin=None, oneWire=None):
+        # pins maps relay names (light, heater, exhaust, circ, water) to GPIO numbers
+        self.model          = BoxModel(buckets, seed)
+        self.buckets        = buckets
+        self.pins           = pins
+        self.relays         = {name: False for name in pins}
+        self.s0Pin          = s0Pin
+        self.s0Callback     = None
+        self.energy         = 0.0   # kWh since last pulse
+        self.soilAddresses  = []
+        self.oneWire        = "sim/" + (oneWire or "28-000000000000") + "/temperature"
+
+        # Statistics
+        self.onTime         = {name: 0.0 for name in pins}
+        self.switches       = {name: 0 for name in pins}
+        self.energyTotal    = 0.0
+        self.band           = None  # (low, high) air temperature band to account for
+        self.outOfBand      = 0.0
+
+#######################################
+# Backend
+#######################################
+class SimBackend(hal.Backend):
+    STEP = 10   # Longest model integration step in seconds
+
+    def __init__(self, pins=None, start=None, buckets=3, seed=0, s0kWhPerPulse=0.001):
+        # Boxes are added with addBox(), pins adds a first one right away
+        if start is None:
+            start = datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
+        self.clock          = VirtualClock(start)
+        self.s0kWhPerPulse  = s0kWhPerPulse
+        self.boxes          = []
+        self.pinBoxes       = {}    # GPIO -> (box, relay name)
+        self.channels       = {}    # I2C multiplexer channel -> box
+        self.oneWires       = {}    # 1-Wire path -> box
+        if pins is not None:
+            self.addBox(pins, buckets, seed)
+
+    #######################################
+    # A further box on its own pins, I2C channel and DS18B20
+    #######################################
+    def addBox(self, pins, buckets=3, seed=0, s0Pin=None, i2cChannel=None, oneWire=None):
+        box = SimBox(pins, buckets, seed, s0Pin, oneWire)
+        self.boxes.append(box)
+        for name, pin in pins.items():
+            self.pinBoxes[pin] = (box, name)
+        self.channels[i2cChannel] = box
+        self.oneWires[box.oneWire] = box
+        return box
+
+    #######################################
+    # Clock
+    #######################################
+    def time(self):
+        return self.clock.time()
+
+    def advanceTo(self, timestamp):
+        while self.clock.time() < timestamp:
+            stepStart   = self.clock.time()
+            dt          = min(self.STEP, timestamp - stepStart)
+            pulses      = []
+            for box in self.boxes:
+                box.model.step(stepStart, dt, box.relays)
+                for name, on in box.relays.items():
+                    if on:
+                        box.onTime[name] += dt
+                if box.band is not None and not (box.band[0] <= box.model.airTemp <= box.band[1]):
+                    box.outOfBand += dt
+
+                # S0 meter pulses, at the moment within the step they happen
+                rate        = box.model.power(box.relays) / 3600 / 1000   # kWh per s
+                box.energyTotal += rate * dt
+                elapsed     = 0.0
+                while rate > 0 and elapsed + (self.s0kWhPerPulse - box.energy) / rate <= dt:
+                    elapsed += (self.s0kWhPerPulse - box.energy) / rate
+                    box.energy = 0.0
+                    pulses.append((elapsed, box))
+                box.energy += rate * (dt - elapsed)
+
+            # Fired in order of time over all boxes
+            pulses.sort(key=lambda pulse: pulse[0])
+            for elapsed, box in pulses:
+                self.clock.set(stepStart + elapsed)
+                if box.s0Callback is not None:
+                    box.s0Callback(box.s0Pin)
+            self.clock.set(stepStart + dt)
+
+    #######################################
+    # GPIO
+    #######################################
+    def setupPins(self, outputs, inputs):
+        for box in self.boxes:
+            for name in box.relays:
+                box.relays[name] = False
+
+    def output(self, pin, state):
+        entry = self.pinBoxes.get(pin)
+        if entry is None:
+            return
+        box, name = entry
+        state = bool(state)
+        if state != box.relays[name]:
+            box.switches[name] += 1
+        box.relays[name] = state
+
+    def onFallingEdge(self, pin, callback, bouncetime):
+        # Meter of the box with that S0 pin, the first box if none has it
+        for box in self.boxes:
+            if box.s0Pin == pin:
+                break
+        else:
+            box = self.boxes[0]
+            box.s0Pin = pin
+        box.s0Callback = callback
+
+    #######################################
+    # Sensors, the "bus" handed out is the box itself
+    #######################################
+    def i2c(self, channel=None):
+        box = self.channels.get(channel)
+        if box is None:
+            raise OSError("No I2C multiplexer channel " + str(channel))
+        return box
+
+    def soilSensor(self, box, address):
+        # Buckets are handed out in the order the addresses are first probed
+        if address not in box.soilAddresses:
+            if len(box.soilAddresses) >= box.buckets:
+                raise OSError("No soil sensor at " + hex(address))
+            box.soilAddresses.append(address)
+        return SimSoilSensor(box.model, box.soilAddresses.index(address))
+
+    def lightSensor(self, box):
+        return SimLightSensor(box)
+
+    def airSensor(self, box):
+        return SimAirSensor(box.model)
+
+    def findOneWire(self, serial=None):
+        if serial is None:
+            return self.boxes[0].oneWire
+        path = "sim/" + serial + "/temperature"
+        return path if path in self.oneWires else None
+
+    def readOneWire(self, path):
+        model = self.oneWires[path].model
+        return model.waterTemp + model.noise(0.05)
+
+    def readThermal(self):
+        model = self.boxes[0].model
+        return model.socTemp + model.noise(0.5)
+
+    def diskUsage(self, path):
+        return 32 * 1024 ** 3, 20 * 1024 ** 3
+
+#######################################
+# Stand-in for the MQTT publisher
+#######################################
+class SimPublisher:
+    def __init__(self):
+        self.messages = 0
+
+    def queue(self, subtopic, payload, qos=None, retain=False, prefix=None):
+        self.messages += 1
+        return True
+
+    def flush(self, timeout=None):
+        return 0
+
+    def replay(self, maxRecords=500):
+        return False
+
+#######################################
+# Tents of the simulation, the first one like grass.tents, further ones on
+# their own (made up) pins, multiplexer channel and DS18B20
+#######################################
+def tentConfigs(grass, count, workDir):
+    configs = []
+    for idx in range(count):
+        if idx == 0:
+            config = dict(grass.tents[0])
+        else:
+            base = 100 + 10 * idx
+            config = {
+                "name"      : "tent" + str(idx + 1),
+                "topic"     : "grass/tent" + str(idx + 1) + "/",
+                "relays"    : {name: base + pin for pin, name in enumerate(grass.relayNames)},
+                "s0"        : base + 9,
+                "soil"      : grass.SOIL_MOIST_ADR,
+                "oneWire"   : "28-%012d" % idx,
+            }
+        if count > 1:
+            config["i2cChannel"] = idx
+        config["energyPath"]    = os.path.join(workDir, config["name"] + "-energy.txt")
+        config["parameterPath"] = os.path.join(workDir, config["name"] + "-parameters.json")
+        config["historyPath"]   = os.path.join(workDir, config["name"] + "-history")
+        configs.append(config)
+    return configs
+
+#######################################
+# Run machineCode of every tent against the model
+#######################################
+def simulate(days, seed=0, start=None, tents=1):
+    import grass
+
+    workDir = tempfile.mkdtemp(prefix="grass-sim-")
+    backend = SimBackend(start=start, s0kWhPerPulse=grass.s0kWhPerPulse)
+    grass.hw            = backend
+    grass.publisher     = SimPublisher()
+    grass.controllers   = []
+    for idx, config in enumerate(tentConfigs(grass, tents, workDir)):
+        tent = grass.Tent(config, primary=(idx == 0))
+        tent.hw         = backend
+        tent.publisher  = grass.publisher
+        box = backend.addBox(config["relays"], len(config["soil"]), seed + idx,
+            config["s0"], config.get("i2cChannel"), config.get("oneWire"))
+        box.band = (tent.airTempSet - tent.airTempHyst, tent.airTempSet + tent.airTempHyst)
+        grass.controllers.append(tent)
+
+    for tent in grass.controllers:
+        tent.parameterSetup()
+        tent.energySetup()
+        tent.historySetup()
+        tent.sensorSetup()
+        tent.actuatorSetup()
+
+    end     = backend.time() + days * 24 * 3600
+    cycles  = 0
+    wall    = time.perf_counter()
+    while backend.time() < end:
+        for tent in grass.controllers:
+            tent.machineCode()
+        cycles += 1
+        # Jump straight to the next thing that can change anything
+        now = backend.time()
+        nextDue = min(min(
+            tent.lastSensors + tent.sensorInterval,
+            tent.lastSlow + tent.slowInterval,
+            now + tent.nextControlDeadline(now)) for tent in grass.controllers)
+        backend.advanceTo(max(nextDue, now) + 0.001)
+    wall = time.perf_counter() - wall
+
+    simulated = days * 24 * 3600
+    boxes = [{
+        "name"          : tent.name,
+        "dutyCycles"    : {name: box.onTime[name] / simulated for name in box.onTime},
+        "switches"      : dict(box.switches),
+        "outOfBand"     : box.outOfBand / simulated,
+        "energyModel"   : box.energyTotal,
+        "energyCounted" : tent.energyMeter.total,
+        "history"       : tent.historyStore,
+    } for tent, box in zip(grass.controllers, backend.boxes)]
+    # The first tent's results at the top, like with a single tent
+    return dict(boxes[0],
+        days        = days,
+        cycles      = cycles,
+        wall        = wall,
+        speedup     = simulated / wall,
+        messages    = grass.publisher.messages,
+        tents       = boxes)
+
+#######################################
+# main()
+#######################################
+def main():
+    parser = argparse.ArgumentParser(description="Run the Grass control loop against a simulated grow box")
+    parser.add_argument("--days", type=float, default=7, help="Simulated days")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sensor noise")
+    parser.add_argument("--tents", type=int, default=1, help="Tents run by the one process")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    result = simulate(args.days, seed=args.seed, tents=args.tents)
+
+    print("Simulated %.1f days in %.2f s (%.0fx real time), %d cycles, %d MQTT messages" % (
+        result["days"], result["wall"], result["speedup"], result["cycles"], result["messages"]))
+    for box in result["tents"]:
+        if len(result["tents"]) > 1:
+            print(box["name"])
+        print("Air temperature out of band %.1f %% of the time" % (box["outOfBand"] * 100))
+        print("Energy %.3f kWh modelled, %.3f kWh counted" % (box["energyModel"], box["energyCounted"]))
+        for name in sorted(box["dutyCycles"]):
+            print("  %-8s duty %5.1f %%  switched %d times" % (name, box["dutyCycles"][name] * 100, box["switches"][name]))
+
+if __name__ == "__main__":
+    main()
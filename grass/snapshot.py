@@ -0,0 +1,127 @@
+#############################################################################
+##                           Cycle snapshot                                ##
+#############################################################################
+# One message per sensor cycle instead of one topic per reading. A Frame
+# collects the cycle's readings and relay states and is encoded either as
+# JSON or as a packed binary record, both carrying a schema version and
+# per channel validity flags so consumers can tell fresh, stale (last good
+# value) and missing readings apart.
+#
+# Binary layout (little endian), schema version 3:
+#   version u8 | buckets u8 | relays u8 | reserved u8 | timestamp f64
+#   | valid mask u32 | stale mask u32 | value f32 or f64 * channel count
+# Channels are bucketmoists/0..n-1, buckettemps/0..n-1 followed by
+# CHANNELS, bit i of the masks belongs to channel i. Missing values are NaN.
+# Counters growing for ever (energy in kWh) are f64, f32 would only resolve
+# 0.01 kWh at four figures, everything else is f32. The masks limit a frame
+# to MASK_BITS channels, i.e. 12 buckets. Version 2, all f32, is still read.
+
+import json
+import math
+import struct
+
+SCHEMA_VERSION  = 3
+READABLE        = (2, 3)    # Schema versions the decoders take
+HEADER          = struct.Struct("<BBBBdII")
+MASK_BITS       = 32        # Channels a frame can hold, one bit each in the masks
+CHANNELS        = ["watertemp", "brightness", "airtemp", "airhum", "energy", "power", "telemetry/soctemp"]
+DOUBLES         = {"energy"}    # Channels packed as f64
+MAX_BUCKETS     = (MASK_BITS - len(CHANNELS)) // 2
+RELAYS          = ["light", "heater", "exhaust", "circ", "water"]
+
+#######################################
+# Channel names of a box with n buckets
+#######################################
+def channelNames(buckets):
+    return (["bucketmoists/" + str(i) for i in range(buckets)]
+        + ["buckettemps/" + str(i) for i in range(buckets)]
+        + CHANNELS)
+
+def valueFormat(names, version=SCHEMA_VERSION):
+    if version < 3:
+        return "<%df" % len(names)
+    return "<" + "".join("d" if name in DOUBLES else "f" for name in names)
+
+#######################################
+# Readings of one cycle
+#######################################
+class Frame:
+    __slots__ = ("timestamp", "buckets", "values", "stale", "relays")
+
+    def __init__(self, timestamp, buckets):
+        self.timestamp  = timestamp
+        self.buckets    = buckets
+        self.values     = {}    # Channel -> value, only those we have
+        self.stale      = set() # Channels holding the last good value
+        self.relays     = {}    # Relay -> state
+
+    def set(self, channel, value, stale=False):
+        if value is None:
+            return
+        self.values[channel] = value
+        if stale:
+            self.stale.add(channel)
+
+    #######################################
+    # JSON
+    #######################################
+    def toJson(self):
+        return json.dumps({
+            "v"         : SCHEMA_VERSION,
+            "ts"        : round(self.timestamp, 3),
+            "values"    : {name: round(value, 3) for name, value in self.values.items()},
+            "stale"     : sorted(self.stale),
+            "relays"    : self.relays,
+        }, separators=(",", ":"))
+
+    #######################################
+    # Packed binary
+    #######################################
+    def toBinary(self):
+        names   = channelNames(self.buckets)
+        if len(names) > MASK_BITS:
+            raise ValueError("Binary snapshots hold " + str(MASK_BITS) + " channels, not " + str(len(names)))
+        valid   = 0
+        stale   = 0
+        values  = []
+        for bit, name in enumerate(names):
+            value = self.values.get(name)
+            if value is None:
+                values.append(math.nan)
+                continue
+            values.append(value)
+            valid |= 1 << bit
+            if name in self.stale:
+                stale |= 1 << bit
+        relays = 0
+        for bit, name in enumerate(RELAYS):
+            if self.relays.get(name):
+                relays |= 1 << bit
+        return HEADER.pack(SCHEMA_VERSION, self.buckets, relays, 0, self.timestamp, valid, stale) + struct.pack(valueFormat(names), *values)
+
+#######################################
+# Decoders for consumers
+#######################################
+def fromJson(payload):
+    data = json.loads(payload)
+    if data.get("v") not in READABLE:
+        raise ValueError("Unknown snapshot schema " + str(data.get("v")))
+    frame = Frame(data["ts"], 0)
+    frame.values    = data["values"]
+    frame.stale     = set(data["stale"])
+    frame.relays    = data["relays"]
+    frame.buckets   = sum(1 for name in frame.values if name.startswith("bucketmoists/"))
+    return frame
+
+def fromBinary(payload):
+    version, buckets, relays, reserved, timestamp, valid, stale = HEADER.unpack_from(payload)
+    if version not in READABLE:
+        raise ValueError("Unknown snapshot schema " + str(version))
+    names   = channelNames(buckets)
+    values  = struct.unpack_from(valueFormat(names, version), payload, HEADER.size)
+    frame   = Frame(timestamp, buckets)
+    for bit, name in enumerate(names):
+        if valid & (1 << bit):
+            frame.set(name, values[bit], bool(stale & (1 << bit)))
+    frame.relays = {name: bool(relays & (1 << bit)) for bit, name in enumerate(RELAYS)}
+    return frame
@@ -0,0 +1,211 @@
+#############################################################################
+##                         Store and forward spool                         ##
+#############################################################################
+# Disk backed outbound queue for MQTT messages produced while the broker is
+# unreachable. Messages are appended to segment files in a compact binary
+# format and replayed in order once the connection is back. The spool is
+# capped in size, when it grows too large the oldest segment is dropped so
+# an outage can't fill up the SD card.
+#
+# Record layout (little endian):
+#   crc32 u32 | timestamp f64 | qos u8 | retain u8 | topic len u16 | payload len u32 | topic | payload
+# The CRC covers everything after itself, a torn record at the end of a
+# segment after a power cut is detected and ignored.
+
+import os
+import glob
+import time
+import zlib
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+HEADER      = struct.Struct("<IdBBHI")
+CRC         = struct.Struct("<I")
+
+class Spool:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, path, maxBytes=50 * 1024 * 1024, segmentBytes=1024 * 1024):
+        self.path           = path          # Directory holding the segments
+        self.maxBytes       = maxBytes      # Total size before the oldest segment is dropped
+        self.segmentBytes   = segmentBytes  # Size after which a new segment is started
+        self.writer         = None
+        self.writeSegment   = None
+        self.posPath        = os.path.join(path, "read.pos")
+
+        os.makedirs(path, exist_ok=True)
+        self.segments = sorted(int(os.path.basename(p)[:-4]) for p in glob.glob(os.path.join(path, "*.seg")))
+        self.readSegment, self.readOffset = self.loadPosition()
+        self.count = self.countRecords()
+        if self.count:
+            logger.info("Spool holds " + str(self.count) + " messages from before")
+
+    #######################################
+    # Helpers
+    #######################################
+    def segmentPath(self, segment):
+        return os.path.join(self.path, "%08d.seg" % segment)
+
+    def loadPosition(self):
+        try:
+            with open(self.posPath, 'r') as f:
+                segment, offset = f.read().split()
+            return int(segment), int(offset)
+        except (OSError, ValueError):
+            return (self.segments[0] if self.segments else 0), 0
+
+    def savePosition(self):
+        # Write and rename so a power cut leaves either the old or the new position
+        tmpPath = self.posPath + ".tmp"
+        with open(tmpPath, 'w') as f:
+            f.write(str(self.readSegment) + " " + str(self.readOffset))
+        os.replace(tmpPath, self.posPath)
+
+    def totalBytes(self):
+        total = 0
+        for segment in self.segments:
+            try:
+                total += os.path.getsize(self.segmentPath(segment))
+            except OSError:
+                pass
+        return total
+
+    def countRecords(self):
+        count = 0
+        for segment in self.segments:
+            offset = self.readOffset if segment == self.readSegment else 0
+            if segment < self.readSegment:
+                continue
+            count += len(self.readRecords(segment, offset, None)[0])
+        return count
+
+    #######################################
+    # Parse records from a segment
+    #######################################
+    def readRecords(self, segment, offset, maxRecords):
+        records = []
+        try:
+            with open(self.segmentPath(segment), 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except OSError:
+            return records, offset
+
+        pos = 0
+        while maxRecords is None or len(records) < maxRecords:
+            if pos + HEADER.size > len(data):
+                break
+            crc, timestamp, qos, retain, topicLength, payloadLength = HEADER.unpack_from(data, pos)
+            end = pos + HEADER.size + topicLength + payloadLength
+            if end > len(data) or zlib.crc32(data[pos + CRC.size:end]) != crc:
+                # Torn write at the end of the segment
+                break
+            topicStart = pos + HEADER.size
+            topic   = data[topicStart:topicStart + topicLength].decode("utf-8")
+            payload = data[topicStart + topicLength:end]
+            records.append((timestamp, topic, payload, qos, bool(retain)))
+            pos = end
+        return records, offset + pos
+
+    #######################################
+    # Append a message
+    #######################################
+    def append(self, topic, payload, qos=0, retain=False, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        topicBytes = topic.encode("utf-8")
+        body = HEADER.pack(0, timestamp, qos, int(retain), len(topicBytes), len(payload))[CRC.size:] + topicBytes + payload
+        record = CRC.pack(zlib.crc32(body)) + body
+
+        if self.writer is None or self.writer.tell() >= self.segmentBytes:
+            self.rotate()
+        self.writer.write(record)
+        self.count += 1
+
+    def rotate(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.writeSegment = (self.segments[-1] + 1) if self.segments else 0
+        if not self.segments:
+            self.readSegment, self.readOffset = self.writeSegment, 0
+        self.segments.append(self.writeSegment)
+        self.writer = open(self.segmentPath(self.writeSegment), 'ab')
+        self.evict()
+
+    #######################################
+    # Drop the oldest segments beyond maxBytes
+    #######################################
+    def evict(self):
+        while len(self.segments) > 1 and self.totalBytes() > self.maxBytes:
+            segment = self.segments.pop(0)
+            offset = self.readOffset if segment == self.readSegment else 0
+            dropped = len(self.readRecords(segment, offset, None)[0])
+            os.remove(self.segmentPath(segment))
+            self.count -= dropped
+            self.readSegment, self.readOffset = self.segments[0], 0
+            self.savePosition()
+            logger.warning("Spool full, dropped " + str(dropped) + " oldest messages!")
+
+    #######################################
+    # Push written records to the OS, once per cycle
+    #######################################
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def pending(self):
+        return self.count > 0
+
+    #######################################
+    # Oldest records for replay, confirm them with commit()
+    #######################################
+    def readBatch(self, maxRecords):
+        self.flush()
+        while self.segments:
+            records, end = self.readRecords(self.readSegment, self.readOffset, maxRecords)
+            if records:
+                return records, (self.readSegment, end, len(records))
+            if self.readSegment == self.writeSegment or self.readSegment == self.segments[-1]:
+                break
+            # Segment fully replayed, continue with the next one
+            self.dropSegment(self.readSegment)
+        if self.count:
+            # Only torn records left, nothing we could still send
+            logger.warning("Spool had " + str(self.count) + " unreadable messages left, discarding them")
+            self.commit((self.readSegment, self.readOffset, self.count))
+        return [], None
+
+    def commit(self, token):
+        segment, offset, count = token
+        self.readSegment, self.readOffset = segment, offset
+        self.count -= count
+        if self.count <= 0:
+            # Everything replayed, start over with a fresh segment
+            self.count = 0
+            for segment in list(self.segments):
+                self.dropSegment(segment)
+            self.readSegment, self.readOffset = 0, 0
+            try:
+                os.remove(self.posPath)
+            except OSError:
+                pass
+        else:
+            self.savePosition()
+
+    def dropSegment(self, segment):
+        if segment == self.writeSegment and self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.writeSegment = None
+        try:
+            os.remove(self.segmentPath(segment))
+        except OSError:
+            pass
+        self.segments.remove(segment)
+        if self.segments:
+            self.readSegment, self.readOffset = self.segments[0], 0
@@ -0,0 +1,171 @@
+#############################################################################
+##                          Loop supervision                               ##
+#############################################################################
+# Watches the scheduler from a thread of its own. As long as no task runs
+# and none is overdue for more than stallAfter seconds the loop counts as
+# healthy and the systemd watchdog is pinged. Once it stalls, the pings stop
+# so systemd restarts us after WatchdogSec, and after safeAfter seconds the
+# outputs are driven into their safe state from this thread. Whatever wedged
+# the loop (an I2C read that never returns, a publish waiting forever) may
+# keep it from ever switching the heater off itself.
+#
+# The watchdog is only used when started by systemd with Type=notify and
+# WatchdogSec set, otherwise the supervisor just watches.
+
+import os
+import time
+import socket
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# sd_notify(3) without libsystemd
+#######################################
+class Notifier:
+    def __init__(self, address=None):
+        address         = address if address is not None else os.getenv("NOTIFY_SOCKET")
+        self.address    = None
+        self.socket     = None
+        if not address:
+            return
+        # Abstract namespace sockets start with @
+        self.address    = "\0" + address[1:] if address.startswith("@") else address
+        self.socket     = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def notify(self, *fields):
+        if self.socket is None:
+            return False
+        try:
+            self.socket.sendto("\n".join(fields).encode("utf-8"), self.address)
+        except OSError:
+            logger.error("Notifying systemd didn't work!")
+            return False
+        return True
+
+    #######################################
+    # Seconds systemd waits for a ping, None without watchdog
+    #######################################
+    def watchdogTimeout(self):
+        usec = os.getenv("WATCHDOG_USEC")
+        pid  = os.getenv("WATCHDOG_PID")
+        if self.socket is None or not usec or (pid and int(pid) != os.getpid()):
+            return None
+        return int(usec) / 1e6
+
+#######################################
+# What the supervisor saw
+#######################################
+class SupervisionStats:
+    __slots__ = ("checks", "pings", "stalls", "safeStates", "recoveries", "longestStall", "maxLateness", "slowestTask")
+
+    def __init__(self):
+        self.checks         = 0
+        self.pings          = 0     # Watchdog pings sent
+        self.stalls         = 0     # Times the loop was late by more than stallAfter
+        self.safeStates     = 0     # Times the outputs were driven into their safe state
+        self.recoveries     = 0
+        self.longestStall   = 0.0   # Seconds
+        self.maxLateness    = 0.0   # Seconds the loop was late at worst, stalled or not
+        self.slowestTask    = None  # Task that was late by maxLateness
+
+class Supervisor:
+    #######################################
+    # Init
+    #######################################
+    def __init__(self, scheduler, stallAfter=30, safeAfter=60, safeState=None, recover=None, onEvent=None,
+                 notifier=None, interval=None, clock=time.monotonic):
+        self.scheduler  = scheduler
+        self.stallAfter = stallAfter    # Seconds late until the loop counts as stalled
+        self.safeAfter  = safeAfter     # Seconds late until safeState() is called
+        self.safeState  = safeState     # Drives the outputs into their safe state, from our thread
+        self.recover    = recover       # Called once a loop that had to be made safe runs again
+        self.onEvent    = onEvent       # Called with event name and details: stalled, safestate, recovered
+        self.notifier   = notifier or Notifier()
+        self.clock      = clock
+        self.stats      = SupervisionStats()
+        self.stalled    = None          # Monotonic start of the stall, None while healthy
+        self.safe       = False         # Outputs are in their safe state
+        self.stopped    = threading.Event()
+        self.thread     = None
+
+        # Check at least every second, twice per stallAfter and ping twice per watchdog timeout
+        watchdog = self.notifier.watchdogTimeout()
+        if interval is None:
+            interval = min(1.0, stallAfter / 2, watchdog / 2 if watchdog else 1.0)
+        self.interval = interval
+        if watchdog is not None and watchdog <= stallAfter:
+            logger.warning("WatchdogSec is shorter than stallAfter, systemd restarts before a stall is reported")
+
+    #######################################
+    # Thread
+    #######################################
+    def start(self):
+        self.notifier.notify("READY=1", "STATUS=Running")
+        self.thread = threading.Thread(target=self.run, name="supervisor", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Supervision check failed!")
+
+    def stop(self):
+        self.stopped.set()
+        self.notifier.notify("STOPPING=1")
+
+    #######################################
+    # One look at the loop
+    #######################################
+    def check(self, now=None):
+        now = self.clock() if now is None else now
+        task, late = self.scheduler.lateness(now)
+        stats = self.stats
+        stats.checks += 1
+        if late > stats.maxLateness:
+            stats.maxLateness = late
+            stats.slowestTask = task
+
+        if late <= self.stallAfter:
+            if self.stalled is not None:
+                seconds = now - self.stalled
+                self.stalled = None
+                stats.recoveries += 1
+                stats.longestStall = max(stats.longestStall, seconds)
+                if self.safe:
+                    self.safe = False
+                    if self.recover is not None:
+                        self.recover()
+                self.event("recovered", {"seconds": round(seconds, 1)})
+                self.notifier.notify("STATUS=Running")
+            if self.notifier.notify("WATCHDOG=1"):
+                stats.pings += 1
+            return
+
+        # Stalled, no more pings
+        if self.stalled is None:
+            self.stalled = now - late
+            stats.stalls += 1
+            self.event("stalled", {"task": task, "seconds": round(late, 1)})
+            self.notifier.notify("STATUS=Stalled in " + str(task))
+        stats.longestStall = max(stats.longestStall, late)
+        if late > self.safeAfter and not self.safe:
+            self.safe = True
+            stats.safeStates += 1
+            if self.safeState is not None:
+                try:
+                    self.safeState()
+                except Exception:
+                    logger.exception("Driving the outputs into their safe state failed!")
+            self.event("safestate", {"task": task, "seconds": round(late, 1)})
+
+    def event(self, name, details):
+        if self.onEvent is None:
+            return
+        try:
+            self.onEvent(name, details)
+        except Exception:
+            logger.exception("Reporting supervision event " + name + " failed!")